@@ -0,0 +1,141 @@
+import re
+import math
+import time
+import logging
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from decouple import config
+from db import get_connection, transaction
+from embeddings import get_embeddings, text_hash
+from loader import fileset_version
+from tracing import span
+
+ANSWER_CACHE_TTL_HOURS = config("ANSWER_CACHE_TTL_HOURS", default=24 * 7, cast=float)
+ANSWER_CACHE_MAX_ENTRIES = config("ANSWER_CACHE_MAX_ENTRIES", default=2000, cast=int)
+# 0 desativa a busca por perguntas quase idênticas (só acerta a pergunta normalizada exata)
+ANSWER_CACHE_SIMILARITY = config("ANSWER_CACHE_SIMILARITY", default=0.0, cast=float)
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    sources: str
+    latency_ms: float
+    similarity: float
+
+def normalize_question(question):
+    text = unicodedata.normalize("NFC", question).casefold()
+    text = re.sub(r"[?!.;:,\s]+$", "", text)
+    return " ".join(text.split())
+
+def _pack(vector):
+    return array("f", vector).tobytes()
+
+def _unpack(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def create_answer_cache_table():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                fileset TEXT NOT NULL,
+                model TEXT NOT NULL,
+                ignore_history INTEGER NOT NULL,
+                question_hash TEXT NOT NULL,
+                question TEXT,
+                embedding BLOB,
+                answer TEXT,
+                sources TEXT,
+                latency_ms REAL,
+                created_at REAL,
+                last_access REAL,
+                UNIQUE (fileset, model, ignore_history, question_hash)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_answer_cache_last_access ON answer_cache (last_access)")
+
+def _question_embedding(question):
+    try:
+        return get_embeddings().embed_query(normalize_question(question))
+    except Exception as e:
+        logging.warning(f"Cache de respostas sem similaridade: {type(e).__name__}: {e}")
+        return None
+
+def lookup_answer(selected_files, model, question, ignore_history=False, threshold=ANSWER_CACHE_SIMILARITY):
+    with span("cache.answer", model) as current:
+        cached = _lookup_answer(selected_files, model, question, ignore_history, threshold)
+        current.hits, current.misses = (1, 0) if cached else (0, 1)
+    return cached
+
+def _lookup_answer(selected_files, model, question, ignore_history, threshold):
+    # Versão do conjunto de arquivos: qualquer arquivo alterado ou não indexado gera outra chave
+    fileset = fileset_version(selected_files)
+    if fileset is None:
+        return None
+    # Com e sem histórico o prompt enviado ao modelo é diferente, então as respostas não se misturam
+    key = (fileset, model, int(bool(ignore_history)))
+    expires = time.time() - ANSWER_CACHE_TTL_HOURS * 3600
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, answer, sources, latency_ms FROM answer_cache
+            WHERE fileset = ? AND model = ? AND ignore_history = ? AND question_hash = ? AND created_at >= ?
+        """, key + (text_hash(normalize_question(question)), expires))
+        row = c.fetchone()
+    similarity = 1.0
+
+    # Perguntas quase idênticas: compara o embedding da pergunta com os das respostas do mesmo conjunto
+    if row is None and threshold > 0:
+        vector = _question_embedding(question)
+        if vector is not None:
+            with get_connection() as conn:
+                c = conn.cursor()
+                c.execute("""
+                    SELECT id, answer, sources, latency_ms, embedding FROM answer_cache
+                    WHERE fileset = ? AND model = ? AND ignore_history = ? AND created_at >= ?
+                      AND embedding IS NOT NULL
+                """, key + (expires,))
+                candidates = c.fetchall()
+            similarity = threshold
+            for candidate in candidates:
+                score = _cosine(vector, _unpack(candidate[4]))
+                if score >= similarity:
+                    row, similarity = candidate[:4], score
+    if row is None:
+        return None
+    with transaction() as conn:
+        conn.execute("UPDATE answer_cache SET last_access = ? WHERE id = ?", (time.time(), row[0]))
+    return CachedAnswer(answer=row[1], sources=row[2], latency_ms=row[3] or 0.0, similarity=similarity)
+
+def store_answer(selected_files, model, question, answer, sources, latency_ms, ignore_history=False,
+                 threshold=ANSWER_CACHE_SIMILARITY):
+    fileset = fileset_version(selected_files)
+    if fileset is None or not answer:
+        return
+    vector = _question_embedding(question) if threshold > 0 else None
+    now = time.time()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            REPLACE INTO answer_cache (fileset, model, ignore_history, question_hash, question, embedding, answer,
+                                       sources, latency_ms, created_at, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (fileset, model, int(bool(ignore_history)), text_hash(normalize_question(question)), normalize_question(question),
+              _pack(vector) if vector is not None else None, answer, sources, latency_ms, now, now))
+
+        # Expira por TTL e mantém só as entradas usadas mais recentemente
+        c.execute("DELETE FROM answer_cache WHERE created_at < ?", (now - ANSWER_CACHE_TTL_HOURS * 3600,))
+        c.execute("""
+            DELETE FROM answer_cache WHERE id IN (
+                SELECT id FROM answer_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+        """, (ANSWER_CACHE_MAX_ENTRIES,))
@@ -0,0 +1,380 @@
+import os
+import time
+import secrets
+import json
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional
+import pandas as pd
+from decouple import config
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from db import (
+    create_history_table, create_lai_table, create_tag_table, create_notes_table, create_index_table, create_meta_table,
+    create_search_tables, create_dedup_tables, create_manifest_tables, save_chat_to_db, get_all_tags, get_tag_counts,
+    get_tags_for_file, save_tags_for_file, get_manifest, list_manifest_files, search_documents, count_search_results,
+    insert_pergunta_lai, count_perguntas_lai, list_perguntas_lai, LAI_COLUMNS
+)
+from loader import process_documents, get_ready_files, filter_sources, CHROMA_HOST
+from chat import initialize_chain, stream_response
+from jobs import create_jobs_table, start_workers, prioritize_files, get_file_status, list_jobs
+from answer_cache import create_answer_cache_table, lookup_answer, store_answer, normalize_question
+from extraction_cache import create_extraction_cache
+from lai_search import index_pergunta_lai, find_similar_perguntas
+from metering import metered, Usage
+import tracing
+
+# API HTTP sem a interface: mesmas funções do app.py, sem reruns do Streamlit.
+# Uso: uvicorn api:app --host 127.0.0.1 --port 8000
+# Com API_TOKEN definido, toda requisição precisa do cabeçalho X-API-Token; sem ele, só exponha em 127.0.0.1
+# Ao lado do app.py, os dois processos precisam do mesmo servidor Chroma (CHROMA_HOST, ver loader.py) e só o
+# app.py roda os workers da fila (API_START_WORKERS=False, o padrão); sozinha, a API roda com API_START_WORKERS=True
+# Perguntas e uploads ocupam threads (LLM, embeddings, SQLite); os semáforos limitam quantos rodam ao mesmo tempo
+API_MAX_QUERIES = config("API_MAX_QUERIES", default=8, cast=int)
+API_MAX_INGESTS = config("API_MAX_INGESTS", default=2, cast=int)
+API_MAX_IO = config("API_MAX_IO", default=32, cast=int)
+API_START_WORKERS = config("API_START_WORKERS", default=False, cast=bool)
+API_SESSION_ID = "api"
+API_TOKEN = config("API_TOKEN", default="")
+
+_query_slots = asyncio.Semaphore(API_MAX_QUERIES)
+_ingest_slots = asyncio.Semaphore(API_MAX_INGESTS)
+_io_slots = asyncio.Semaphore(API_MAX_IO)
+
+# Perguntas idênticas em andamento: quem chega depois acompanha a mesma geração em vez de chamar o LLM de novo
+_flights = {}
+_tasks = set()
+
+@asynccontextmanager
+async def lifespan(app):
+    create_history_table()
+    create_tag_table()
+    create_notes_table()
+    create_lai_table()
+    create_index_table()
+    create_meta_table()
+    create_search_tables()
+    create_dedup_tables()
+    create_manifest_tables()
+    create_extraction_cache()
+    create_answer_cache_table()
+    create_jobs_table()
+    tracing.create_metrics_table()
+    if not API_TOKEN:
+        logging.warning("API sem autenticação (API_TOKEN vazio): não exponha fora de 127.0.0.1")
+    if not CHROMA_HOST:
+        logging.warning("Chroma embutido (CHROMA_HOST vazio): não rode a API junto com o app.py no mesmo diretório")
+    if API_START_WORKERS:
+        start_workers()
+    else:
+        logging.info("API_START_WORKERS=False: uploads ficam na fila para os workers do app.py")
+    yield
+
+def _check_token(x_api_token: Optional[str] = Header(None)):
+    if API_TOKEN and not secrets.compare_digest(x_api_token or "", API_TOKEN):
+        raise HTTPException(401, "Token da API ausente ou inválido.")
+
+app = FastAPI(title="RAG Chatbot API", lifespan=lifespan, dependencies=[Depends(_check_token)])
+
+async def _io(func, *args, **kwargs):
+    async with _io_slots:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+class _Flight:
+    # Trechos da resposta em geração; cada ouvinte relê desde o início e depois espera os próximos
+    def __init__(self, loop):
+        self.loop = loop
+        self.chunks = []
+        self.result = None
+        self.error = None
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, chunk):
+        # Chamado na thread da geração
+        self.loop.call_soon_threadsafe(self._append, chunk)
+
+    def _append(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    async def stream(self):
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.done:
+                return
+            await changed.wait()
+
+    async def wait(self):
+        while not self.done:
+            await self._changed.wait()
+
+class _Upload:
+    # process_documents espera o objeto do st.file_uploader: .name e leitura em blocos
+    def __init__(self, upload):
+        self.name = os.path.basename(upload.filename or "")
+        self._file = upload.file
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+class QueryRequest(BaseModel):
+    question: str
+    files: Optional[list[str]] = None  # Padrão: todo o acervo
+    folder: Optional[str] = None
+    tag: Optional[str] = None
+    model: str = "gpt-3.5-turbo"
+    ignore_history: bool = False
+    ignore_cache: bool = False
+    stream: bool = False
+    session_id: str = API_SESSION_ID
+
+class TagsRequest(BaseModel):
+    tags: list[str]
+
+class LaiRequest(BaseModel):
+    pergunta: str
+    data_envio: str  # AAAA-MM-DD; o prazo de 20 dias úteis é calculado aqui, como no formulário
+    origem: Optional[str] = None
+    destinatario: Optional[str] = None
+    orgao_recursal_1: Optional[str] = None
+    site_orgao_recursal_1: Optional[str] = None
+    texto_recurso_1: Optional[str] = None
+    orgao_recursal_2: Optional[str] = None
+    site_orgao_recursal_2: Optional[str] = None
+    texto_recurso_2: Optional[str] = None
+    tag: Optional[str] = None
+    transparencia_ativa: bool = False
+    observacao_privada: Optional[str] = None
+
+def _safe_folder(folder):
+    folder = os.path.normpath(folder or "").replace("\\", "/").strip("/")
+    if folder in ("", "."):
+        return ""
+    if os.path.isabs(folder) or folder.split("/")[0] == "..":
+        raise HTTPException(400, "Pasta inválida.")
+    return folder
+
+def _resolve_scope(body):
+    scope = filter_sources(body.files or list_manifest_files(), folder=body.folder, tag=body.tag)
+    if not scope:
+        raise HTTPException(404, "Nenhum arquivo corresponde aos filtros de pasta/tag.")
+    # Arquivos ainda em indexação ficam de fora e sobem na fila, como no chat
+    ready = get_ready_files(scope)
+    pending = [f for f in scope if f not in ready]
+    if pending:
+        prioritize_files(pending)
+    if not ready:
+        raise HTTPException(409, "Os arquivos selecionados ainda estão em indexação. Tente novamente em instantes.")
+    return ready, pending
+
+def _usage_dict(usage, model):
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "embedding_tokens": usage.embedding_tokens,
+        "cost_usd": round(usage.cost(model), 6),
+    }
+
+def _answer(body, scope, push):
+    # Roda numa thread: mesmo fluxo do chat do app.py (cache de respostas, chain, histórico)
+    with tracing.request("api.query", body.question[:80]), metered() as usage:
+        start = time.perf_counter()
+        cached = None if body.ignore_cache else lookup_answer(scope, body.model, body.question, body.ignore_history)
+        if cached:
+            push(cached.answer)
+            latency = (time.perf_counter() - start) * 1000
+            save_chat_to_db(body.model, body.question, cached.answer, cached.sources, latency, latency,
+                            session_id=body.session_id, cache_hit=True,
+                            latency_saved_ms=max(cached.latency_ms - latency, 0), usage=usage, document_set=scope)
+            return {"answer": cached.answer, "sources": cached.sources, "cached": True, "latency_ms": latency,
+                    "usage": _usage_dict(usage, body.model)}
+
+        chain = initialize_chain(scope, body.model)
+        if chain is None:
+            raise RuntimeError("Nenhum conteúdo válido vetorizado.")
+        response = stream_response(chain, body.question, body.ignore_history)
+        for chunk in response:
+            push(chunk)
+        save_chat_to_db(body.model, body.question, response.answer, response.sources, response.ttft_ms,
+                        response.latency_ms, session_id=body.session_id, usage=response.usage, document_set=scope)
+        store_answer(scope, body.model, body.question, response.answer, response.sources, response.latency_ms,
+                     body.ignore_history)
+        return {"answer": response.answer, "sources": response.sources, "cached": False,
+                "ttft_ms": response.ttft_ms, "latency_ms": response.latency_ms,
+                "usage": _usage_dict(response.usage, body.model)}
+
+def _save_follower(body, scope, result, latency):
+    # Pergunta juntada a outra em andamento: entra no histórico da própria sessão sem tokens, como um acerto de cache
+    save_chat_to_db(body.model, body.question, result["answer"], result["sources"], None, latency,
+                    session_id=body.session_id, cache_hit=True,
+                    latency_saved_ms=max(result["latency_ms"] - latency, 0), usage=Usage(), document_set=scope)
+
+async def _lead(key, flight, body, scope):
+    try:
+        async with _query_slots:
+            flight.result = await asyncio.to_thread(_answer, body, scope, flight.push)
+    except Exception as e:
+        flight.error = f"{type(e).__name__}: {e}"
+        logging.warning(f"API: falha ao responder \"{body.question[:80]}\": {flight.error}")
+    finally:
+        _flights.pop(key, None)
+        flight.finish()
+
+async def _ndjson(flight, extra, on_done=None):
+    # Uma linha JSON por trecho; a última traz a resposta completa, as fontes e o consumo (ou o erro)
+    async for chunk in flight.stream():
+        yield json.dumps({"token": chunk}, ensure_ascii=False) + "\n"
+    if not flight.error and on_done:
+        await on_done()
+    final = {"error": flight.error} if flight.error else {**flight.result, **extra, "done": True}
+    yield json.dumps(final, ensure_ascii=False) + "\n"
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "in_flight": len(_flights)}
+
+@app.post("/query")
+async def query(body: QueryRequest):
+    if not body.question.strip():
+        raise HTTPException(400, "Pergunta vazia.")
+    start = time.perf_counter()
+    scope, pending = await _io(_resolve_scope, body)
+    key = (tuple(sorted(scope)), body.model, normalize_question(body.question), body.ignore_history, body.ignore_cache)
+    flight = _flights.get(key)
+    coalesced = flight is not None
+    if flight is None:
+        flight = _flights[key] = _Flight(asyncio.get_running_loop())
+        task = asyncio.create_task(_lead(key, flight, body, scope))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    extra = {"coalesced": coalesced, "pending_files": pending}
+    on_done = None
+    if coalesced:
+        # O consumo é todo de quem gerou a resposta; quem acompanhou só ganha a sua linha no histórico
+        extra["usage"] = _usage_dict(Usage(), body.model)
+
+        async def on_done():
+            await _io(_save_follower, body, scope, flight.result, (time.perf_counter() - start) * 1000)
+
+    if body.stream:
+        return StreamingResponse(_ndjson(flight, extra, on_done), media_type="application/x-ndjson",
+                                 headers={"X-Coalesced": str(int(coalesced))})
+    await flight.wait()
+    if flight.error:
+        raise HTTPException(502, flight.error)
+    if on_done:
+        await on_done()
+    return {**flight.result, **extra}
+
+@app.post("/ingest")
+async def ingest(files: list[UploadFile] = File(...), folder: str = Form("")):
+    folder = _safe_folder(folder)
+    uploads = [_Upload(upload) for upload in files]
+    if any(not upload.name or upload.name.startswith(".") for upload in uploads):
+        raise HTTPException(400, "Nome de arquivo inválido.")
+    async with _ingest_slots:
+        # Só grava e enfileira; a indexação segue na fila em segundo plano (acompanhe em /files ou /jobs)
+        return await asyncio.to_thread(process_documents, uploads, folder)
+
+@app.get("/files")
+async def files(folder: Optional[str] = None):
+    def load():
+        manifest = get_manifest()
+        jobs = get_file_status()
+        paths = list_manifest_files(_safe_folder(folder) if folder else None)
+        return [
+            {"path": path, "size": manifest[path][0], "status": manifest[path][4],
+             "job": jobs.get(path, (None,))[0]}
+            for path in paths if path in manifest
+        ]
+    return await _io(load)
+
+@app.get("/jobs")
+async def jobs(limit: int = 20):
+    rows = await _io(list_jobs, limit)
+    columns = ("id", "kind", "source", "status", "progress", "attempts", "error")
+    return [dict(zip(columns, row)) for row in rows]
+
+@app.get("/search")
+async def search(q: str, limit: int = 20, offset: int = 0):
+    if not q.strip():
+        raise HTTPException(400, "Termo de busca vazio.")
+    limit = max(1, min(limit, 100))
+
+    def load():
+        total = count_search_results(q)
+        rows = search_documents(q, limit, offset) if total else []
+        return {"total": total, "results": [{"source": s, "page": p, "snippet": t} for s, p, t in rows]}
+    return await _io(load)
+
+@app.get("/tags")
+async def tags():
+    names, counts = await asyncio.gather(_io(get_all_tags), _io(get_tag_counts))
+    return {"tags": names, "counts": counts}
+
+@app.get("/files/{source:path}/tags")
+async def file_tags(source: str):
+    return {"source": source, "tags": await _io(get_tags_for_file, source)}
+
+@app.put("/files/{source:path}/tags")
+async def set_file_tags(source: str, body: TagsRequest):
+    if source not in await _io(get_manifest):
+        raise HTTPException(404, "Arquivo não encontrado.")
+    tags = [tag.strip() for tag in body.tags if tag.strip()]
+    await _io(save_tags_for_file, source, tags)
+    return {"source": source, "tags": tags}
+
+@app.get("/lai")
+async def lai_list(tag: Optional[str] = None, destinatario: Optional[str] = None, limit: int = 20,
+                   after_data: Optional[str] = None, after_id: Optional[int] = None):
+    # Paginação por chave: passe data_envio e id da última linha recebida
+    after = (after_data, after_id) if after_data and after_id is not None else None
+    total, rows = await asyncio.gather(
+        _io(count_perguntas_lai, tag, destinatario),
+        _io(list_perguntas_lai, tag, destinatario, max(1, min(limit, 100)), after)
+    )
+    columns = ("id", "pergunta", "data_envio", "data_limite_resposta", "destinatario", "tag", "observacao_privada")
+    return {"total": total, "items": [dict(zip(columns, row)) for row in rows]}
+
+@app.post("/lai", status_code=201)
+async def lai_create(body: LaiRequest):
+    values = body.model_dump()
+    try:
+        data_envio = pd.to_datetime(values["data_envio"])
+    except (ValueError, TypeError):
+        raise HTTPException(400, "data_envio inválida (use AAAA-MM-DD).")
+    values["data_envio"] = str(data_envio.date())
+    values["data_limite_resposta"] = str((data_envio + pd.offsets.BDay(20)).date())
+    values["transparencia_ativa"] = int(values["transparencia_ativa"])
+    id_ = await _io(insert_pergunta_lai, **{column: values.get(column) for column in LAI_COLUMNS})
+    try:
+        await _io(index_pergunta_lai, id_)
+    except Exception as e:
+        logging.warning(f"Pergunta LAI {id_} salva, mas não indexada para busca semântica: {e}")
+    return {"id": id_, "data_limite_resposta": values["data_limite_resposta"]}
+
+@app.get("/lai/similar")
+async def lai_similar(texto: str, k: int = 5, before_id: Optional[int] = None):
+    # before_id: só perguntas cadastradas antes desta
+    rows = await _io(find_similar_perguntas, texto, max(1, min(k, 50)), before_id)
+    return [{"id": id_, "score": score, "campo": campo, "pergunta": pergunta, "data_envio": data_envio}
+            for id_, score, campo, pergunta, data_envio in rows]
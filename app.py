@@ -1,23 +1,27 @@
 import base64
-import sqlite3
 import hashlib
-import pickle
-import pytesseract
 import os
 import pandas as pd
-import shutil
 import streamlit as st
 import datetime
-import pytesseract
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
+import time
+import uuid
 from pandas.tseries.offsets import BDay
 from decouple import config
-from db import create_history_table, create_lai_table, create_tag_table, load_chat_history, save_chat_to_db, delete_all_history, get_tags_for_file, save_tags_for_file, get_all_tags, create_notes_table, save_document_note, get_document_note
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, UnstructuredWordDocumentLoader
-from loader import process_documents, get_available_files, load_file, delete_files, UPLOAD_DIRECTORY
-from chat import initialize_chain, get_response, render_sources
-from pdf2image import convert_from_path
+from db import create_history_table, create_lai_table, create_tag_table, load_chat_history, has_older_chats, save_chat_to_db, delete_all_history, get_tags_for_file, save_tags_for_file, get_all_tags, create_notes_table, save_document_note, get_document_note, create_index_table, create_meta_table, create_search_tables, create_dedup_tables, get_dedup_stats, search_documents, count_search_results
+from db import create_manifest_tables, list_manifest_files, list_manifest_folders, count_manifest_files, save_manifest_dir, get_manifest
+from db import get_files_by_tag, get_tag_counts, get_model_usage, get_token_usage, get_answer_cache_usage, buscar_relacionados_em_lote, insert_pergunta_lai, update_pergunta_lai, get_lai_filter_values, count_perguntas_lai, list_perguntas_lai
+from loader import process_documents, get_ready_files, filter_sources, load_preview_text, known_file_hash, delete_files, delete_folder, rename_source, UPLOAD_DIRECTORY, PERSIST_DIRECTORY
+from chat import initialize_chain, stream_response, render_sources
+from ocr import ocr_pdf, OCR_MAX_PAGES
+from jobs import create_jobs_table, start_workers, prioritize_files
+from answer_cache import create_answer_cache_table, lookup_answer, store_answer
+from preview_server import ensure_preview_server, preview_url
+from lai_search import index_pergunta_lai, find_similar_perguntas, find_relevant_chunks
+from extraction_cache import create_extraction_cache, get_extraction, save_extraction
 from ui import render_sidebar, render_chat_history
+import tracing
+from metering import metered
 
 # Funções
 
@@ -25,82 +29,64 @@ def resumir_documento(texto, max_chars=1000):
     resumo = texto.strip().replace("\n", " ").replace("  ", " ")
     return resumo[:max_chars] + "..." if len(resumo) > max_chars else resumo
 
+SUMMARY_VERSION = "1"
+
+HISTORY_WINDOW = config("HISTORY_WINDOW", default=20, cast=int)
+
+DASHBOARD_PAGE_SIZE = config("DASHBOARD_PAGE_SIZE", default=20, cast=int)
+DASHBOARD_PREVIEW_CHARS = config("DASHBOARD_PREVIEW_CHARS", default=3000, cast=int)
+DASHBOARD_OCR_PAGES = config("DASHBOARD_OCR_PAGES", default=2, cast=int)
+
+PERFORMANCE_PERIODS = {"Última hora": 3600, "Últimas 24 horas": 86400, "Últimos 7 dias": 7 * 86400}
+CACHE_LABELS = {"cache.answer": "Respostas", "cache.extraction": "Extração", "embedding": "Embeddings"}
+
+def rotular_conjunto(arquivos, max_nomes=3):
+    nomes = ", ".join(arquivos[:max_nomes]) + ("…" if len(arquivos) > max_nomes else "")
+    return f"{len(arquivos)} arquivo(s): {nomes}"
+
 def get_cached_summary(file_path):
-    cache_file = f"{file_path}.summary.cache"
-    if os.path.exists(cache_file):
-        with open(cache_file, "rb") as f:
-            return pickle.load(f)
-    return None
+    return get_extraction(known_file_hash(file_path), "summary", SUMMARY_VERSION)
 
 def save_summary_cache(file_path, summary):
-    cache_file = f"{file_path}.summary.cache"
-    with open(cache_file, "wb") as f:
-        pickle.dump(summary, f)
-
-def buscar_perguntas_relacionadas(tag, id_atual):
-    if not tag:
-        return []
-    conn = sqlite3.connect("chat_history.sqlite3")
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, pergunta FROM perguntas_lai
-        WHERE tag = ? AND id != ?
-        ORDER BY data_envio DESC LIMIT 5
-    """, (tag, id_atual))
-    relacionadas = c.fetchall()
-    conn.close()
-    return relacionadas
-
-def buscar_documentos_por_tag(tag):
-    if not tag:
-        return []
-    conn = sqlite3.connect("chat_history.sqlite3")
-    c = conn.cursor()
-    c.execute("""
-        SELECT file_name FROM document_tags
-        WHERE tags LIKE ?
-    """, (f"%{tag}%",))
-    rows = c.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
-
-def get_cached_ocr(file_path):
-    cache_path = f"{file_path}.ocr.cache"
-    if os.path.exists(cache_path):
-        with open(cache_path, "r", encoding="utf-8") as f:
-            return f.read()
-    return None
-
-def save_cached_ocr(file_path, content):
-    cache_path = f"{file_path}.ocr.cache"
-    with open(cache_path, "w", encoding="utf-8") as f:
-        f.write(content)
-
-from pdf2image import convert_from_path
-import pytesseract
-
-def extract_text_from_image_pdf(file_path, max_pages=3):
+    save_extraction(known_file_hash(file_path), "summary", SUMMARY_VERSION, summary)
+
+def extract_text_from_image_pdf(file_path, max_pages=OCR_MAX_PAGES):
     try:
-        images = convert_from_path(
+        progress = st.progress(0, text="🔍 Executando OCR nas páginas do PDF...")
+        extracted_text, report = ocr_pdf(
             file_path,
-            dpi=200,
-            first_page=1,
-            last_page=max_pages,
-            poppler_path=r"C:\Program Files\poppler-24.08.0\Library\bin"
+            max_pages=max_pages,
+            progress_callback=lambda done, total: progress.progress(done / total if total else 1.0)
         )
-        extracted_text = ""
-        progress = st.progress(0, text="🔍 Executando OCR nas páginas do PDF...")
-
-        for i, img in enumerate(images):
-            text = pytesseract.image_to_string(img, lang="por")
-            extracted_text += text + "\n\n"
-            progress.progress((i + 1) / len(images))
         progress.empty()  # limpa a barra ao final
-        return extracted_text.strip()
+        st.caption(f"⏱️ OCR: {report.summary()}")
+        return extracted_text
     except Exception as e:
         return f"[Erro no OCR de imagem] {str(e)}"
 
 
+def indexar_pergunta_lai(id_):
+    try:
+        index_pergunta_lai(id_)
+    except Exception as e:
+        st.warning(f"Pergunta salva, mas não foi possível atualizar a busca semântica: {e}")
+
+def exibir_semelhantes(texto, before_id=None, key=""):
+    semelhantes = find_similar_perguntas(texto, k=5, before_id=before_id)
+    if semelhantes:
+        st.markdown("🧭 **Perguntas semelhantes:**")
+        for rid, score, campo, texto_rel, data_rel in semelhantes:
+            resumo = (texto_rel or "").strip().replace("\n", " ")
+            origem = "" if campo == "pergunta" else f" (via {campo})"
+            st.markdown(f"- #{rid} ({data_rel}) — similaridade {score:.2f}{origem}: {resumo[:100]}{'...' if len(resumo) > 100 else ''}")
+    else:
+        st.caption("Nenhuma pergunta semelhante encontrada.")
+    trechos = find_relevant_chunks(texto, k=3)
+    if trechos:
+        st.markdown("📎 **Trechos de documentos relevantes:**")
+        for doc, score in trechos:
+            st.markdown(f"- `{doc.metadata.get('source')}` ({score:.2f}): {doc.page_content[:200].strip()}...")
+
 # Setup inicial
 st.set_page_config(page_title="Chat com documentos (RAG)", page_icon="📄")
 os.environ["OPENAI_API_KEY"] = config("OPENAI_API_KEY")
@@ -108,10 +94,33 @@ create_history_table()
 create_tag_table()
 create_notes_table()
 create_lai_table()
+create_index_table()
+create_meta_table()
+create_search_tables()
+create_dedup_tables()
+create_manifest_tables()
+create_extraction_cache()
+create_answer_cache_table()
+create_jobs_table()
+tracing.create_metrics_table()
+start_workers()
 
 if "page" not in st.session_state:
     st.session_state.page = "Analytics"
 
+# Cada conversa tem seu próprio ID, mantido na URL para sobreviver a recarregamentos da página
+if "conversa" not in st.query_params:
+    st.query_params["conversa"] = uuid.uuid4().hex
+session_id = st.query_params["conversa"]
+# Conversas deste navegador, para a lista da barra lateral; conversas de outros usuários nunca são listadas
+minhas_conversas = st.session_state.setdefault("minhas_conversas", [])
+if session_id in minhas_conversas:
+    minhas_conversas.remove(session_id)
+minhas_conversas.insert(0, session_id)
+if st.session_state.get("historico_sessao") != session_id:
+    st.session_state.historico_sessao = session_id
+    st.session_state.historico_desde = None  # None: só as mensagens mais recentes
+
 # Sidebar
 uploaded_files, selected_files, selected_model, selected_folder = render_sidebar()
 
@@ -141,6 +150,8 @@ if st.sidebar.button("➕ Cadastrar nova pergunta LAI"):
 
 # Opção para ignorar o histórico apenas na próxima pergunta
 ignore_history = st.sidebar.checkbox("🔁 Ignorar histórico nesta pergunta", value=False)
+ignore_cache = st.sidebar.checkbox("♻️ Ignorar cache de respostas nesta pergunta", value=False)
+perfilar = st.sidebar.checkbox("🔬 Gerar perfil (cProfile) das perguntas", value=False)
 
 if page == "Chat":
     # Processamento de arquivos
@@ -152,43 +163,124 @@ if page == "Chat":
     
     st.title("🤖 Chat com documentos (RAG)")
     
-    # Histórico
+    # Histórico: janela das mensagens mais recentes desta conversa; anteriores sob demanda (keyset por id)
     st.subheader("🕘 Histórico")
-    render_chat_history(load_chat_history())
+    if st.session_state.historico_desde is None:
+        historico = load_chat_history(session_id, limit=HISTORY_WINDOW)
+    else:
+        historico = load_chat_history(session_id, since_id=st.session_state.historico_desde)
+    if historico and has_older_chats(session_id, historico[0][0]):
+        if st.button("⬆️ Carregar mensagens anteriores"):
+            anteriores = load_chat_history(session_id, limit=HISTORY_WINDOW, before_id=historico[0][0])
+            st.session_state.historico_desde = anteriores[0][0]
+            st.rerun()
+    render_chat_history(historico)
+
+    # Perfil da última pergunta perfilada: resumo por tempo acumulado e o .prof para snakeviz/pstats
+    perfil = st.session_state.get("ultimo_perfil")
+    resumo_perfil = tracing.profile_summary(perfil) if perfil else None
+    if resumo_perfil:
+        with st.expander("🔬 Perfil da última pergunta"):
+            st.code(resumo_perfil)
+            with open(tracing.profile_path(perfil), "rb") as f:
+                st.download_button("⬇️ Baixar perfil (.prof)", f, file_name=f"{perfil}.prof")
+
+    # Escopo da pergunta: pasta e tag restringem os arquivos consultados nos índices léxico e vetorial
+    col_pasta, col_tag = st.columns(2)
+    pastas = sorted({f.split("/")[0] for f in selected_files if "/" in f})
+    filtro_pasta = col_pasta.selectbox("📁 Restringir à pasta", ["Todas"] + pastas)
+    filtro_tag = col_tag.selectbox("🏷️ Restringir à tag", ["Todas"] + get_all_tags())
+    escopo = filter_sources(
+        selected_files,
+        folder=None if filtro_pasta == "Todas" else filtro_pasta,
+        tag=None if filtro_tag == "Todas" else filtro_tag
+    )
 
     # Chat
     prompt = st.chat_input("Como posso ajudar?")
-    if prompt and selected_files:
-        with st.spinner("💬 Buscando resposta..."):
-            qa_chain = initialize_chain(selected_files, selected_model)
+    if prompt and selected_files and not escopo:
+        st.warning("Nenhum dos arquivos selecionados corresponde aos filtros de pasta/tag.")
+    elif prompt and escopo:
+        # Arquivos ainda em indexação ficam de fora desta resposta e sobem na fila
+        prontos = get_ready_files(escopo)
+        pendentes = [f for f in escopo if f not in prontos]
+        if pendentes:
+            prioritize_files(pendentes)
+            if prontos:
+                st.info(f"⏳ {len(pendentes)} arquivo(s) ainda não indexado(s) ficaram de fora; "
+                        f"respondendo com os {len(prontos)} já indexados.")
+            else:
+                st.warning("⏳ Os arquivos selecionados ainda estão em indexação. Tente novamente em instantes.")
+        escopo = prontos
+
+    if prompt and escopo:
+        # Todos os spans da pergunta (cache, recuperação, LLM, SQLite) ficam agrupados sob o mesmo ID
+        with tracing.request("chat", prompt[:80], profile=perfilar) as request_id, metered() as uso:
+            if perfilar:
+                st.session_state.ultimo_perfil = request_id
+            inicio = time.perf_counter()
+            cached = None if ignore_cache else lookup_answer(escopo, selected_model, prompt, ignore_history)
+            if cached:
+                with st.chat_message("user"):
+                    st.markdown(f"**({selected_model})** {prompt}")
+                with st.chat_message("assistant"):
+                    st.markdown(cached.answer)
+                    render_sources(cached.sources)
+                latencia = (time.perf_counter() - inicio) * 1000
+                save_chat_to_db(selected_model, prompt, cached.answer, cached.sources, latencia, latencia,
+                                session_id=session_id, cache_hit=True,
+                                latency_saved_ms=max(cached.latency_ms - latencia, 0), usage=uso, document_set=escopo)
+                st.rerun()
+
+            with st.spinner("💬 Buscando resposta..."):
+                qa_chain = initialize_chain(escopo, selected_model)
             if qa_chain:
-                result = get_response(qa_chain, prompt, ignore_history)
-                resposta = result.get("answer")
-                fontes = result.get("sources")
                 with st.chat_message("user"):
                     st.markdown(f"**({selected_model})** {prompt}")
                 with st.chat_message("assistant"):
-                    st.markdown(resposta)
-                    render_sources(fontes)
-                save_chat_to_db(selected_model, prompt, resposta, fontes)
-        st.rerun()
+                    resposta = stream_response(qa_chain, prompt, ignore_history)
+                    st.write_stream(iter(resposta))
+                    render_sources(resposta.sources)
+                    if resposta.packing:
+                        ctx = resposta.packing
+                        st.caption(f"📦 Contexto: {ctx['chunks']} chunk(s) → {ctx['spans']} trecho(s), "
+                                   f"{ctx['tokens_before']} → {ctx['tokens_after']} tokens")
+                    consumo = resposta.usage
+                    st.caption(f"🪙 {consumo.prompt_tokens} tokens de prompt + {consumo.completion_tokens} de resposta "
+                               f"· US$ {consumo.cost(selected_model):.4f}")
+                save_chat_to_db(selected_model, prompt, resposta.answer, resposta.sources,
+                                resposta.ttft_ms, resposta.latency_ms, session_id=session_id,
+                                usage=resposta.usage, document_set=escopo)
+                store_answer(escopo, selected_model, prompt, resposta.answer, resposta.sources,
+                             resposta.latency_ms, ignore_history)
+            st.rerun()
 
 elif page == "Dashboard":
     st.title("📊 Dashboard de Documentos")
+    inicio = time.perf_counter()
+    payload = 0  # Bytes de conteúdo enviados ao navegador nesta renderização
 
-    files = get_available_files()
-
-    folders = sorted(set([f.split("/")[0] for f in files]))
-    folder_filter = st.selectbox("📁 Filtrar por pasta", ["Todas"] + folders)
-    filtered_files = [f for f in files if folder_filter == "Todas" or f.startswith(folder_filter + "/")]
+    folder_filter = st.selectbox("📁 Filtrar por pasta", ["Todas"] + list_manifest_folders())
+    filtered_files = list_manifest_files(None if folder_filter == "Todas" else folder_filter)
 
     st.subheader("📁 Documentos carregados")
 
-    if not files:
+    if not filtered_files and folder_filter == "Todas":
         st.info("Nenhum documento foi carregado ainda.")
     else:
-        for file in filtered_files:
-            with st.expander(f"📄 {file}"):
+        # Paginação: só os documentos da página atual são renderizados
+        total_paginas = max(1, -(-len(filtered_files) // DASHBOARD_PAGE_SIZE))
+        pagina = st.number_input("Página", min_value=1, max_value=total_paginas, value=1, step=1)
+        pagina_files = filtered_files[(pagina - 1) * DASHBOARD_PAGE_SIZE:pagina * DASHBOARD_PAGE_SIZE]
+        st.caption(f"{len(filtered_files)} documento(s) — página {pagina} de {total_paginas}")
+
+        ensure_preview_server()
+        all_tags = None
+        for file in pagina_files:
+            # Detalhes (anotações, pré-visualização e texto) só são carregados quando o documento é aberto
+            if not st.toggle(f"📄 {file}", key=f"detalhes_{file}"):
+                continue
+            with st.container(border=True):
                 note, favorite = get_document_note(file)
 
                 # Favorito
@@ -196,6 +288,7 @@ elif page == "Dashboard":
 
                 # Anotação
                 user_note = st.text_area("📝 Anotação para este documento", value=note, height=100, key=f"note_{file}")
+                payload += len(note or "")
 
                 if st.button("💾 Salvar anotação/favorito", key=f"save_note_{file}"):
                     save_document_note(file, user_note, is_fav)
@@ -205,58 +298,47 @@ elif page == "Dashboard":
                 existing_tags = get_tags_for_file(file)
                 st.markdown(f"🏷️ **Classificação:** {', '.join(existing_tags) if existing_tags else 'Nenhuma'}")
 
-                file_path = os.path.join("uploaded_files", file)
-
-                import base64  # coloque no topo do app.py, se ainda não estiver
+                file_path = os.path.join(UPLOAD_DIRECTORY, file)
 
-                # Botão de download
+                # Download pelo Streamlit (servido por URL de mídia, não pelo websocket), só do documento aberto
                 with open(file_path, "rb") as f:
-                    st.download_button(f"📥 Baixar {os.path.basename(file_path)}", data=f, file_name=os.path.basename(file_path))
-
-                # Se for PDF, tenta exibir como iframe
-                if file.endswith(".pdf"):
-                    with open(file_path, "rb") as f:
-                        base64_pdf = base64.b64encode(f.read()).decode('utf-8')
-                        pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="100%" height="500px" type="application/pdf"></iframe>'
-                        st.markdown(pdf_display, unsafe_allow_html=True)
-
-                # Tentativa de leitura e cache
-                cached_text = get_cached_ocr(file_path)
-                if cached_text and not cached_text.startswith("[Erro no OCR"):
-                    st.text_area("📄 Conteúdo extraído do cache", value=cached_text[:3000], height=300)
+                    st.download_button(f"📥 Baixar {os.path.basename(file_path)}", data=f,
+                                       file_name=os.path.basename(file_path), key=f"download_{file}")
+
+                if file.endswith(".pdf") and st.checkbox("👁️ Pré-visualizar PDF", key=f"preview_{file}"):
+                    # Por referência, com link assinado, quando o servidor de pré-visualização está configurado;
+                    # senão, embutido, só para este documento
+                    src = preview_url(file)
+                    if src is None:
+                        with open(file_path, "rb") as f:
+                            src = "data:application/pdf;base64," + base64.b64encode(f.read()).decode("ascii")
+                        payload += len(src)
+                    st.markdown(
+                        f'<iframe src="{src}" width="100%" height="500px" type="application/pdf"></iframe>',
+                        unsafe_allow_html=True
+                    )
+
+                # Só as primeiras páginas necessárias para o trecho exibido, via cache de extração
+                try:
+                    full_text = load_preview_text(file_path, max_chars=DASHBOARD_PREVIEW_CHARS)
+                except Exception as e:
+                    st.warning(f"Erro ao extrair texto: {e}")
+                    full_text = ""
+
+                if not full_text.strip() and file.endswith(".pdf"):
+                    with st.spinner("🧠 Extraindo texto com OCR (aguarde alguns segundos)..."):
+                        full_text = extract_text_from_image_pdf(file_path, max_pages=DASHBOARD_OCR_PAGES)
+
+                if full_text.startswith("[Erro no OCR"):
+                    st.warning(full_text)
+                elif full_text.strip():
+                    st.text_area("📄 Conteúdo extraído do arquivo", value=full_text[:DASHBOARD_PREVIEW_CHARS], height=300)
+                    payload += len(full_text[:DASHBOARD_PREVIEW_CHARS].encode("utf-8"))
                 else:
-                    try:
-                        if file.endswith(".pdf"):
-                            loader = PyPDFLoader(file_path)
-                        elif file.endswith(".txt"):
-                            loader = TextLoader(file_path, encoding="utf-8")
-                        elif file.endswith(".docx"):
-                            loader = UnstructuredWordDocumentLoader(file_path)
-                        else:
-                            loader = None
-
-                        if loader:
-                            docs = loader.load()
-                            full_text = "\n".join([doc.page_content for doc in docs])
-                        else:
-                            full_text = ""
-                    except Exception as e:
-                        st.warning(f"Erro ao extrair texto: {e}")
-                        full_text = ""
-
-                    if not full_text.strip() and file.endswith(".pdf"):
-                        with st.spinner("🧠 Extraindo texto com OCR (aguarde alguns segundos)..."):
-                            full_text = extract_text_from_image_pdf(file_path)
-
-                    if full_text.strip():
-                        save_cached_ocr(file_path, full_text)
-                        st.text_area("📄 Conteúdo extraído do arquivo", value=full_text[:3000], height=300)
-                    else:
-                        st.warning("❌ Nenhum conteúdo textual foi encontrado neste arquivo.")
-
-
-
-                all_tags = get_all_tags()
+                    st.warning("❌ Nenhum conteúdo textual foi encontrado neste arquivo.")
+
+                if all_tags is None:
+                    all_tags = get_all_tags()
                 selected_tags = st.multiselect(
                     f"Editar classificação (tags) para {file}",
                     options=all_tags,
@@ -272,24 +354,18 @@ elif page == "Dashboard":
                     st.success("Classificação salva com sucesso!")
                     st.rerun()
 
+        st.caption(f"⏱️ Página renderizada em {(time.perf_counter() - inicio) * 1000:.0f} ms · {payload / 1024:.1f} KB de conteúdo enviado")
+
 elif page == "Classificações":
     st.title("🏷️ Classificações (Tags)")
 
-    all_tags = get_all_tags()
-    if not all_tags:
+    files_by_tag = get_files_by_tag()
+    if not files_by_tag:
         st.info("Nenhuma classificação encontrada ainda.")
     else:
-        for tag in all_tags:
+        for tag, files in files_by_tag.items():
             st.subheader(f"🔖 Tag: `{tag}`")
 
-            conn = sqlite3.connect("chat_history.sqlite3")
-            c = conn.cursor()
-            c.execute("SELECT file_name, tags FROM document_tags")
-            rows = c.fetchall()
-            conn.close()
-
-            files = [file for file, tag_str in rows if tag in [t.strip() for t in tag_str.split(",")]]
-
             if files:
                 for file in files:
                     with st.expander(f"📄 {file}"):
@@ -307,14 +383,14 @@ elif page == "Classificações":
 elif page == "Pastas":
     st.title("📂 Gerenciador de Pastas")
 
-    folders = os.listdir(UPLOAD_DIRECTORY)
-    folders = [f for f in folders if os.path.isdir(os.path.join(UPLOAD_DIRECTORY, f))]
+    folders = list_manifest_folders()
     selected_folder = st.selectbox("📁 Selecione uma pasta para gerenciar", folders + ["[Criar nova pasta]"])
 
     if selected_folder == "[Criar nova pasta]":
         new_folder = st.text_input("🔧 Nome da nova pasta")
         if new_folder and st.button("➕ Criar pasta"):
             os.makedirs(os.path.join(UPLOAD_DIRECTORY, new_folder), exist_ok=True)
+            save_manifest_dir(new_folder, os.stat(os.path.join(UPLOAD_DIRECTORY, new_folder)).st_mtime)
             st.success(f"Pasta '{new_folder}' criada com sucesso!")
             st.rerun()
 
@@ -325,12 +401,12 @@ elif page == "Pastas":
         # Renomear pasta
         new_name = st.text_input("✏️ Renomear pasta", value=selected_folder, key="rename_input")
         if new_name and new_name != selected_folder and st.button("🔄 Renomear"):
-            os.rename(folder_path, os.path.join(UPLOAD_DIRECTORY, new_name))
+            rename_source(f"{selected_folder}/", f"{new_name}/")
             st.success("Pasta renomeada com sucesso!")
             st.rerun()
 
-        # Listar arquivos da pasta
-        files = os.listdir(folder_path)
+        # Listar arquivos da pasta (só os que estão diretamente nela, segundo o manifesto)
+        files = [os.path.basename(f) for f in get_manifest(selected_folder)]
         st.markdown("### 📄 Arquivos:")
         for file in files:
             file_path = os.path.join(folder_path, file)
@@ -347,10 +423,7 @@ elif page == "Pastas":
             file_to_move = st.selectbox("📦 Escolha um arquivo para mover", files)
             target_folder = st.selectbox("📍 Mover para:", [f for f in folders if f != selected_folder])
             if st.button("🚚 Mover arquivo"):
-                os.rename(
-                    os.path.join(folder_path, file_to_move),
-                    os.path.join(UPLOAD_DIRECTORY, target_folder, file_to_move)
-                )
+                rename_source(f"{selected_folder}/{file_to_move}", f"{target_folder}/{file_to_move}")
                 st.success(f"{file_to_move} movido para {target_folder}!")
                 st.rerun()
 
@@ -358,10 +431,7 @@ elif page == "Pastas":
         if st.checkbox("⚠️ Deseja excluir esta pasta?"):
             delete_contents = st.checkbox("🗑️ Apagar todos os arquivos também?")
             if st.button("❌ Excluir pasta"):
-                if delete_contents:
-                    shutil.rmtree(folder_path)
-                else:
-                    os.rmdir(folder_path)
+                delete_folder(selected_folder, delete_contents)
                 st.success("Pasta excluída com sucesso!")
                 st.rerun()
 
@@ -369,21 +439,10 @@ elif page == "Analytics":
     st.title("📊 Analytics do Sistema")
 
     # Número total de documentos
-    files = get_available_files()
-    st.metric("📁 Total de documentos", len(files))
+    st.metric("📁 Total de documentos", count_manifest_files())
 
     # Tags mais usadas
-    tag_counts = {}
-    conn = sqlite3.connect("chat_history.sqlite3")
-    c = conn.cursor()
-    c.execute("SELECT tags FROM document_tags")
-    rows = c.fetchall()
-    for row in rows:
-        if row[0]:
-            for tag in row[0].split(","):
-                tag = tag.strip()
-                tag_counts[tag] = tag_counts.get(tag, 0) + 1
-    conn.close()
+    tag_counts = get_tag_counts()
 
     if tag_counts:
         st.subheader("🏷️ Tags mais usadas")
@@ -393,43 +452,116 @@ elif page == "Analytics":
         st.info("Nenhuma tag registrada ainda.")
 
     # Uso por modelo
-    c = sqlite3.connect("chat_history.sqlite3").cursor()
-    c.execute("SELECT model, COUNT(*) FROM history GROUP BY model")
-    model_data = c.fetchall()
+    model_data = get_model_usage()
     if model_data:
         st.subheader("🧠 Uso por modelo LLM")
         df_model = pd.DataFrame(model_data, columns=["Modelo", "Interações"])
         st.bar_chart(df_model.set_index("Modelo"))
 
+    # Tokens e custo estimado, registrados a cada pergunta (interações anteriores à medição ficam de fora)
+    colunas_consumo = ["Interações", "Prompt", "Resposta", "Embedding", "Custo (US$)", "Prompt médio"]
+    consumo_modelo = get_token_usage(("model",))
+    if consumo_modelo:
+        st.subheader("🪙 Tokens e custo")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Custo estimado", f"US$ {sum(row[5] or 0 for row in consumo_modelo):.2f}")
+        col2.metric("Tokens de prompt", f"{sum(row[2] or 0 for row in consumo_modelo):,}".replace(",", "."))
+        col3.metric("Tokens de resposta", f"{sum(row[3] or 0 for row in consumo_modelo):,}".replace(",", "."))
+        col4.metric("Tokens de embedding", f"{sum(row[4] or 0 for row in consumo_modelo):,}".replace(",", "."))
+        df_consumo = pd.DataFrame(consumo_modelo, columns=["Modelo"] + colunas_consumo)
+        st.dataframe(df_consumo.round({"Custo (US$)": 4, "Prompt médio": 0}), hide_index=True, use_container_width=True)
+
+        st.markdown("**📅 Custo por dia (últimos 30 dias)**")
+        df_dia = pd.DataFrame(get_token_usage(("day", "model"), since=time.time() - 30 * 86400),
+                              columns=["Dia", "Modelo"] + colunas_consumo)
+        if not df_dia.empty:
+            st.bar_chart(df_dia.pivot_table(index="Dia", columns="Modelo", values="Custo (US$)", aggfunc="sum"))
+
+        # Conjuntos que mais inflam o contexto: maior média de tokens de prompt por pergunta
+        st.markdown("**📚 Consumo por conjunto de documentos**")
+        df_conjunto = pd.DataFrame([
+            (rotular_conjunto(row[0]),) + tuple(row[1:]) for row in get_token_usage(("document_set",))
+        ], columns=["Conjunto"] + colunas_consumo)
+        df_conjunto = df_conjunto.sort_values(by="Prompt médio", ascending=False).head(10)
+        st.dataframe(df_conjunto.round({"Custo (US$)": 4, "Prompt médio": 0}), hide_index=True, use_container_width=True)
+
+    # Deduplicação de chunks na ingestão
+    dedup = get_dedup_stats()
+    if dedup["canonical"]:
+        st.subheader("🧬 Deduplicação de chunks")
+        tamanho_indice = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, _, names in os.walk(PERSIST_DIRECTORY) for name in names
+        )
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Taxa de duplicados", f"{dedup['ratio']:.0%}")
+        col2.metric("Chunks vetorizados", dedup["canonical"])
+        col3.metric("Embeddings evitados", dedup["duplicates"])
+        col4.metric("Índice em disco", f"{tamanho_indice / 1024 / 1024:.1f} MB")
+
+    # Cache de respostas
+    total_respostas, respostas_cache, latencia_economizada = get_answer_cache_usage()
+    if total_respostas:
+        st.subheader("♻️ Cache de respostas")
+        col1, col2 = st.columns(2)
+        col1.metric("Taxa de acerto", f"{respostas_cache / total_respostas:.0%}", f"{respostas_cache} de {total_respostas}")
+        col2.metric("Latência economizada", f"{latencia_economizada / 1000:.1f} s")
+
+    # Latência por etapa, gravada pelos spans de tracing.py
+    st.subheader("⏱️ Desempenho por etapa")
+    periodo = st.selectbox("Período", list(PERFORMANCE_PERIODS), index=1)
+    desde = time.time() - PERFORMANCE_PERIODS[periodo]
+    percentis = tracing.get_stage_percentiles(desde)
+    if not percentis:
+        st.info("Nenhuma medição registrada no período.")
+    else:
+        df_etapas = pd.DataFrame(percentis, columns=["Etapa", "Chamadas", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Máx. (ms)"])
+        st.dataframe(df_etapas.round(1), hide_index=True, use_container_width=True)
+
+        lentas = tracing.get_slowest_requests(desde)
+        if lentas:
+            st.markdown("**🐢 Perguntas mais lentas**")
+            df_lentas = pd.DataFrame([
+                (datetime.datetime.fromtimestamp(inicio_req).strftime("%d/%m %H:%M:%S"), round(duracao), pergunta, etapas)
+                for _, inicio_req, duracao, pergunta, etapas in lentas
+            ], columns=["Quando", "Duração (ms)", "Pergunta", "Etapas mais lentas"])
+            st.dataframe(df_lentas, hide_index=True, use_container_width=True)
+
+        taxas = tracing.get_cache_hit_rates(desde)
+        if taxas:
+            st.markdown("**🎯 Acerto dos caches**")
+            colunas = st.columns(len(taxas))
+            for coluna, (etapa, (acertos, faltas)) in zip(colunas, sorted(taxas.items())):
+                total = acertos + faltas
+                coluna.metric(CACHE_LABELS.get(etapa, etapa), f"{acertos / total:.0%}" if total else "—",
+                              f"{acertos} de {total}")
+
 elif page == "Busca":
     st.title("🔍 Busca textual em documentos")
 
     query = st.text_input("Digite um termo para buscar")
-    if query:
-        files = get_available_files()
-        resultados = []
-
-        for file in files:
-            path = os.path.join("uploaded_files", file)
-            try:
-                docs = load_file(path)
-                if docs:
-                    full_text = "\n".join([doc.page_content for doc in docs])
-                    if query.lower() in full_text.lower():
-                        trechos = [linha.strip() for linha in full_text.split("\n") if query.lower() in linha.lower()]
-                        resultados.append((file, trechos[:3]))  # mostra até 3 trechos
-            except Exception as e:
-                st.warning(f"Erro ao processar {file}: {str(e)}")
-
-        if not resultados:
+    if query.strip():
+        inicio = time.perf_counter()
+        total = count_search_results(query)
+        if not total:
             st.warning("Nenhum resultado encontrado.")
         else:
-            st.success(f"{len(resultados)} documento(s) encontrados.")
-            for file, trechos in resultados:
+            por_pagina = 20
+            total_paginas = max((total - 1) // por_pagina + 1, 1)
+            pagina = st.number_input("Página", 1, total_paginas, 1)
+            rows = search_documents(query, por_pagina, (pagina - 1) * por_pagina)
+            st.success(f"{total} trecho(s) encontrados em {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+
+            # Agrupa os trechos por documento, mantendo a ordem de relevância
+            resultados = {}
+            for file, pagina_doc, trecho in rows:
+                resultados.setdefault(file, []).append((pagina_doc, trecho))
+
+            for file, trechos in resultados.items():
                 file_path = os.path.join("uploaded_files", file)
                 cached_summary = get_cached_summary(file_path)
                 if not cached_summary:
-                    joined_text = "\n".join([t for t in trechos])
+                    joined_text = "\n".join([t for _, t in trechos])
                     resumo = resumir_documento(joined_text)
                     save_summary_cache(file_path, resumo)
                 else:
@@ -439,8 +571,9 @@ elif page == "Busca":
                     st.markdown("🔹 **Resumo do documento:**")
                     st.markdown(f"> {resumo}")
                     st.markdown("🔍 **Trechos encontrados:**")
-                    for trecho in trechos:
-                        st.markdown(f"- {trecho}")
+                    for pagina_doc, trecho in trechos:
+                        prefixo = f"(p. {pagina_doc}) " if pagina_doc else ""
+                        st.markdown(f"- {prefixo}{trecho}")
 
 elif page == "LAI":
     st.title("📄 Cadastro de Perguntas - Lei de Acesso à Informação")
@@ -475,31 +608,26 @@ elif page == "LAI":
 
         submitted = st.form_submit_button("💾 Salvar pergunta")
         if submitted:
-            conn = sqlite3.connect("chat_history.sqlite3")
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO perguntas_lai (
-                    pergunta, data_envio, data_limite_resposta,
-                    origem, destinatario,
-                    orgao_recursal_1, site_orgao_recursal_1, texto_recurso_1,
-                    orgao_recursal_2, site_orgao_recursal_2, texto_recurso_2,
-                    tag, transparencia_ativa, observacao_privada
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                pergunta, str(data_envio), str(data_limite),
-                origem, destinatario,
-                orgao_recursal_1, site_orgao_recursal_1, texto_recurso_1,
-                orgao_recursal_2, site_orgao_recursal_2, texto_recurso_2,
-                tag, int(transparencia_ativa), observacao_privada
-            ))
-            conn.commit()
-            conn.close()
+            novo_id = insert_pergunta_lai(
+                pergunta=pergunta, data_envio=str(data_envio), data_limite_resposta=str(data_limite),
+                origem=origem, destinatario=destinatario,
+                orgao_recursal_1=orgao_recursal_1, site_orgao_recursal_1=site_orgao_recursal_1, texto_recurso_1=texto_recurso_1,
+                orgao_recursal_2=orgao_recursal_2, site_orgao_recursal_2=site_orgao_recursal_2, texto_recurso_2=texto_recurso_2,
+                tag=tag, transparencia_ativa=int(transparencia_ativa), observacao_privada=observacao_privada
+            )
+            indexar_pergunta_lai(novo_id)
             st.success("Pergunta cadastrada com sucesso!")
 
 
 elif page == "Cadastro LAI":
     st.title("📝 Cadastro de nova pergunta (LAI)")
 
+    # Verificação de duplicidade antes do cadastro
+    with st.expander("🔎 Verificar se já existe pergunta semelhante"):
+        texto_verificacao = st.text_area("Texto a verificar", key="texto_verificacao")
+        if texto_verificacao.strip() and st.button("Buscar semelhantes"):
+            exibir_semelhantes(texto_verificacao)
+
     with st.form("form_lai"):
         pergunta = st.text_area("📝 Texto da pergunta", height=100)
         data_envio = st.date_input("📆 Data de envio da pergunta", value=datetime.date.today())
@@ -529,25 +657,14 @@ elif page == "Cadastro LAI":
 
         submitted = st.form_submit_button("💾 Salvar pergunta")
         if submitted:
-            conn = sqlite3.connect("chat_history.sqlite3")
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO perguntas_lai (
-                    pergunta, data_envio, data_limite_resposta,
-                    origem, destinatario,
-                    orgao_recursal_1, site_orgao_recursal_1, texto_recurso_1,
-                    orgao_recursal_2, site_orgao_recursal_2, texto_recurso_2,
-                    tag, transparencia_ativa, observacao_privada
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                pergunta, str(data_envio), str(data_limite),
-                origem, destinatario,
-                orgao_recursal_1, site_orgao_recursal_1, texto_recurso_1,
-                orgao_recursal_2, site_orgao_recursal_2, texto_recurso_2,
-                tag, int(transparencia_ativa), observacao_privada
-            ))
-            conn.commit()
-            conn.close()
+            novo_id = insert_pergunta_lai(
+                pergunta=pergunta, data_envio=str(data_envio), data_limite_resposta=str(data_limite),
+                origem=origem, destinatario=destinatario,
+                orgao_recursal_1=orgao_recursal_1, site_orgao_recursal_1=site_orgao_recursal_1, texto_recurso_1=texto_recurso_1,
+                orgao_recursal_2=orgao_recursal_2, site_orgao_recursal_2=site_orgao_recursal_2, texto_recurso_2=texto_recurso_2,
+                tag=tag, transparencia_ativa=int(transparencia_ativa), observacao_privada=observacao_privada
+            )
+            indexar_pergunta_lai(novo_id)
             st.success("Pergunta cadastrada com sucesso!")
             st.session_state.page = "Perguntas LAI"
             st.rerun()
@@ -555,15 +672,8 @@ elif page == "Cadastro LAI":
 elif page == "Perguntas LAI":
     st.title("📄 Perguntas cadastradas (LAI)")
 
-    conn = sqlite3.connect("chat_history.sqlite3")
-    c = conn.cursor()
-
     # Captura filtros únicos
-    c.execute("SELECT DISTINCT tag FROM perguntas_lai WHERE tag IS NOT NULL")
-    tags = [row[0] for row in c.fetchall() if row[0]]
-
-    c.execute("SELECT DISTINCT destinatario FROM perguntas_lai WHERE destinatario IS NOT NULL")
-    orgaos = [row[0] for row in c.fetchall() if row[0]]
+    tags, orgaos = get_lai_filter_values()
 
     # Filtros
     col1, col2 = st.columns(2)
@@ -577,37 +687,39 @@ elif page == "Perguntas LAI":
         st.session_state.page = "Cadastro LAI"
         st.rerun()
 
-    # Construção da query com filtros
-    query_base = "FROM perguntas_lai WHERE 1=1"
-    params = []
-
-    if filtro_tag != "Todos":
-        query_base += " AND tag = ?"
-        params.append(filtro_tag)
-
-    if filtro_destinatario != "Todos":
-        query_base += " AND destinatario = ?"
-        params.append(filtro_destinatario)
+    tag_filtro = filtro_tag if filtro_tag != "Todos" else None
+    destinatario_filtro = filtro_destinatario if filtro_destinatario != "Todos" else None
 
     por_pagina = 20
-    c.execute(f"SELECT COUNT(*) {query_base}", params)
-    total = c.fetchone()[0]
+    total = count_perguntas_lai(tag_filtro, destinatario_filtro)
     total_paginas = max((total - 1) // por_pagina + 1, 1)
-    pagina = st.number_input("Página", 1, total_paginas, 1)
-    offset = (pagina - 1) * por_pagina
-
-    c.execute(f"""
-        SELECT id, pergunta, data_envio, data_limite_resposta, destinatario, tag, observacao_privada
-        {query_base}
-        ORDER BY data_envio DESC
-        LIMIT ? OFFSET ?
-    """, params + [por_pagina, offset])
-    rows = c.fetchall()
-    conn.close()
+
+    # Paginação por chave: guarda o cursor (data_envio, id) do fim de cada página visitada
+    filtros = (tag_filtro, destinatario_filtro)
+    if st.session_state.get("lai_filtros") != filtros:
+        st.session_state.lai_filtros = filtros
+        st.session_state.lai_cursores = [None]
+    cursores = st.session_state.lai_cursores
+    pagina = len(cursores)
+
+    rows = list_perguntas_lai(tag_filtro, destinatario_filtro, por_pagina, after=cursores[-1])
+
+    col_ant, col_pag, col_prox = st.columns([1, 2, 1])
+    with col_ant:
+        if pagina > 1 and st.button("⬅️ Anterior"):
+            cursores.pop()
+            st.rerun()
+    with col_pag:
+        st.caption(f"Página {pagina} de {total_paginas} ({total} pergunta(s))")
+    with col_prox:
+        if len(rows) == por_pagina and pagina < total_paginas and st.button("Próxima ➡️"):
+            cursores.append((rows[-1][2], rows[-1][0]))
+            st.rerun()
 
     if not rows:
         st.info("Nenhuma pergunta cadastrada.")
     else:
+        relacionadas_por_id, documentos_por_tag = buscar_relacionados_em_lote([(row[0], row[5]) for row in rows])
         for id_, pergunta, data_envio, data_limite, destinatario, tag, obs_privada in rows:
             with st.expander(f"📌 Pergunta #{id_} - {data_envio}"):
                 nova_pergunta = st.text_area("📝 Pergunta", value=pergunta, key=f"edit_pergunta_{id_}")
@@ -616,13 +728,16 @@ elif page == "Perguntas LAI":
 
                 st.markdown(f"**Unidade destinatária:** `{destinatario}`")
                 st.markdown(f"**Prazo para resposta:** `{data_limite}`")
-                relacionadas = buscar_perguntas_relacionadas(tag, id_)
+                if st.toggle("🧭 Buscar perguntas semelhantes", key=f"semelhantes_{id_}"):
+                    exibir_semelhantes(pergunta, before_id=id_)
+
+                relacionadas = relacionadas_por_id.get(id_, [])
                 if relacionadas:
                     st.markdown("🔗 **Perguntas relacionadas:**")
                     for rid, texto in relacionadas:
                         resumo = texto.strip().replace("\n", " ")
                         st.markdown(f"- #{rid}: {resumo[:100]}{'...' if len(resumo) > 100 else ''}")
-                    docs_relacionados = buscar_documentos_por_tag(tag)
+                    docs_relacionados = documentos_por_tag.get(tag, [])
                     st.markdown("📎 **Documentos relacionados:**")
                     for doc in docs_relacionados:
                         st.markdown(f"**📄 {doc}**")
@@ -630,22 +745,13 @@ elif page == "Perguntas LAI":
                         try:
                             with open(path, "r", encoding="utf-8") as f:
                                 conteudo = f.read()
-                                st.text_area("Conteúdo", conteudo[:2000], height=200, key=f"txt_{doc}")
+                                st.text_area("Conteúdo", conteudo[:2000], height=200, key=f"txt_{id_}_{doc}")
                         except:
                             st.caption("❌ Não foi possível exibir o conteúdo.")
 
-
-
                 if st.button("💾 Salvar alterações", key=f"salvar_{id_}"):
-                    conn2 = sqlite3.connect("chat_history.sqlite3")
-                    c2 = conn2.cursor()
-                    c2.execute("""
-                        UPDATE perguntas_lai
-                        SET pergunta = ?, tag = ?, observacao_privada = ?
-                        WHERE id = ?
-                    """, (nova_pergunta, nova_tag, nova_obs, id_))
-                    conn2.commit()
-                    conn2.close()
+                    update_pergunta_lai(id_, nova_pergunta, nova_tag, nova_obs)
+                    indexar_pergunta_lai(id_)
                     st.success("Alterações salvas!")
                     st.rerun()
 
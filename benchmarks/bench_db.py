@@ -0,0 +1,74 @@
+# Micro-benchmark da camada SQLite: conexão por chamada (antes) x pool com WAL (depois).
+# Uso: python benchmarks/bench_db.py [operações]
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROW = ("gpt-4", "Qual o prazo de resposta da LAI?", "São 20 dias, prorrogáveis por mais 10.", "lai.pdf", 120.0, 900.0)
+BEFORE_PATH = "antes.sqlite3"
+INSERT = "INSERT INTO history (model, user_input, assistant_response, sources, ttft_ms, latency_ms) VALUES (?, ?, ?, ?, ?, ?)"
+
+def naive_insert(n):
+    for _ in range(n):
+        conn = sqlite3.connect(BEFORE_PATH)
+        conn.execute(INSERT, ROW)
+        conn.commit()
+        conn.close()
+
+def naive_select(n):
+    for i in range(n):
+        conn = sqlite3.connect(BEFORE_PATH)
+        conn.execute("SELECT id, model, user_input FROM history WHERE id = ?", (i % 100 + 1,)).fetchone()
+        conn.close()
+
+def pooled_insert(n):
+    for _ in range(n):
+        db.save_chat_to_db(*ROW)
+
+def pooled_select(n):
+    for i in range(n):
+        with db.get_connection() as conn:
+            conn.execute("SELECT id, model, user_input FROM history WHERE id = ?", (i % 100 + 1,)).fetchone()
+
+def bulk_insert(n):
+    db.save_chats_to_db([ROW] * n)
+
+def concurrent(fn, n, threads=8):
+    workers = [threading.Thread(target=fn, args=(n // threads,)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+def measure(label, fn, n):
+    start = time.perf_counter()
+    fn(n)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<40} {n / elapsed:>12,.0f} ops/s")
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    os.chdir(tempfile.mkdtemp())
+
+    # "Antes": banco separado em modo rollback journal, uma conexão por operação
+    import db
+    conn = sqlite3.connect(BEFORE_PATH)
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT, user_input TEXT, "
+                 "assistant_response TEXT, sources TEXT, ttft_ms REAL, latency_ms REAL)")
+    conn.close()
+    db.create_history_table()
+
+    measure("antes: insert (conexão por chamada)", naive_insert, n)
+    measure("antes: select (conexão por chamada)", naive_select, n)
+    measure("antes: insert concorrente (8 threads)", lambda k: concurrent(naive_insert, k), n)
+
+    # "Depois": pool de conexões com WAL e statements em cache
+    measure("depois: insert (pool + WAL)", pooled_insert, n)
+    measure("depois: select (pool)", pooled_select, n)
+    measure("depois: insert concorrente (8 threads)", lambda k: concurrent(pooled_insert, k), n)
+    measure("depois: insert em lote (executemany)", bulk_insert, n)
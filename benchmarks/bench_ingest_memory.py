@@ -0,0 +1,85 @@
+# Pico de memória (RSS) da ingestão em função do número de páginas: lista inteira (antes) x lotes em streaming (depois).
+# Gera PDFs sintéticos com texto, usa embeddings locais (sem chamadas à API) e mede cada caso num processo novo,
+# já que o pico de RSS de um processo só cresce.
+# Uso: python benchmarks/bench_ingest_memory.py [páginas ...]
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+LINES_PER_PAGE = 45
+WORDS = "prazo pedido informação órgão público resposta recurso sigilo decreto portaria contrato edital".split()
+
+def write_pdf(path, pages):
+    # PDF mínimo com uma fonte padrão e uma página de texto por objeto de conteúdo
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for p in range(pages):
+        lines = [f"Pagina {p} linha {i}: " + " ".join(WORDS[(p + i + j) % len(WORDS)] for j in range(12))
+                 for i in range(LINES_PER_PAGE)]
+        text = " T* ".join(f"({line})Tj" for line in lines)
+        stream = f"BT /F1 9 Tf 11 TL 40 800 Td {text} ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                       b"/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), pages)
+
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+def peak_rss_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def child(mode, pages):
+    os.chdir(tempfile.mkdtemp())
+    import loader
+    from embeddings import LocalHashEmbeddings
+    from ingestion import INGEST_BATCH_CHUNKS
+
+    path = os.path.join(loader.UPLOAD_DIRECTORY, "diario.pdf")
+    write_pdf(path, pages)
+    embedder = LocalHashEmbeddings()
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    chunks = 0
+    if mode == "lista":
+        # Como antes: todas as páginas, depois todos os chunks, depois todos os vetores
+        docs = loader.split_pages(loader.load_file(path), "diario.pdf")
+        vectors = embedder.embed_documents([doc.page_content for doc in docs])
+        chunks = len(vectors)
+    else:
+        for _, batch in loader.split_batches(path, "diario.pdf", INGEST_BATCH_CHUNKS):
+            vectors = embedder.embed_documents([doc.page_content for doc in batch])
+            chunks += len(vectors)
+    print(f"{peak_rss_mb():.1f} {peak_rss_mb() - baseline:.1f} {chunks} {time.perf_counter() - start:.1f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], int(sys.argv[3]))
+        sys.exit()
+
+    page_counts = [int(arg) for arg in sys.argv[1:]] or [100, 500, 1000, 2000]
+    print(f"{'páginas':>8} {'modo':>10} {'pico RSS':>10} {'acréscimo':>10} {'chunks':>8} {'tempo':>7}")
+    for pages in page_counts:
+        for mode in ("lista", "streaming"):
+            out = subprocess.run([sys.executable, __file__, "--child", mode, str(pages)],
+                                 capture_output=True, text=True, cwd=ROOT, check=True).stdout.split()
+            peak, delta, chunks, elapsed = out[-4:]
+            print(f"{pages:>8} {mode:>10} {peak:>7} MB {delta:>7} MB {chunks:>8} {elapsed:>6}s")
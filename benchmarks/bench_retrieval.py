@@ -0,0 +1,96 @@
+# Benchmark offline de relevância e latência: vetorial x BM25 x híbrido (RRF), com e sem filtro de pasta.
+# Usa embeddings locais (sem chamadas à API) e um acervo sintético em diretório temporário.
+# Uso: python benchmarks/bench_retrieval.py [documentos] [consultas]
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOPICS = ["licitação", "orçamento", "pessoal", "saúde", "educação", "obras", "transporte", "ouvidoria"]
+COMMON = "o a de da do que em para com por sobre conforme prazo pedido informação órgão público".split()
+FOLDERS = 4
+K = 4
+
+def build_corpus(n_docs, rng):
+    topic_words = {t: [f"{t[:4]}{i}" for i in range(40)] for t in TOPICS}
+    docs = []
+    for i in range(n_docs):
+        topic = TOPICS[i % len(TOPICS)]
+        code = f"proc{i:06d}"
+        words = rng.choices(COMMON, k=60) + rng.choices(topic_words[topic], k=25) + [topic, code, code]
+        rng.shuffle(words)
+        docs.append((f"pasta{i % FOLDERS}/doc{i:05d}.txt", code, topic, " ".join(words)))
+    return docs
+
+def measure(label, retrieve, queries):
+    hits, reciprocal, latencies = 0, 0.0, []
+    for query, expected in queries:
+        start = time.perf_counter()
+        sources = [doc.metadata["source"] for doc in retrieve(query)]
+        latencies.append((time.perf_counter() - start) * 1000)
+        if expected in sources:
+            hits += 1
+            reciprocal += 1 / (sources.index(expected) + 1)
+    latencies.sort()
+    print(f"{label:<32} recall@{K} {hits / len(queries):>6.1%}  MRR {reciprocal / len(queries):.3f}  "
+          f"p50 {statistics.median(latencies):>6.1f} ms  p95 {latencies[int(len(latencies) * 0.95) - 1]:>6.1f} ms")
+
+if __name__ == "__main__":
+    n_docs = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = random.Random(42)
+    os.chdir(tempfile.mkdtemp())
+
+    import db
+    import embeddings
+    embeddings._embeddings = embeddings.CachedEmbeddings(embeddings.LocalHashEmbeddings())
+    import loader
+    from chat import HybridRetriever
+    from langchain_core.documents import Document
+
+    db.create_search_tables()
+    db.create_dedup_tables()
+    corpus = build_corpus(n_docs, rng)
+    store = loader.get_index()
+    start = time.perf_counter()
+    for i in range(0, len(corpus), 500):
+        part = corpus[i:i + 500]
+        store.add_documents([Document(page_content=text, metadata={"source": source}) for source, _, _, text in part],
+                            ids=[f"{source}#0" for source, _, _, _ in part])
+        for source, _, _, text in part:
+            db.index_chunks(source, [(f"{source}#0", None, 0, text)])
+    print(f"Acervo: {n_docs} documentos indexados em {time.perf_counter() - start:.1f}s")
+
+    queries = []
+    for source, code, topic, _ in rng.sample(corpus, n_queries):
+        queries.append((f"qual o prazo do pedido {code} sobre {topic}", source))
+
+    all_sources = [source for source, _, _, _ in corpus]
+    folder_of = lambda source: source.split("/")[0]
+
+    def dense(sources):
+        return lambda q: store.similarity_search(q, k=K, filter=loader.source_filter(sources))
+
+    def lexical(sources):
+        return lambda q: [Document(page_content=text, metadata={"source": source})
+                          for _, source, _, _, text, _ in db.search_chunks(q, sources, K)]
+
+    def hybrid(sources):
+        return HybridRetriever(vector_store=store, sources=sources, k=K).invoke
+
+    for label, make in (("vetorial", dense), ("bm25", lexical), ("híbrido (rrf)", hybrid)):
+        measure(f"{label}: acervo todo", make(all_sources), queries)
+
+    # Com filtro de pasta: cada consulta só enxerga os arquivos da pasta do documento esperado
+    expected_for = dict(queries)
+    by_folder = {}
+    for source in all_sources:
+        by_folder.setdefault(folder_of(source), []).append(source)
+    for label, make in (("vetorial", dense), ("bm25", lexical), ("híbrido (rrf)", hybrid)):
+        retrievers = {folder: make(sources) for folder, sources in by_folder.items()}
+        measure(f"{label}: filtro de pasta",
+                lambda q, _r=retrievers: _r[folder_of(expected_for[q])](q), queries)
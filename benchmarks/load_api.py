@@ -0,0 +1,175 @@
+# Teste de carga da api.py no estilo do locust: N usuários virtuais repetem tarefas com pesos (pergunta com e
+# sem streaming, busca, tags, listagem LAI, upload) por um tempo fixo e o relatório traz vazão e p50/p95/p99
+# por endpoint. Sem --url, sobe a API num diretório temporário com LLM e embeddings falsos (LLM_BACKEND=fake,
+# EMBEDDING_BACKEND=local): mede a API, a fila e o SQLite, sem custo nem limite de taxa da OpenAI.
+# Perguntas repetidas de um conjunto pequeno exercitam o cache de respostas e a junção de perguntas em andamento.
+# Uso: python benchmarks/load_api.py [--users 20] [--duration 30] [--docs 20] [--url http://localhost:8000]
+# Token da API (cabeçalho X-API-Token): --token ou API_TOKEN do ambiente; a API local sobe com o mesmo token
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUESTIONS = [
+    "Qual é o prazo para responder um pedido de acesso à informação?",
+    "Quando cabe recurso contra a negativa de acesso?",
+    "Quais informações podem ser classificadas como sigilosas?",
+    "Como funciona a transparência ativa dos órgãos públicos?",
+]
+TERMS = ["prazo", "recurso", "sigilo", "decreto", "contrato", "edital"]
+WORDS = "prazo pedido informação órgão público resposta recurso sigilo decreto portaria contrato edital".split()
+
+# (nome, peso); o nome também é a linha do relatório
+TASKS = [("query", 4), ("query-stream", 2), ("search", 3), ("tags", 1), ("lai", 1), ("ingest", 1)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def document(i, paragraphs=30):
+    rng = random.Random(i)
+    return "\n\n".join(
+        f"Documento {i}, seção {p}. " + " ".join(rng.choice(WORDS) for _ in range(80)) for p in range(paragraphs)
+    ).encode("utf-8")
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))] if ordered else 0.0
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.failures = {}
+        self.coalesced = 0
+        self.cached = 0
+
+    def add(self, name, elapsed_ms, ok):
+        self.latencies.setdefault(name, []).append(elapsed_ms)
+        if not ok:
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    def report(self, duration):
+        print(f"{'endpoint':<14} {'req':>6} {'falhas':>7} {'req/s':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for name, values in sorted(self.latencies.items()):
+            print(f"{name:<14} {len(values):>6} {self.failures.get(name, 0):>7} {len(values) / duration:>7.1f} "
+                  f"{percentile(values, 50):>6.0f}ms {percentile(values, 95):>6.0f}ms {percentile(values, 99):>6.0f}ms")
+        total = sum(len(values) for values in self.latencies.values())
+        print(f"total: {total} requisições em {duration:.0f}s ({total / duration:.1f} req/s); "
+              f"{self.coalesced} pergunta(s) juntada(s) a outra em andamento, {self.cached} do cache de respostas")
+
+async def run_task(client, name, stats, uploads):
+    start = time.perf_counter()
+    ok = True
+    try:
+        if name in ("query", "query-stream"):
+            # Metade ignora o cache: perguntas iguais simultâneas só se juntam se o LLM for de fato chamado
+            body = {"question": random.choice(QUESTIONS), "ignore_cache": random.random() < 0.5,
+                    "stream": name == "query-stream"}
+            if name == "query":
+                response = await client.post("/query", json=body)
+                ok = response.status_code == 200
+                result = response.json() if ok else {}
+            else:
+                result = {}
+                async with client.stream("POST", "/query", json=body) as response:
+                    ok = response.status_code == 200
+                    async for line in response.aiter_lines():
+                        if line:
+                            result = json.loads(line)
+                ok = ok and "error" not in result
+            stats.coalesced += bool(result.get("coalesced"))
+            stats.cached += bool(result.get("cached"))
+        elif name == "search":
+            ok = (await client.get("/search", params={"q": random.choice(TERMS)})).status_code == 200
+        elif name == "tags":
+            ok = (await client.get("/tags")).status_code == 200
+        elif name == "lai":
+            ok = (await client.get("/lai", params={"limit": 20})).status_code == 200
+        elif name == "ingest":
+            uploads[0] += 1
+            files = {"files": (f"carga-{uploads[0]}.txt", document(10_000 + uploads[0]), "text/plain")}
+            ok = (await client.post("/ingest", files=files, data={"folder": "carga"})).status_code == 200
+    except httpx.HTTPError:
+        ok = False
+    stats.add(name, (time.perf_counter() - start) * 1000, ok)
+
+async def user(client, deadline, stats, uploads):
+    names = [name for name, _ in TASKS]
+    weights = [weight for _, weight in TASKS]
+    while time.monotonic() < deadline:
+        await run_task(client, random.choices(names, weights)[0], stats, uploads)
+
+async def setup(client, docs, timeout=300):
+    # Acervo inicial e algumas perguntas LAI; espera a fila indexar antes de medir
+    files = [("files", (f"doc-{i}.txt", document(i), "text/plain")) for i in range(docs)]
+    (await client.post("/ingest", files=files, data={"folder": "base"})).raise_for_status()
+    for i in range(10):
+        await client.post("/lai", json={"pergunta": QUESTIONS[i % len(QUESTIONS)], "data_envio": "2024-09-02",
+                                        "tag": TERMS[i % len(TERMS)]})
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        listed = (await client.get("/files", params={"folder": "base"})).json()
+        if listed and all(f["status"] != "pending" for f in listed):
+            return
+        await asyncio.sleep(1)
+    raise TimeoutError("Indexação do acervo inicial não terminou a tempo")
+
+def start_server(port, token):
+    workdir = tempfile.mkdtemp(prefix="rag-api-")
+    env = {**os.environ, "PYTHONPATH": ROOT, "LLM_BACKEND": "fake", "EMBEDDING_BACKEND": "local", "API_TOKEN": token,
+           "API_START_WORKERS": "True"}
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=env
+    )
+    for _ in range(120):
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", headers={"X-API-Token": token}).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("A API não respondeu em /health")
+
+async def main(args):
+    server = None
+    url = args.url
+    headers = {"X-API-Token": args.token} if args.token else {}
+    if not url:
+        port = free_port()
+        server = start_server(port, args.token)
+        url = f"http://127.0.0.1:{port}"
+    try:
+        limits = httpx.Limits(max_connections=args.users * 2)
+        async with httpx.AsyncClient(base_url=url, timeout=120, limits=limits, headers=headers) as client:
+            if not args.url:
+                await setup(client, args.docs)
+            stats, uploads = Stats(), [0]
+            start = time.perf_counter()
+            deadline = time.monotonic() + args.duration
+            await asyncio.gather(*(user(client, deadline, stats, uploads) for _ in range(args.users)))
+            stats.report(time.perf_counter() - start)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--url", help="API já em execução (sem backends falsos nem acervo inicial)")
+    parser.add_argument("--token", default=os.environ.get("API_TOKEN", ""), help="Valor do cabeçalho X-API-Token")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,100 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+try:
+    import fcntl
+except ImportError:  # Windows: sem reflink, usa hard link ou cópia
+    fcntl = None
+
+# Armazenamento por conteúdo: cada upload vira um blob "blobs/ab/abcdef..." (SHA-256) e o caminho em
+# uploaded_files é um clone copy-on-write (reflink) ou, sem suporte, um hard link para ele. Conteúdo repetido
+# em outra pasta ocupa o disco uma vez só, e quem lê o arquivo pelo caminho (loaders, OCR, pré-visualização)
+# não precisa saber do blob. Com hard link, editar o arquivo no lugar altera também o blob: o nome do blob
+# é confiável (só o tamanho é conferido no upload, sem reler o conteúdo) e a varredura do manifesto descarta
+# o blob de um caminho ligado a ele que mudou (ver loader.rescan_manifest).
+BLOB_DIRECTORY = "blobs"
+BLOCK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # ioctl de clone do Linux (btrfs, XFS, bcachefs...)
+os.makedirs(os.path.join(BLOB_DIRECTORY, "tmp"), exist_ok=True)
+
+def blob_path(content_hash):
+    return os.path.join(BLOB_DIRECTORY, content_hash[:2], content_hash)
+
+def _blob_intact(content_hash, size):
+    # Um hash só (o do upload): tamanho diferente denuncia uma edição no lugar sem reler o blob
+    try:
+        return os.path.getsize(blob_path(content_hash)) == size
+    except FileNotFoundError:
+        return False
+
+def write_blob(fileobj, block_size=BLOCK_SIZE):
+    # Grava em blocos calculando o hash durante a escrita; retorna (hash, já existia)
+    digest = hashlib.sha256()
+    size = 0
+    if hasattr(fileobj, "seek"):
+        fileobj.seek(0)
+    with tempfile.NamedTemporaryFile(dir=os.path.join(BLOB_DIRECTORY, "tmp"), delete=False) as tmp:
+        try:
+            for block in iter(lambda: fileobj.read(block_size), b""):
+                digest.update(block)
+                tmp.write(block)
+                size += len(block)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+    content_hash = digest.hexdigest()
+    target = blob_path(content_hash)
+    if os.path.exists(target):
+        if _blob_intact(content_hash, size):
+            os.remove(tmp.name)
+            return content_hash, True
+        # Blob alterado por uma edição no lugar de um caminho ligado a ele: o conteúdo novo assume o nome,
+        # e o inode alterado fica só com quem o editou. Não conta como existente (nada é reaproveitado)
+        logging.warning(f"Blob {content_hash[:12]} com tamanho diferente; substituído pelo conteúdo enviado")
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(tmp.name, target)
+    return content_hash, False
+
+def _reflink(src, dst):
+    # Clone copy-on-write: compartilha os blocos em disco, mas gravar num dos arquivos não altera o outro
+    if fcntl is None:
+        return False
+    try:
+        with open(src, "rb") as source, open(dst, "wb") as dest:
+            fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except FileNotFoundError:
+            pass
+        return False
+
+def link_blob(content_hash, dest_path):
+    # Reflink quando o sistema de arquivos permite; senão hard link; sem nenhum dos dois (outro volume), cópia
+    # Nome temporário oculto: a varredura do manifesto ignora arquivos iniciados por "."
+    folder, name = os.path.split(dest_path)
+    tmp_path = os.path.join(folder, f".{name}.{content_hash[:8]}.tmp")
+    if not _reflink(blob_path(content_hash), tmp_path):
+        try:
+            os.link(blob_path(content_hash), tmp_path)
+        except OSError:
+            shutil.copyfile(blob_path(content_hash), tmp_path)
+    os.replace(tmp_path, dest_path)
+
+def same_content(content_hash, path):
+    try:
+        return os.path.samefile(blob_path(content_hash), path)
+    except OSError:
+        return False
+
+def release_blob(content_hash):
+    # Chamado quando nenhum caminho do manifesto aponta mais para o blob
+    try:
+        os.remove(blob_path(content_hash))
+        logging.info(f"Blob {content_hash[:12]} removido (sem referências)")
+    except FileNotFoundError:
+        pass
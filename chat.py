@@ -1,27 +1,184 @@
+import re
+import sys
+import queue
+import logging
+import threading
+import time
+import contextvars
+from collections import OrderedDict
+from contextvars import ContextVar
+from typing import Any
+from decouple import config
 from langchain.chains import RetrievalQAWithSourcesChain
 from langchain.schema import SystemMessage, HumanMessage
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.language_models.chat_models import generate_from_stream
+from langchain_core.retrievers import BaseRetriever
 from langchain_openai import ChatOpenAI
-from loader import get_vectorstore
+from db import get_index_version, search_chunks, get_shared_chunks
+from context_packing import pack_context, context_budget
+from loader import get_index, get_ready_files, source_filter
+from tracing import span, traced, record, profile_thread
+from metering import Usage, current_usage
+from embeddings import count_tokens
 import streamlit as st
 
+# LRU limitado em quantidade e em memória. O LLM e o índice são compartilhados, então o que cresce por entrada é o
+# conjunto de arquivos (chave e filtro do retriever), medido com sys.getsizeof
+CHAIN_CACHE_MAX_ENTRIES = config("CHAIN_CACHE_MAX_ENTRIES", default=32, cast=int)
+CHAIN_CACHE_MAX_MB = config("CHAIN_CACHE_MAX_MB", default=16, cast=float)
+RETRIEVAL_K = config("RETRIEVAL_K", default=4, cast=int)
+RETRIEVAL_FETCH_K = config("RETRIEVAL_FETCH_K", default=20, cast=int)
+RRF_K = config("RRF_K", default=60, cast=int)
+# "fake": resposta fixa em streaming, sem chamar a API (testes de carga da api.py)
+LLM_BACKEND = config("LLM_BACKEND", default="openai")
+FAKE_LLM_TOKEN_DELAY = config("FAKE_LLM_TOKEN_DELAY", default=0.005, cast=float)
+FAKE_LLM_ANSWER = "FINAL ANSWER: Resposta simulada, gerada sem chamar o modelo.\nSOURCES: "
+# Com orçamento de tokens, mais candidatos entram na fusão e o empacotamento decide o que cabe
+PACKING_CANDIDATES = config("PACKING_CANDIDATES", default=8, cast=int)
+
+# Registro por processo: todas as sessões do Streamlit compartilham chains e clientes HTTP
+_chains = OrderedDict()
+_chain_sizes = {}
+_chains_version = None
+_llms = {}
+_registry_lock = threading.Lock()
+
+# Relatório do empacotamento da pergunta em andamento (cada StreamedResponse roda na sua thread)
+_packing_report = ContextVar("packing_report", default=None)
+
+class FakeStreamingChat(FakeListChatModel):
+    # Emite a resposta caractere a caractere, com atraso, pelos mesmos callbacks do ChatOpenAI em streaming
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        chunks = []
+        for chunk in self._stream(messages, stop=stop, **kwargs):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            chunks.append(chunk)
+        return generate_from_stream(iter(chunks))
+
+def get_llm(selected_model):
+    with _registry_lock:
+        llm = _llms.get(selected_model)
+        if llm is None and LLM_BACKEND == "fake":
+            llm = _llms[selected_model] = FakeStreamingChat(responses=[FAKE_LLM_ANSWER], sleep=FAKE_LLM_TOKEN_DELAY)
+        if llm is None:
+            # llm = ChatOpenAI(temperature=0.7, model_name=selected_model)
+            llm = ChatOpenAI(
+                temperature=0.8,
+                model_name=selected_model,
+                max_tokens=1500,
+                streaming=True,
+                stream_usage=True  # A API informa os tokens consumidos também no modo streaming
+            )
+            _llms[selected_model] = llm
+        return llm
+
+def _entry_bytes(key, sources):
+    # Chave (frozenset), lista do retriever e filtro {"source": {"$in": [...]}} montado a cada consulta;
+    # os nomes são os mesmos objetos nos três e contam uma vez
+    names = sum(sys.getsizeof(name) for name in key[0])
+    return names + sys.getsizeof(key[0]) + 2 * sys.getsizeof(sources) + 2 * sys.getsizeof({})
+
+class HybridRetriever(BaseRetriever):
+    # Combina BM25 (FTS5 sobre os chunks) e busca vetorial com reciprocal rank fusion;
+    # os dois índices recebem o mesmo filtro de arquivos
+    vector_store: Any
+    sources: list
+    k: int = RETRIEVAL_K
+    fetch_k: int = RETRIEVAL_FETCH_K
+    rrf_k: int = RRF_K
+    token_budget: int = 0
+
+    def _get_relevant_documents(self, query, *, run_manager=None):
+        with span("retrieval", f"{len(self.sources)} arquivo(s)"):
+            return self._retrieve(query)
+
+    def _retrieve(self, query):
+        # Chunks deduplicados guardados sob outro arquivo, mas presentes nos arquivos filtrados
+        shared = get_shared_chunks(self.sources)
+        where = source_filter(self.sources)
+        if shared:
+            where = {"$or": [where, {"chunk_id": {"$in": list(shared)}}]}
+        with span("retrieval.dense"):
+            dense = self.vector_store.similarity_search(query, k=self.fetch_k, filter=where)
+        lexical = []
+        with span("retrieval.lexical"):
+            rows = search_chunks(query, self.sources, self.fetch_k)
+        for chunk_id, source, page, start_index, content, _ in rows:
+            metadata = {"source": source, "page": page, "start_index": start_index, "chunk_id": chunk_id}
+            lexical.append(Document(page_content=content, metadata={k: v for k, v in metadata.items() if v is not None}))
+
+        scores, docs = {}, {}
+        for ranking in (dense, lexical):
+            for rank, doc in enumerate(ranking):
+                if doc.metadata.get("chunk_id") in shared and doc.metadata.get("source") not in self.sources:
+                    doc.metadata["source"] = shared[doc.metadata["chunk_id"]]
+                key = (doc.metadata.get("source"), doc.page_content)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+                docs.setdefault(key, doc)
+        limit = max(self.k, PACKING_CANDIDATES) if self.token_budget else self.k
+        best = [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:limit]]
+        if not self.token_budget:
+            return best
+
+        with span("context_packing"):
+            packed, tokens_before, tokens_after = pack_context(best, self.token_budget)
+        report = _packing_report.get()
+        if report is not None:
+            report.update(chunks=len(best), spans=len(packed), tokens_before=tokens_before, tokens_after=tokens_after)
+        logging.info(f"Contexto: {len(best)} chunk(s) → {len(packed)} trecho(s), {tokens_before} → {tokens_after} tokens")
+        return packed
+
+@traced("initialize_chain")
 def initialize_chain(selected_files, selected_model):
-    vector_store = get_vectorstore(selected_files)
-    if not vector_store:
+    global _chains_version
+    # Só arquivos já indexados pela fila em segundo plano: nenhuma pergunta espera a ingestão
+    selected_files = get_ready_files(selected_files)
+    if not selected_files:
         st.error("❌ Nenhum conteúdo válido vetorizado.")
         return None
-    # llm = ChatOpenAI(temperature=0.7, model_name=selected_model)
-    llm = ChatOpenAI(
-        temperature=0.8,
-        model_name=selected_model,
-        max_tokens=1500
-    )
-    return RetrievalQAWithSourcesChain.from_chain_type(
-        llm=llm,
-        retriever=vector_store.as_retriever(),
+    vector_store = get_index()
+
+    version = get_index_version()
+    key = (frozenset(selected_files), selected_model, version)
+    with _registry_lock:
+        # Acervo alterado (upload, exclusão ou reindexação): descarta todas as chains antigas
+        if version != _chains_version:
+            _chains.clear()
+            _chain_sizes.clear()
+            _chains_version = version
+        chain = _chains.get(key)
+        if chain is not None:
+            _chains.move_to_end(key)
+            return chain
+
+    chain = RetrievalQAWithSourcesChain.from_chain_type(
+        llm=get_llm(selected_model),
+        retriever=HybridRetriever(
+            vector_store=vector_store,
+            sources=sorted(selected_files),
+            token_budget=context_budget(selected_model)
+        ),
         return_source_documents=False
     )
 
-def get_response(chain, prompt, ignore_history=False):
+    with _registry_lock:
+        if version == _chains_version:
+            _chains[key] = chain
+            _chains.move_to_end(key)
+            _chain_sizes[key] = _entry_bytes(key, chain.retriever.sources)
+            max_bytes = CHAIN_CACHE_MAX_MB * 1024 * 1024
+            total = sum(_chain_sizes.values())
+            # Despeja as menos usadas até caber; a recém-criada fica mesmo se sozinha passar do limite
+            while len(_chains) > 1 and (len(_chains) > CHAIN_CACHE_MAX_ENTRIES or total > max_bytes):
+                evicted, _ = _chains.popitem(last=False)
+                total -= _chain_sizes.pop(evicted)
+    return chain
+
+def _build_inputs(prompt, ignore_history):
     if ignore_history:
         messages = []
     else:
@@ -30,8 +187,162 @@ def get_response(chain, prompt, ignore_history=False):
             "com exemplos e clareza. Evite respostas curtas. Estruture a resposta como se estivesse ensinando o assunto."
         ))
         messages = [system_prompt, HumanMessage(content=prompt)]
+    return {"question": prompt, "chat_history": messages}
+
+def get_response(chain, prompt, ignore_history=False):
+    callbacks = [_LlmTimer(), _UsageHandler(current_usage() or Usage())]
+    with span("chain"):
+        return chain.invoke(_build_inputs(prompt, ignore_history), config={"callbacks": callbacks})
+
+SOURCES_MARKER = re.compile(r"SOURCES?:", re.IGNORECASE)
+ANSWER_PREFIX = "FINAL ANSWER:"
+_DONE = object()
+
+class _TokenQueueHandler(BaseCallbackHandler):
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.tokens.put(token)
+
+class _LlmTimer(BaseCallbackHandler):
+    # Um span "llm" por chamada ao modelo, do envio do prompt ao último token
+    def __init__(self):
+        self.started = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        model = (kwargs.get("invocation_params") or {}).get("model_name")
+        self.started[run_id] = (time.perf_counter(), model)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._finish(run_id, False)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._finish(run_id, True)
+
+    def _finish(self, run_id, error):
+        start, model = self.started.pop(run_id, (None, None))
+        if start is not None:
+            record("llm", (time.perf_counter() - start) * 1000, model, error=error)
+
+def _reported_usage(response):
+    # (prompt, resposta) informados pela API: llm_output sem streaming, usage_metadata da mensagem com streaming
+    token_usage = (response.llm_output or {}).get("token_usage") or {}
+    if token_usage.get("prompt_tokens") is not None:
+        return token_usage["prompt_tokens"], token_usage.get("completion_tokens") or 0
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                return metadata["input_tokens"], metadata["output_tokens"]
+    return None
+
+class _UsageHandler(BaseCallbackHandler):
+    # Soma os tokens de cada chamada ao LLM; sem contagem da API, usa o tokenizador local
+    def __init__(self, usage):
+        self.usage = usage
+        self.prompts = {}
+        self.completions = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        # ~4 tokens de formatação por mensagem no formato de chat da OpenAI
+        self.prompts[run_id] = sum(count_tokens(str(m.content)) + 4 for batch in messages for m in batch)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self.prompts[run_id] = sum(count_tokens(prompt) for prompt in prompts)
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        self.completions.setdefault(run_id, []).append(token)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        prompt_tokens = self.prompts.pop(run_id, 0)
+        text = "".join(self.completions.pop(run_id, []))
+        reported = _reported_usage(response)
+        if reported:
+            prompt_tokens, completion_tokens = reported
+            self.usage.reported = True
+        else:
+            text = text or "".join(g.text for generations in response.generations for g in generations)
+            completion_tokens = count_tokens(text) if text else 0
+        self.usage.prompt_tokens += prompt_tokens
+        self.usage.completion_tokens += completion_tokens
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.prompts.pop(run_id, None)
+        self.completions.pop(run_id, None)
+
+class StreamedResponse:
+    # Itera os tokens da resposta conforme chegam; answer, sources, latências e usage ficam disponíveis ao final
+    def __init__(self, chain, prompt, ignore_history=False):
+        self.chain = chain
+        self.inputs = _build_inputs(prompt, ignore_history)
+        self.answer = ""
+        self.sources = ""
+        self.ttft_ms = None
+        self.latency_ms = None
+        self.packing = {}
+        self.usage = current_usage() or Usage()
+
+    def _run(self, tokens):
+        _packing_report.set(self.packing)
+        try:
+            with profile_thread(), span("chain"):
+                callbacks = [_TokenQueueHandler(tokens), _LlmTimer(), _UsageHandler(self.usage)]
+                tokens.put(("result", self.chain.invoke(self.inputs, config={"callbacks": callbacks})))
+        except Exception as e:
+            tokens.put(("error", e))
+        tokens.put(_DONE)
+
+    @staticmethod
+    def _visible(raw, done):
+        # Oculta o prefixo "FINAL ANSWER:" e o trecho "SOURCES:", que a chain devolve separadamente
+        text = raw.lstrip()
+        if text[:len(ANSWER_PREFIX)].upper() == ANSWER_PREFIX:
+            text = text[len(ANSWER_PREFIX):].lstrip()
+        elif not done and ANSWER_PREFIX.startswith(text.upper()):
+            return ""
+        match = SOURCES_MARKER.search(text)
+        if match:
+            return text[:match.start()].rstrip()
+        return text if done else text[:max(0, len(text) - len("SOURCES:"))]
+
+    def __iter__(self):
+        start = time.perf_counter()
+        tokens = queue.Queue()
+        # A thread herda o contexto da pergunta: os spans dela entram na mesma requisição
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run, tokens), daemon=True).start()
+
+        raw, emitted, result = "", 0, None
+        while True:
+            item = tokens.get()
+            if item is _DONE:
+                break
+            if isinstance(item, tuple):
+                kind, value = item
+                if kind == "error":
+                    raise value
+                result = value
+                continue
+            if self.ttft_ms is None:
+                self.ttft_ms = (time.perf_counter() - start) * 1000
+            raw += item
+            visible = self._visible(raw, done=False)
+            if len(visible) > emitted:
+                yield visible[emitted:]
+                emitted = len(visible)
+
+        # A chain separa as fontes, mas devolve a resposta ainda com o prefixo "FINAL ANSWER:"
+        self.answer = self._visible(result.get("answer", ""), done=True).strip() if result else self._visible(raw, done=True)
+        self.sources = result.get("sources", "") if result else ""
+        # Completa o que ficou retido aguardando o marcador de fontes (ou tudo, se o LLM não fez streaming)
+        visible = self._visible(raw, done=True) if raw else self.answer
+        if len(visible) > emitted:
+            yield visible[emitted:]
+        self.latency_ms = (time.perf_counter() - start) * 1000
 
-    return chain.invoke({"question": prompt, "chat_history": messages})
+def stream_response(chain, prompt, ignore_history=False):
+    return StreamedResponse(chain, prompt, ignore_history)
 
 
 def render_sources(source_string):
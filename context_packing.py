@@ -0,0 +1,104 @@
+import re
+from decouple import config
+from langchain_core.documents import Document
+from embeddings import count_tokens
+
+# Orçamento de tokens do contexto enviado ao LLM, por modelo da barra lateral ("modelo=tokens,...")
+DEFAULT_CONTEXT_BUDGETS = "gpt-3.5-turbo=2500,gpt-4=3000,gpt-4-turbo=12000,gpt-4o=12000"
+CONTEXT_TOKEN_BUDGETS = {
+    model.strip(): int(tokens)
+    for model, tokens in (item.split("=") for item in config("CONTEXT_TOKEN_BUDGETS", default=DEFAULT_CONTEXT_BUDGETS).split(","))
+}
+DEFAULT_CONTEXT_BUDGET = config("DEFAULT_CONTEXT_BUDGET", default=3000, cast=int)
+# Trecho com esta fração de shingles já presentes no contexto é considerado repetido
+NEAR_DUPLICATE_THRESHOLD = config("NEAR_DUPLICATE_THRESHOLD", default=0.8, cast=float)
+MIN_OVERLAP_CHARS = 20
+SHINGLE_SIZE = 5
+
+def context_budget(model):
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_BUDGET)
+
+def _text_overlap(a, b, max_overlap=1000):
+    # Maior sufixo de `a` que é prefixo de `b` (sobreposição do splitter entre chunks vizinhos)
+    for size in range(min(len(a), len(b), max_overlap), MIN_OVERLAP_CHARS - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+class _Span:
+    def __init__(self, doc, rank):
+        self.source = doc.metadata.get("source")
+        self.page = doc.metadata.get("page")
+        self.start = doc.metadata.get("start_index")
+        self.text = doc.page_content
+        self.metadata = dict(doc.metadata)
+        self.rank = rank
+
+    @property
+    def end(self):
+        return self.start + len(self.text) if self.start is not None else None
+
+    def absorb(self, other):
+        # Junta `other` logo após este trecho; retorna False se não forem contíguos
+        if self.start is not None and other.start is not None:
+            if other.start > self.end or other.start < self.start:
+                return False
+            if other.end > self.end:
+                self.text += other.text[self.end - other.start:]
+        else:
+            overlap = _text_overlap(self.text, other.text)
+            if overlap:
+                self.text += other.text[overlap:]
+            elif other.text not in self.text:
+                return False
+        self.rank = min(self.rank, other.rank)
+        return True
+
+def _merge_spans(docs):
+    groups = {}
+    for rank, doc in enumerate(docs):
+        span = _Span(doc, rank)
+        groups.setdefault((span.source, span.page), []).append(span)
+
+    merged = []
+    for spans in groups.values():
+        spans.sort(key=lambda s: (s.start is None, s.start or 0))
+        result = []
+        for span in spans:
+            for i, current in enumerate(result):
+                if current.absorb(span):
+                    break
+                # Sem start_index a ordem é desconhecida: o novo trecho pode vir antes do atual
+                if span.start is None and span.absorb(current):
+                    result[i] = span
+                    break
+            else:
+                result.append(span)
+        merged.extend(result)
+    return sorted(merged, key=lambda s: s.rank)
+
+def pack_context(docs, budget):
+    # Retorna (documentos empacotados, tokens antes, tokens depois)
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs)
+    packed, seen, used = [], set(), 0
+    for span in _merge_spans(docs):
+        shingles = _shingles(span.text)
+        if shingles and len(shingles & seen) / len(shingles) >= NEAR_DUPLICATE_THRESHOLD:
+            continue
+        tokens = count_tokens(span.text)
+        if used + tokens > budget:
+            if packed:
+                continue
+            # Nem o trecho mais relevante cabe: corta proporcionalmente ao orçamento
+            span.text = span.text[:int(len(span.text) * budget / tokens)]
+            tokens = count_tokens(span.text)
+        seen |= shingles
+        used += tokens
+        packed.append(Document(page_content=span.text, metadata=span.metadata))
+    return packed, tokens_before, used
@@ -1,135 +1,1173 @@
+import os
+import sys
+import json
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from tracing import span
 
 DB_PATH = "chat_history.sqlite3"
+POOL_SIZE = 8
+# Fora de uma requisição (interface, fila de jobs) só entram nas métricas as chamadas mais lentas que isto
+SQLITE_SLOW_MS = 20
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",  # com WAL, dispensa fsync a cada commit sem arriscar corrupção
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+class ConnectionPool:
+    # Conexões de longa duração: o cache de statements do sqlite3 mantém as consultas já preparadas
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._connect()
+        return self._idle.get()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=DB_PATH):
+    with _pools_lock:
+        pool = _pools.get(path)
+        # Processos filhos (fork) não reutilizam conexões herdadas do processo pai
+        if pool is None or pool.pid != os.getpid():
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+def _caller_name():
+    # Função que abriu a conexão, pulando os wrappers de contextmanager e transaction()
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_name in ("__enter__", "get_connection", "transaction"):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else None
+
+@contextmanager
+def get_connection(path=DB_PATH):
+    # Cada uso de conexão vira um span "sqlite" (espera pelo pool, consultas e commit)
+    with span("sqlite", _caller_name(), min_ms=SQLITE_SLOW_MS):
+        pool = get_pool(path)
+        conn = pool.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+
+@contextmanager
+def transaction(path=DB_PATH):
+    # Commit ao final do bloco; rollback se houver exceção
+    with get_connection(path) as conn:
+        with conn:
+            yield conn
+
+def _add_column_if_missing(cursor, table, column, definition):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+LEGACY_SESSION_ID = "legado"
 
 def create_history_table():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            model TEXT,
-            user_input TEXT,
-            assistant_response TEXT,
-            sources TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
-
-def save_chat_to_db(model, user_input, assistant_response, sources=None):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("INSERT INTO history (model, user_input, assistant_response, sources) VALUES (?, ?, ?, ?)",
-              (model, user_input, assistant_response, sources))
-    conn.commit()
-    conn.close()
-
-def load_chat_history():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT id, model, user_input, assistant_response, sources FROM history ORDER BY id ASC")
-    rows = c.fetchall()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                model TEXT,
+                user_input TEXT,
+                assistant_response TEXT,
+                sources TEXT
+            )
+        """)
+        _add_column_if_missing(c, "history", "ttft_ms", "REAL")
+        _add_column_if_missing(c, "history", "latency_ms", "REAL")
+        _add_column_if_missing(c, "history", "session_id", "TEXT")
+        _add_column_if_missing(c, "history", "cache_hit", "INTEGER DEFAULT 0")
+        _add_column_if_missing(c, "history", "latency_saved_ms", "REAL")
+        # Consumo por interação; linhas anteriores à medição ficam com NULL e fora dos totais
+        _add_column_if_missing(c, "history", "created_at", "REAL")
+        _add_column_if_missing(c, "history", "prompt_tokens", "INTEGER")
+        _add_column_if_missing(c, "history", "completion_tokens", "INTEGER")
+        _add_column_if_missing(c, "history", "embedding_tokens", "INTEGER")
+        _add_column_if_missing(c, "history", "cost_usd", "REAL")
+        _add_column_if_missing(c, "history", "document_set", "TEXT")
+        # Conversas anteriores aos IDs de sessão ficam agrupadas numa sessão própria
+        c.execute("UPDATE history SET session_id = ? WHERE session_id IS NULL", (LEGACY_SESSION_ID,))
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_session ON history (session_id, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_history_created ON history (created_at)")
+
+def save_chat_to_db(model, user_input, assistant_response, sources=None, ttft_ms=None, latency_ms=None,
+                    session_id=LEGACY_SESSION_ID, cache_hit=False, latency_saved_ms=None, usage=None,
+                    document_set=None):
+    # usage: metering.Usage da pergunta; document_set: arquivos consultados (o escopo, não só as fontes citadas)
+    tokens = (usage.prompt_tokens, usage.completion_tokens, usage.embedding_tokens, usage.cost(model)) if usage else (None,) * 4
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO history (model, user_input, assistant_response, sources, ttft_ms, latency_ms, session_id,
+                                 cache_hit, latency_saved_ms, created_at, prompt_tokens, completion_tokens,
+                                 embedding_tokens, cost_usd, document_set)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (model, user_input, assistant_response, sources, ttft_ms, latency_ms, session_id,
+              int(cache_hit), latency_saved_ms, time.time()) + tokens +
+             (json.dumps(sorted(document_set), ensure_ascii=False) if document_set else None,))
+
+def save_chats_to_db(rows, session_id=LEGACY_SESSION_ID):
+    # rows: (model, user_input, assistant_response, sources, ttft_ms, latency_ms)
+    with transaction() as conn:
+        conn.executemany("INSERT INTO history (model, user_input, assistant_response, sources, ttft_ms, latency_ms, session_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         [tuple(row) + (session_id,) for row in rows])
+
+def get_model_usage():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT model, COUNT(*) FROM history GROUP BY model")
+        rows = c.fetchall()
     return rows
 
+# Agrupamentos aceitos por get_token_usage
+USAGE_GROUPS = {
+    "model": "model",
+    "day": "date(created_at, 'unixepoch', 'localtime')",
+    "document_set": "document_set",
+}
+
+def get_token_usage(group_by=("model",), since=None):
+    # (chaves..., interações, tokens de prompt, de resposta, de embedding, custo US$, média de tokens de prompt)
+    keys = ", ".join(USAGE_GROUPS[group] for group in group_by)
+    where, params = "prompt_tokens IS NOT NULL", []
+    if since is not None:
+        where += " AND created_at >= ?"
+        params.append(since)
+    with get_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT {keys}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(embedding_tokens),
+                   SUM(cost_usd), AVG(prompt_tokens)
+            FROM history WHERE {where}
+            GROUP BY {keys} ORDER BY {keys}
+        """, params).fetchall()
+    if "document_set" not in group_by:
+        return rows
+    position = list(group_by).index("document_set")
+    return [row[:position] + (json.loads(row[position]) if row[position] else [],) + row[position + 1:] for row in rows]
+
+def get_answer_cache_usage():
+    # (total de respostas, respostas vindas do cache, latência economizada em ms)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(cache_hit), 0), COALESCE(SUM(latency_saved_ms), 0) FROM history")
+        return c.fetchone()
+
+def load_chat_history(session_id=None, limit=None, before_id=None, since_id=None):
+    # Janela do histórico por keyset em id: as `limit` mensagens mais recentes antes de `before_id`,
+    # ou todas a partir de `since_id`; sempre em ordem cronológica
+    where, params = [], []
+    if session_id is not None:
+        where.append("session_id = ?")
+        params.append(session_id)
+    if before_id is not None:
+        where.append("id < ?")
+        params.append(before_id)
+    if since_id is not None:
+        where.append("id >= ?")
+        params.append(since_id)
+    query = "SELECT id, model, user_input, assistant_response, sources FROM history"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY id DESC"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(query, params)
+        rows = c.fetchall()
+    return rows[::-1]
+
+def has_older_chats(session_id, before_id):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT EXISTS (SELECT 1 FROM history WHERE session_id = ? AND id < ?)", (session_id, before_id))
+        return bool(c.fetchone()[0])
+
+def get_session_titles(session_ids):
+    # {session_id: primeira pergunta} só das conversas informadas, cada uma lida pelo índice (session_id, id);
+    # conversas ainda sem mensagens ficam de fora
+    session_ids = list(session_ids)
+    if not session_ids:
+        return {}
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT j.value, (SELECT user_input FROM history WHERE session_id = j.value ORDER BY id LIMIT 1)
+            FROM json_each(?) j
+        """, (json.dumps(session_ids),))
+        rows = c.fetchall()
+    return {session_id: title for session_id, title in rows if title is not None}
+
 def delete_all_history():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("DELETE FROM history")
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM history")
 
 def create_tag_table():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS document_tags (
-            file_name TEXT PRIMARY KEY,
-            tags TEXT
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS tags (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL UNIQUE
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS document_tag (
+                file_name TEXT NOT NULL,
+                tag_id INTEGER NOT NULL REFERENCES tags(id),
+                PRIMARY KEY (file_name, tag_id)
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_document_tag_tag ON document_tag (tag_id, file_name)")
+
+        # Migra o formato antigo (tags separadas por vírgula em document_tags)
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'document_tags'")
+        if c.fetchone():
+            c.execute("SELECT file_name, tags FROM document_tags")
+            for file_name, tags_str in c.fetchall():
+                _link_tags(c, file_name, (tags_str or "").split(","))
+            c.execute("DROP TABLE document_tags")
+
+def _link_tags(cursor, file_name, tags):
+    names = sorted({tag.strip() for tag in tags if tag and tag.strip()})
+    cursor.executemany("INSERT OR IGNORE INTO tags (name) VALUES (?)", [(name,) for name in names])
+    cursor.executemany("""
+        INSERT OR IGNORE INTO document_tag (file_name, tag_id)
+        SELECT ?, id FROM tags WHERE name = ?
+    """, [(file_name, name) for name in names])
 
 def save_tags_for_file(file_name, tags):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    tags_str = ",".join(tags)
-    c.execute("REPLACE INTO document_tags (file_name, tags) VALUES (?, ?)", (file_name, tags_str))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM document_tag WHERE file_name = ?", (file_name,))
+        _link_tags(c, file_name, tags)
 
 def get_tags_for_file(file_name):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT tags FROM document_tags WHERE file_name = ?", (file_name,))
-    row = c.fetchone()
-    conn.close()
-    return row[0].split(",") if row and row[0] else []
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT t.name FROM document_tag dt
+            JOIN tags t ON t.id = dt.tag_id
+            WHERE dt.file_name = ?
+            ORDER BY t.name
+        """, (file_name,))
+        rows = c.fetchall()
+    return [r[0] for r in rows]
 
 def get_all_tags():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT tags FROM document_tags")
-    rows = c.fetchall()
-    conn.close()
-    tag_set = set()
-    for row in rows:
-        if row[0]:
-            tag_set.update(tag.strip() for tag in row[0].split(","))
-    return sorted(tag_set)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT name FROM tags t
+            WHERE EXISTS (SELECT 1 FROM document_tag dt WHERE dt.tag_id = t.id)
+            ORDER BY name
+        """)
+        rows = c.fetchall()
+    return [r[0] for r in rows]
+
+def get_tag_counts():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT t.name, COUNT(*) FROM document_tag dt
+            JOIN tags t ON t.id = dt.tag_id
+            GROUP BY dt.tag_id
+        """)
+        rows = c.fetchall()
+    return dict(rows)
+
+def get_files_by_tag():
+    # Uma única consulta para todas as tags, em vez de uma por tag
+    files_by_tag = {}
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT t.name, dt.file_name FROM document_tag dt
+            JOIN tags t ON t.id = dt.tag_id
+            ORDER BY t.name, dt.file_name
+        """)
+        for tag, file_name in c.fetchall():
+            files_by_tag.setdefault(tag, []).append(file_name)
+    return files_by_tag
+
+def buscar_documentos_por_tag(tag):
+    if not tag:
+        return []
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT dt.file_name FROM tags t
+            JOIN document_tag dt ON dt.tag_id = t.id
+            WHERE t.name = ?
+            ORDER BY dt.file_name
+        """, (tag.strip(),))
+        rows = c.fetchall()
+    return [r[0] for r in rows]
 
 def create_notes_table():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS document_notes (
-            file_name TEXT PRIMARY KEY,
-            note TEXT,
-            favorite INTEGER
-        )
-    """)
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS document_notes (
+                file_name TEXT PRIMARY KEY,
+                note TEXT,
+                favorite INTEGER
+            )
+        """)
 
 def save_document_note(file_name, note, favorite):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("REPLACE INTO document_notes (file_name, note, favorite) VALUES (?, ?, ?)",
-              (file_name, note, int(favorite)))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("REPLACE INTO document_notes (file_name, note, favorite) VALUES (?, ?, ?)",
+                  (file_name, note, int(favorite)))
 
 def get_document_note(file_name):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT note, favorite FROM document_notes WHERE file_name = ?", (file_name,))
-    row = c.fetchone()
-    conn.close()
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT note, favorite FROM document_notes WHERE file_name = ?", (file_name,))
+        row = c.fetchone()
     return row if row else ("", 0)
 
 def create_lai_table():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS perguntas_lai (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pergunta TEXT,
-            data_envio TEXT,
-            data_limite_resposta TEXT,
-            origem TEXT,
-            destinatario TEXT,
-            orgao_recursal_1 TEXT,
-            site_orgao_recursal_1 TEXT,
-            texto_recurso_1 TEXT,
-            orgao_recursal_2 TEXT,
-            site_orgao_recursal_2 TEXT,
-            texto_recurso_2 TEXT,
-            tag TEXT,
-            transparencia_ativa INTEGER,
-            observacao_privada TEXT
-        )
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS perguntas_lai (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pergunta TEXT,
+                data_envio TEXT,
+                data_limite_resposta TEXT,
+                origem TEXT,
+                destinatario TEXT,
+                orgao_recursal_1 TEXT,
+                site_orgao_recursal_1 TEXT,
+                texto_recurso_1 TEXT,
+                orgao_recursal_2 TEXT,
+                site_orgao_recursal_2 TEXT,
+                texto_recurso_2 TEXT,
+                tag TEXT,
+                transparencia_ativa INTEGER,
+                observacao_privada TEXT
+            )
+        """)
+        # Índices compostos na ordem da listagem (data_envio DESC, id DESC) para paginação por chave
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lai_data ON perguntas_lai (data_envio DESC, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lai_tag_data ON perguntas_lai (tag, data_envio DESC, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lai_dest_data ON perguntas_lai (destinatario, data_envio DESC, id DESC)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_lai_tag_dest_data ON perguntas_lai (tag, destinatario, data_envio DESC, id DESC)")
+
+LAI_COLUMNS = (
+    "pergunta", "data_envio", "data_limite_resposta",
+    "origem", "destinatario",
+    "orgao_recursal_1", "site_orgao_recursal_1", "texto_recurso_1",
+    "orgao_recursal_2", "site_orgao_recursal_2", "texto_recurso_2",
+    "tag", "transparencia_ativa", "observacao_privada",
+)
+
+# Valores de filtro e totais da listagem LAI, válidos enquanto app_meta.lai_version não mudar: inserções e edições
+# de qualquer processo (app, API, workers) incrementam a versão na mesma transação
+_lai_cache = {}
+_lai_cache_version = None
+_lai_cache_lock = threading.Lock()
+
+def _bump_lai_version(conn):
+    conn.execute("""
+        INSERT INTO app_meta (key, value) VALUES ('lai_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
     """)
-    conn.commit()
-    conn.close()
+
+def _cached_lai(key, load):
+    global _lai_cache_version
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = 'lai_version'").fetchone()
+    version = row[0] if row else 0
+    with _lai_cache_lock:
+        if version != _lai_cache_version:
+            _lai_cache.clear()
+            _lai_cache_version = version
+        elif key in _lai_cache:
+            return _lai_cache[key]
+    value = load()
+    with _lai_cache_lock:
+        if version == _lai_cache_version:
+            _lai_cache[key] = value
+    return value
+
+def insert_perguntas_lai(rows):
+    # rows: tuplas na ordem de LAI_COLUMNS
+    with transaction() as conn:
+        conn.executemany(
+            f"INSERT INTO perguntas_lai ({', '.join(LAI_COLUMNS)}) VALUES ({', '.join('?' * len(LAI_COLUMNS))})",
+            rows
+        )
+        _bump_lai_version(conn)
+
+def insert_pergunta_lai(**values):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"INSERT INTO perguntas_lai ({', '.join(LAI_COLUMNS)}) VALUES ({', '.join('?' * len(LAI_COLUMNS))})",
+            tuple(values.get(column) for column in LAI_COLUMNS)
+        )
+        id_ = c.lastrowid
+        _bump_lai_version(conn)
+    return id_
+
+def get_max_pergunta_lai_id():
+    with get_connection() as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM perguntas_lai").fetchone()[0]
+
+def get_textos_perguntas_lai(after_id=0, limit=500, ids=None):
+    # (id, pergunta, texto_recurso_1, texto_recurso_2, data_envio), em ordem de id
+    with get_connection() as conn:
+        c = conn.cursor()
+        if ids is not None:
+            ids = list(ids)
+            if not ids:
+                return []
+            c.execute(f"""
+                SELECT id, pergunta, texto_recurso_1, texto_recurso_2, data_envio FROM perguntas_lai
+                WHERE id IN ({",".join("?" * len(ids))}) ORDER BY id
+            """, ids)
+        else:
+            c.execute("""
+                SELECT id, pergunta, texto_recurso_1, texto_recurso_2, data_envio FROM perguntas_lai
+                WHERE id > ? ORDER BY id LIMIT ?
+            """, (after_id, limit))
+        rows = c.fetchall()
+    return rows
+
+def update_pergunta_lai(id_, pergunta, tag, observacao_privada):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE perguntas_lai
+            SET pergunta = ?, tag = ?, observacao_privada = ?
+            WHERE id = ?
+        """, (pergunta, tag, observacao_privada, id_))
+        _bump_lai_version(c)
+
+def _load_lai_filter_values():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT tag FROM perguntas_lai WHERE tag IS NOT NULL ORDER BY tag")
+        tags = [row[0] for row in c.fetchall() if row[0]]
+        c.execute("SELECT DISTINCT destinatario FROM perguntas_lai WHERE destinatario IS NOT NULL ORDER BY destinatario")
+        orgaos = [row[0] for row in c.fetchall() if row[0]]
+    return tags, orgaos
+
+def get_lai_filter_values():
+    return _cached_lai("filters", _load_lai_filter_values)
+
+def _lai_filters(tag, destinatario):
+    query_base = "FROM perguntas_lai WHERE 1=1"
+    params = []
+    if tag:
+        query_base += " AND tag = ?"
+        params.append(tag)
+    if destinatario:
+        query_base += " AND destinatario = ?"
+        params.append(destinatario)
+    return query_base, params
+
+def count_perguntas_lai(tag=None, destinatario=None):
+    query_base, params = _lai_filters(tag, destinatario)
+
+    def load():
+        with get_connection() as conn:
+            c = conn.cursor()
+            c.execute(f"SELECT COUNT(*) {query_base}", params)
+            return c.fetchone()[0]
+
+    return _cached_lai(("count", tag, destinatario), load)
+
+def list_perguntas_lai(tag=None, destinatario=None, limit=20, after=None):
+    # after: (data_envio, id) da última linha da página anterior (paginação por chave, sem OFFSET)
+    query_base, params = _lai_filters(tag, destinatario)
+    if after:
+        query_base += " AND (data_envio, id) < (?, ?)"
+        params += list(after)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT id, pergunta, data_envio, data_limite_resposta, destinatario, tag, observacao_privada
+            {query_base}
+            ORDER BY data_envio DESC, id DESC
+            LIMIT ?
+        """, params + [limit])
+        rows = c.fetchall()
+    return rows
+
+def buscar_perguntas_relacionadas(tag, id_atual):
+    return buscar_relacionados_em_lote([(id_atual, tag)])[0].get(id_atual, [])
+
+def buscar_relacionados_em_lote(perguntas, limite=5):
+    # perguntas: [(id, tag)]. Retorna ({id: [(id, pergunta)]}, {tag: [arquivos]}) com duas consultas no total
+    tags = sorted({tag for _, tag in perguntas if tag})
+    if not tags:
+        return {}, {}
+    placeholders = ",".join("?" * len(tags))
+    # Folga para descartar a própria pergunta quando várias da página compartilham a tag
+    folga = max(sum(1 for _, tag in perguntas if tag == t) for t in tags)
+    with get_connection() as conn:
+        c = conn.cursor()
+        # Um ramo por tag, cada um lendo só o topo do índice (tag, data_envio, id)
+        ramo = "SELECT * FROM (SELECT id, pergunta, tag FROM perguntas_lai WHERE tag = ? ORDER BY data_envio DESC, id DESC LIMIT ?)"
+        c.execute(" UNION ALL ".join([ramo] * len(tags)), [value for tag in tags for value in (tag, limite + folga)])
+        por_tag = {}
+        for id_, pergunta, tag in c.fetchall():
+            por_tag.setdefault(tag, []).append((id_, pergunta))
+
+        c.execute(f"""
+            SELECT t.name, dt.file_name FROM tags t
+            JOIN document_tag dt ON dt.tag_id = t.id
+            WHERE t.name IN ({placeholders})
+            ORDER BY dt.file_name
+        """, tags)
+        documentos = {}
+        for tag, file_name in c.fetchall():
+            documentos.setdefault(tag, []).append(file_name)
+
+    relacionadas = {
+        id_atual: [item for item in por_tag.get(tag, []) if item[0] != id_atual][:limite]
+        for id_atual, tag in perguntas
+    }
+    return relacionadas, documentos
+
+def create_index_table():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                source TEXT PRIMARY KEY,
+                content_hash TEXT,
+                size INTEGER,
+                mtime REAL,
+                chunk_count INTEGER
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_indexed_files_hash ON indexed_files (content_hash)")
+        # Versão dos loaders na indexação: arquivos indexados por outra versão (NULL nos antigos) são reindexados
+        _add_column_if_missing(c, "indexed_files", "loader_version", "TEXT")
+
+def get_indexed_files():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT source, content_hash, size, mtime, chunk_count, loader_version FROM indexed_files")
+        rows = c.fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def save_indexed_file(source, content_hash, size, mtime, chunk_count, loader_version=None):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            REPLACE INTO indexed_files (source, content_hash, size, mtime, chunk_count, loader_version)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (source, content_hash, size, mtime, chunk_count, loader_version))
+
+def delete_indexed_file(source):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM indexed_files WHERE source = ?", (source,))
+
+def get_indexed_file(source):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT content_hash, size, mtime, chunk_count FROM indexed_files WHERE source = ?", (source,))
+        row = c.fetchone()
+    return row
+
+def find_indexed_twin(content_hash, source, loader_version):
+    # Outro arquivo já indexado com o mesmo conteúdo e pelos loaders atuais: seus chunks servem para este
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT source, chunk_count FROM indexed_files
+            WHERE content_hash = ? AND source != ? AND chunk_count > 0 AND loader_version = ?
+            LIMIT 1
+        """, (content_hash, source, loader_version))
+        row = c.fetchone()
+    return row
+
+def get_ready_sources(sources):
+    # Arquivos indexados com conteúdo e inalterados desde a indexação, segundo o manifesto
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT f.path FROM files f
+            JOIN indexed_files i ON i.source = f.path
+            WHERE f.path IN (SELECT value FROM json_each(?))
+              AND i.chunk_count > 0 AND i.size = f.size AND i.mtime = f.mtime
+        """, (json.dumps(list(sources)),))
+        rows = c.fetchall()
+    return {row[0] for row in rows}
+
+def create_meta_table():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS app_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        """)
+
+def get_index_version():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT value FROM app_meta WHERE key = 'index_version'")
+        row = c.fetchone()
+    return row[0] if row else 0
+
+def get_meta_value(key, default=0):
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta_value(key, value):
+    with transaction() as conn:
+        conn.execute("REPLACE INTO app_meta (key, value) VALUES (?, ?)", (key, value))
+
+def bump_index_version():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO app_meta (key, value) VALUES ('index_version', 1)
+            ON CONFLICT(key) DO UPDATE SET value = value + 1
+        """)
+
+def create_search_tables():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                source UNINDEXED,
+                page UNINDEXED,
+                content,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS search_files (
+                source TEXT PRIMARY KEY,
+                content_hash TEXT,
+                size INTEGER,
+                mtime REAL
+            )
+        """)
+
+        # Índice léxico dos chunks vetorizados (BM25 da busca híbrida); o FTS usa o conteúdo de "chunks"
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY,
+                chunk_id TEXT UNIQUE,
+                source TEXT,
+                page INTEGER,
+                start_index INTEGER,
+                content TEXT
+            )
+        """)
+        _add_column_if_missing(c, "chunks", "start_index", "INTEGER")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chunks_source ON chunks (source)")
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                content,
+                content = 'chunks',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunks_fts (rowid, content) VALUES (new.id, new.content);
+            END
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END
+        """)
+
+def get_search_files():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT source, content_hash, size, mtime FROM search_files")
+        rows = c.fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def update_search_file(source, content_hash, size, mtime):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("REPLACE INTO search_files (source, content_hash, size, mtime) VALUES (?, ?, ?, ?)",
+                  (source, content_hash, size, mtime))
+
+def index_document_pages(source, content_hash, size, mtime, pages, batch_size=64):
+    # pages pode ser um gerador: grava em lotes curtos, sem segurar a escrita do banco enquanto o arquivo é lido.
+    # O registro em search_files vem por último, então uma indexação interrompida é refeita do zero
+    with transaction() as conn:
+        conn.execute("DELETE FROM search_files WHERE source = ?", (source,))
+        conn.execute("DELETE FROM documents_fts WHERE source = ?", (source,))
+    batch = []
+    for page, content in pages:
+        batch.append((source, page, content))
+        if len(batch) >= batch_size:
+            with transaction() as conn:
+                conn.executemany("INSERT INTO documents_fts (source, page, content) VALUES (?, ?, ?)", batch)
+            batch = []
+    with transaction() as conn:
+        c = conn.cursor()
+        c.executemany("INSERT INTO documents_fts (source, page, content) VALUES (?, ?, ?)", batch)
+        c.execute("REPLACE INTO search_files (source, content_hash, size, mtime) VALUES (?, ?, ?, ?)",
+                  (source, content_hash, size, mtime))
+
+def delete_document_pages(source):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM documents_fts WHERE source = ?", (source,))
+        c.execute("DELETE FROM search_files WHERE source = ?", (source,))
+
+def delete_document_pages_by_prefix(prefix):
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM documents_fts WHERE substr(source, 1, ?) = ?", (len(prefix), prefix))
+        c.execute("DELETE FROM search_files WHERE substr(source, 1, ?) = ?", (len(prefix), prefix))
+
+def _rename_column(cursor, table, column, old_source, new_source, conflict=""):
+    # Também serve para pastas: "antiga/" → "nova/" renomeia todos os arquivos sob o prefixo
+    if old_source.endswith("/"):
+        cursor.execute(f"UPDATE {conflict} {table} SET {column} = ? || substr({column}, ?) WHERE substr({column}, 1, ?) = ?",
+                       (new_source, len(old_source) + 1, len(old_source), old_source))
+    else:
+        cursor.execute(f"UPDATE {conflict} {table} SET {column} = ? WHERE {column} = ?", (new_source, old_source))
+
+def rename_document_source(old_source, new_source):
+    with transaction() as conn:
+        c = conn.cursor()
+        for table in ("documents_fts", "search_files"):
+            _rename_column(c, table, "source", old_source, new_source)
+
+def rename_indexed_source(old_source, new_source):
+    # Mover ou renomear só troca o nome nos registros: chunks, deduplicação, tags e anotações acompanham o arquivo
+    with transaction() as conn:
+        c = conn.cursor()
+        for table in ("indexed_files", "chunks", "chunk_signatures", "chunk_refs"):
+            _rename_column(c, table, "source", old_source, new_source, "OR REPLACE")
+        for table in ("document_tag", "document_notes"):
+            _rename_column(c, table, "file_name", old_source, new_source, "OR REPLACE")
+
+def copy_document_pages(source, twin, size, mtime):
+    # Arquivo duplicado: reaproveita as páginas já extraídas para a busca textual; False se o gêmeo não tem páginas
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            REPLACE INTO search_files (source, content_hash, size, mtime)
+            SELECT ?, content_hash, ?, ? FROM search_files WHERE source = ?
+        """, (source, size, mtime, twin))
+        if not c.rowcount:
+            return False
+        c.execute("DELETE FROM documents_fts WHERE source = ?", (source,))
+        c.execute("INSERT INTO documents_fts (source, page, content) SELECT ?, page, content FROM documents_fts WHERE source = ?",
+                  (source, twin))
+    return True
+
+def _fts_query(query):
+    # Cada termo vira uma frase entre aspas: evita erros de sintaxe do FTS5 com a entrada do usuário
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+def count_search_results(query):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM documents_fts WHERE documents_fts MATCH ?", (_fts_query(query),))
+        total = c.fetchone()[0]
+    return total
+
+def search_documents(query, limit=20, offset=0):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT source, page, snippet(documents_fts, 2, '**', '**', '…', 24)
+            FROM documents_fts
+            WHERE documents_fts MATCH ?
+            ORDER BY bm25(documents_fts)
+            LIMIT ? OFFSET ?
+        """, (_fts_query(query), limit, offset))
+        rows = c.fetchall()
+    return rows
+
+def index_chunks(source, chunks, replace=True):
+    # chunks: (chunk_id, page, start_index, content); replace=False acrescenta um lote aos já gravados
+    with transaction() as conn:
+        c = conn.cursor()
+        if replace:
+            c.execute("DELETE FROM chunks WHERE source = ?", (source,))
+        c.executemany("INSERT INTO chunks (chunk_id, source, page, start_index, content) VALUES (?, ?, ?, ?, ?)",
+                      [(chunk_id, source, page, start, content) for chunk_id, page, start, content in chunks])
+
+def delete_chunks(source):
+    with transaction() as conn:
+        conn.execute("DELETE FROM chunks WHERE source = ?", (source,))
+
+def get_chunk_sources():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT source FROM chunks UNION SELECT DISTINCT source FROM chunk_refs")
+        rows = c.fetchall()
+    return {row[0] for row in rows}
+
+def search_chunks(query, sources=None, limit=20):
+    # Termos combinados com OR: perguntas em linguagem natural raramente contêm todos os termos do trecho
+    terms = _fts_query(query).replace('" "', '" OR "')
+    if not terms:
+        return []
+    sql = """
+        SELECT ch.chunk_id, ch.source, ch.page, ch.start_index, ch.content, bm25(chunks_fts) AS score
+        FROM chunks_fts
+        JOIN chunks ch ON ch.id = chunks_fts.rowid
+        WHERE chunks_fts MATCH ?
+    """
+    params = [terms]
+    if sources is not None:
+        # Filtro de pasta/tag/arquivo aplicado dentro da consulta, antes do ranking e do LIMIT;
+        # inclui chunks canônicos de outros arquivos que os arquivos filtrados contêm (deduplicação)
+        sql += """ AND (ch.source IN (SELECT value FROM json_each(?))
+                   OR ch.chunk_id IN (SELECT chunk_id FROM chunk_refs WHERE source IN (SELECT value FROM json_each(?))))"""
+        params += [json.dumps(list(sources))] * 2
+    sql += " ORDER BY score LIMIT ?"
+    params.append(limit)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql, params)
+        rows = c.fetchall()
+    return rows
+
+def create_dedup_tables():
+    with transaction() as conn:
+        c = conn.cursor()
+        # Assinatura MinHash de cada chunk canônico (o que foi vetorizado) e seus buckets de LSH
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_signatures (
+                chunk_id TEXT PRIMARY KEY,
+                source TEXT NOT NULL,
+                signature BLOB NOT NULL
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chunk_signatures_source ON chunk_signatures (source)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_lsh (
+                band INTEGER,
+                bucket INTEGER,
+                chunk_id TEXT,
+                PRIMARY KEY (band, bucket, chunk_id)
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chunk_lsh_chunk ON chunk_lsh (chunk_id)")
+        # Referências: posição de cada chunk duplicado → chunk canônico que o representa
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS chunk_refs (
+                source TEXT,
+                position INTEGER,
+                chunk_id TEXT NOT NULL,
+                PRIMARY KEY (source, position)
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_chunk_refs_chunk ON chunk_refs (chunk_id, source)")
+
+def get_lsh_buckets(keys):
+    # keys: {(band, bucket)} → [((band, bucket), chunk_id, signature)]
+    keys = list(keys)
+    rows = []
+    with get_connection() as conn:
+        c = conn.cursor()
+        for i in range(0, len(keys), 400):
+            part = keys[i:i + 400]
+            c.execute(f"""
+                SELECT l.band, l.bucket, s.chunk_id, s.signature
+                FROM chunk_lsh l
+                JOIN chunk_signatures s ON s.chunk_id = l.chunk_id
+                WHERE (l.band, l.bucket) IN (VALUES {",".join(["(?, ?)"] * len(part))})
+            """, [value for key in part for value in key])
+            rows.extend(((band, bucket), chunk_id, signature) for band, bucket, chunk_id, signature in c.fetchall())
+    return rows
+
+def save_dedup_entries(entries, refs):
+    # entries: (chunk_id, source, signature, [(band, bucket)]); refs: (chunk_id canônico, source, position)
+    with transaction() as conn:
+        c = conn.cursor()
+        c.executemany("REPLACE INTO chunk_signatures (chunk_id, source, signature) VALUES (?, ?, ?)",
+                      [(chunk_id, source, signature) for chunk_id, source, signature, _ in entries])
+        c.executemany("INSERT OR IGNORE INTO chunk_lsh (band, bucket, chunk_id) VALUES (?, ?, ?)",
+                      [(band, bucket, chunk_id) for chunk_id, _, _, buckets in entries for band, bucket in buckets])
+        c.executemany("REPLACE INTO chunk_refs (chunk_id, source, position) VALUES (?, ?, ?)", refs)
+
+def release_dedup_source(source):
+    # Remove o arquivo da deduplicação. Chunks canônicos dele ainda referenciados por outros arquivos
+    # passam a pertencer a um desses arquivos; retorna {chunk_id: novo source} para atualizar os índices
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM chunk_refs WHERE source = ?", (source,))
+        c.execute("""
+            SELECT r.chunk_id, MIN(r.source) FROM chunk_refs r
+            JOIN chunks ch ON ch.chunk_id = r.chunk_id
+            WHERE ch.source = ?
+            GROUP BY r.chunk_id
+        """, (source,))
+        promoted = dict(c.fetchall())
+        for chunk_id, new_source in promoted.items():
+            c.execute("UPDATE chunk_signatures SET source = ? WHERE chunk_id = ?", (new_source, chunk_id))
+            c.execute("DELETE FROM chunk_refs WHERE chunk_id = ? AND source = ?", (chunk_id, new_source))
+            c.execute("UPDATE chunks SET source = ? WHERE chunk_id = ?", (new_source, chunk_id))
+        c.execute("DELETE FROM chunk_lsh WHERE chunk_id IN (SELECT chunk_id FROM chunk_signatures WHERE source = ?)",
+                  (source,))
+        c.execute("DELETE FROM chunk_signatures WHERE source = ?", (source,))
+    return promoted
+
+def link_duplicate_source(source, twin):
+    # Arquivo idêntico a outro já indexado: todos os chunks viram referências aos do gêmeo, sem novos vetores
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM chunk_refs WHERE source = ?", (source,))
+        c.execute("""
+            INSERT INTO chunk_refs (source, position, chunk_id)
+            SELECT ?, ROW_NUMBER() OVER (ORDER BY chunk_id) - 1, chunk_id FROM (
+                SELECT chunk_id FROM chunks WHERE source = ?
+                UNION SELECT chunk_id FROM chunk_refs WHERE source = ?
+            )
+        """, (source, twin, twin))
+        return c.rowcount
+
+def get_shared_chunks(sources):
+    # Chunks canônicos de outros arquivos referenciados pelos arquivos informados: {chunk_id: source que o referencia}
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT r.chunk_id, MIN(r.source) FROM chunk_refs r
+            JOIN chunks ch ON ch.chunk_id = r.chunk_id
+            WHERE r.source IN (SELECT value FROM json_each(?))
+              AND ch.source NOT IN (SELECT value FROM json_each(?))
+            GROUP BY r.chunk_id
+        """, (json.dumps(list(sources)), json.dumps(list(sources))))
+        rows = c.fetchall()
+    return dict(rows)
+
+def get_dedup_stats():
+    with get_connection() as conn:
+        c = conn.cursor()
+        canonical = c.execute("SELECT COUNT(*) FROM chunk_signatures").fetchone()[0]
+        duplicates = c.execute("SELECT COUNT(*) FROM chunk_refs").fetchone()[0]
+    total = canonical + duplicates
+    return {
+        "canonical": canonical,
+        "duplicates": duplicates,
+        "ratio": duplicates / total if total else 0.0,
+    }
+
+# Manifesto dos arquivos enviados: substitui os os.walk da pasta de uploads por consultas indexadas.
+# "manifest_dirs" guarda o mtime de cada pasta ("" é a raiz) para a varredura incremental
+def create_manifest_tables():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                content_hash TEXT,
+                page_count INTEGER,
+                index_status TEXT DEFAULT 'pending',
+                updated_at REAL
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_files_folder ON files (folder, path)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_files_hash ON files (content_hash)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS manifest_dirs (
+                path TEXT PRIMARY KEY,
+                mtime REAL
+            )
+        """)
+
+def _folder_of(path):
+    return path.rsplit("/", 1)[0] if "/" in path else ""
+
+def upsert_manifest_file(path, size, mtime, index_status="pending", content_hash=None):
+    # Conteúdo novo ou alterado: páginas (e o hash, se não informado) ficam pendentes até a próxima indexação
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO files (path, folder, size, mtime, content_hash, index_status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (path) DO UPDATE SET
+                size = excluded.size, mtime = excluded.mtime, content_hash = excluded.content_hash, page_count = NULL,
+                index_status = excluded.index_status, updated_at = excluded.updated_at
+        """, (path, _folder_of(path), size, mtime, content_hash, index_status, time.time()))
+
+def update_manifest_status(path, index_status, content_hash=None, page_count=None):
+    with transaction() as conn:
+        conn.execute("""
+            UPDATE files SET index_status = ?, content_hash = COALESCE(?, content_hash),
+                page_count = COALESCE(?, page_count), updated_at = ?
+            WHERE path = ?
+        """, (index_status, content_hash, page_count, time.time(), path))
+
+def delete_manifest_files(paths):
+    with transaction() as conn:
+        conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+
+def delete_manifest_folder(folder):
+    with transaction() as conn:
+        c = conn.cursor()
+        prefix = folder + "/"
+        c.execute("DELETE FROM files WHERE folder = ? OR substr(folder, 1, ?) = ?", (folder, len(prefix), prefix))
+        c.execute("DELETE FROM manifest_dirs WHERE path = ? OR substr(path, 1, ?) = ?", (folder, len(prefix), prefix))
+
+def rename_manifest_path(old_path, new_path):
+    # Também serve para pastas ("antiga/" → "nova/"); status, hash e páginas acompanham o arquivo
+    now = time.time()
+    with transaction() as conn:
+        c = conn.cursor()
+        if old_path.endswith("/"):
+            old_dir, new_dir = old_path.rstrip("/"), new_path.rstrip("/")
+            c.execute("""
+                UPDATE files SET path = ? || substr(path, ?), folder = ? || substr(folder, ?), updated_at = ?
+                WHERE substr(path, 1, ?) = ?
+            """, (new_path, len(old_path) + 1, new_dir, len(old_dir) + 1, now, len(old_path), old_path))
+            c.execute("UPDATE manifest_dirs SET path = ? || substr(path, ?) WHERE path = ? OR substr(path, 1, ?) = ?",
+                      (new_dir, len(old_dir) + 1, old_dir, len(old_path), old_path))
+        else:
+            # os.rename sobrescreve o destino: a entrada antiga dele sai do manifesto
+            c.execute("DELETE FROM files WHERE path = ?", (new_path,))
+            c.execute("UPDATE files SET path = ?, folder = ?, updated_at = ? WHERE path = ?",
+                      (new_path, _folder_of(new_path), now, old_path))
+
+def save_manifest_dir(path, mtime):
+    with transaction() as conn:
+        conn.execute("REPLACE INTO manifest_dirs (path, mtime) VALUES (?, ?)", (path, mtime))
+
+def get_manifest_dirs():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT path, mtime FROM manifest_dirs")
+        rows = c.fetchall()
+    return dict(rows)
+
+def get_manifest(folder=None):
+    # {path: (size, mtime, content_hash, page_count, index_status)}
+    sql = "SELECT path, size, mtime, content_hash, page_count, index_status FROM files"
+    params = ()
+    if folder is not None:
+        sql += " WHERE folder = ?"
+        params = (folder,)
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql + " ORDER BY path", params)
+        rows = c.fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+def list_manifest_files(folder=None):
+    # Arquivos da pasta e das subpastas dela (todas, se folder for None), em ordem de caminho
+    sql = "SELECT path FROM files"
+    params = ()
+    if folder is not None:
+        sql += " WHERE folder = ? OR substr(folder, 1, ?) = ?"
+        params = (folder, len(folder) + 1, folder + "/")
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql + " ORDER BY path", params)
+        rows = c.fetchall()
+    return [row[0] for row in rows]
+
+def list_manifest_folders():
+    # Pastas de primeiro nível, inclusive as vazias
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT path FROM manifest_dirs WHERE path != '' AND instr(path, '/') = 0 ORDER BY path")
+        rows = c.fetchall()
+    return [row[0] for row in rows]
+
+def get_manifest_hashes(paths):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT path, content_hash FROM files WHERE path IN (SELECT value FROM json_each(?))",
+                  (json.dumps(list(paths)),))
+        rows = c.fetchall()
+    return {path: content_hash for path, content_hash in rows if content_hash}
+
+def get_known_hash(path, size, mtime):
+    # Hash já calculado para o arquivo neste tamanho e mtime, pelo manifesto ou pela indexação
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT content_hash FROM files WHERE path = ? AND size = ? AND mtime = ? AND content_hash IS NOT NULL
+            UNION ALL
+            SELECT content_hash FROM indexed_files WHERE source = ? AND size = ? AND mtime = ?
+            LIMIT 1
+        """, (path, size, mtime) * 2)
+        row = c.fetchone()
+    return row[0] if row else None
+
+def count_file_references(content_hash):
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM files WHERE content_hash = ?", (content_hash,))
+        total = c.fetchone()[0]
+    return total
+
+def count_manifest_files():
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM files")
+        total = c.fetchone()[0]
+    return total
+
+def apply_manifest_scan(dirs, changed, removed_files, removed_dirs):
+    # dirs: {pasta: mtime} relistadas; changed: (path, size, mtime) novos ou alterados
+    now = time.time()
+    with transaction() as conn:
+        c = conn.cursor()
+        for folder in removed_dirs:
+            prefix = folder + "/"
+            c.execute("DELETE FROM files WHERE folder = ? OR substr(folder, 1, ?) = ?", (folder, len(prefix), prefix))
+        c.executemany("DELETE FROM manifest_dirs WHERE path = ?", [(folder,) for folder in removed_dirs])
+        c.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed_files])
+        c.executemany("""
+            INSERT INTO files (path, folder, size, mtime, index_status, updated_at) VALUES (?, ?, ?, ?, 'pending', ?)
+            ON CONFLICT (path) DO UPDATE SET
+                size = excluded.size, mtime = excluded.mtime, content_hash = NULL, page_count = NULL,
+                index_status = 'pending', updated_at = excluded.updated_at
+        """, [(path, _folder_of(path), size, mtime, now) for path, size, mtime in changed])
+        c.executemany("REPLACE INTO manifest_dirs (path, mtime) VALUES (?, ?)", list(dirs.items()))
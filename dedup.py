@@ -0,0 +1,78 @@
+import re
+import logging
+import threading
+import mmh3
+import numpy as np
+from decouple import config
+from db import get_lsh_buckets, save_dedup_entries
+
+# Deduplicação de chunks quase idênticos na ingestão (MinHash + LSH por bandas)
+DEDUP_ENABLED = config("DEDUP_ENABLED", default=True, cast=bool)
+DEDUP_THRESHOLD = config("DEDUP_THRESHOLD", default=0.9, cast=float)
+DEDUP_NUM_PERM = config("DEDUP_NUM_PERM", default=128, cast=int)
+DEDUP_BANDS = config("DEDUP_BANDS", default=32, cast=int)
+SHINGLE_SIZE = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_rng = np.random.RandomState(1)
+_PERM_A = _rng.randint(1, 1 << 32, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_PERM_B = _rng.randint(0, 1 << 32, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_ROWS = DEDUP_NUM_PERM // DEDUP_BANDS
+
+# Verificação e registro de novos chunks canônicos são serializados entre as threads de ingestão
+_lock = threading.Lock()
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def minhash(text):
+    hashes = np.array([mmh3.hash(s, signed=False) for s in _shingles(text)], dtype=np.uint64)
+    permuted = (np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME & _MAX_HASH
+    return permuted.min(axis=0).astype(np.uint32)
+
+def band_buckets(signature):
+    rows = signature[:_ROWS * DEDUP_BANDS].reshape(DEDUP_BANDS, _ROWS)
+    return [(band, mmh3.hash64(row.tobytes(), signed=True)[0]) for band, row in enumerate(rows)]
+
+def similarity(a, b):
+    return float(np.mean(a == b))
+
+def deduplicate_chunks(source, chunks, ids, offset=0):
+    # Retorna (chunks canônicos, ids deles, quantidade de duplicados); duplicados viram referências ao canônico.
+    # offset: posição do primeiro chunk no arquivo, quando ele chega em lotes
+    if not DEDUP_ENABLED or not chunks:
+        return chunks, ids, 0
+
+    signatures = [minhash(chunk.page_content) for chunk in chunks]
+    buckets = [band_buckets(signature) for signature in signatures]
+    with _lock:
+        index = {}
+        for key, chunk_id, blob in get_lsh_buckets({b for chunk_buckets in buckets for b in chunk_buckets}):
+            index.setdefault(key, []).append((chunk_id, np.frombuffer(blob, dtype=np.uint32)))
+
+        kept, kept_ids, new_entries, refs = [], [], [], []
+        for position, (chunk, chunk_id, signature, chunk_buckets) in enumerate(zip(chunks, ids, signatures, buckets), offset):
+            best, best_score = None, DEDUP_THRESHOLD
+            for key in chunk_buckets:
+                for candidate_id, candidate in index.get(key, ()):
+                    score = similarity(signature, candidate)
+                    if score >= best_score:
+                        best, best_score = candidate_id, score
+            if best is not None:
+                refs.append((best, source, position))
+                continue
+            kept.append(chunk)
+            kept_ids.append(chunk_id)
+            new_entries.append((chunk_id, source, signature.tobytes(), chunk_buckets))
+            # Duplicados dentro do próprio arquivo também são detectados
+            for key in chunk_buckets:
+                index.setdefault(key, []).append((chunk_id, signature))
+        save_dedup_entries(new_entries, refs)
+
+    if refs:
+        logging.debug(f"{source} → {len(refs)} de {len(chunks)} chunk(s) duplicado(s) não vetorizado(s)")
+    return kept, kept_ids, len(refs)
@@ -0,0 +1,208 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decouple import config
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from db import get_connection, transaction
+from tracing import span
+from metering import add_embedding_tokens
+
+EMBEDDING_CACHE_PATH = config("EMBEDDING_CACHE_PATH", default="embeddings_cache.sqlite3")
+EMBEDDING_BATCH_SIZE = config("EMBEDDING_BATCH_SIZE", default=256, cast=int)
+EMBEDDING_BATCH_CHARS = config("EMBEDDING_BATCH_CHARS", default=200_000, cast=int)
+EMBEDDING_WORKERS = config("EMBEDDING_WORKERS", default=4, cast=int)
+EMBEDDING_MAX_RETRIES = config("EMBEDDING_MAX_RETRIES", default=5, cast=int)
+# "local": LocalHashEmbeddings, sem chamadas à API (testes de carga); use outro PERSIST_DIRECTORY, as dimensões diferem
+EMBEDDING_BACKEND = config("EMBEDDING_BACKEND", default="openai")
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def count_tokens(text):
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+def _pack(vector):
+    return array("f", vector).tobytes()
+
+def _unpack(blob):
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+class EmbeddingCache:
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        with transaction(self.path) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT,
+                    text_hash TEXT,
+                    vector BLOB,
+                    tokens INTEGER,
+                    PRIMARY KEY (model, text_hash)
+                ) WITHOUT ROWID
+            """)
+
+    def get_many(self, model, hashes):
+        found = {}
+        hashes = list(hashes)
+        with get_connection(self.path) as conn:
+            # Respeita o limite de parâmetros do SQLite
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = conn.execute(
+                    f"SELECT text_hash, vector, tokens FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model] + part
+                ).fetchall()
+                for key, blob, tokens in rows:
+                    found[key] = (_unpack(blob), tokens)
+        return found
+
+    def put_many(self, model, items):
+        with transaction(self.path) as conn:
+            conn.executemany(
+                "REPLACE INTO embeddings (model, text_hash, vector, tokens) VALUES (?, ?, ?, ?)",
+                [(model, key, _pack(vector), tokens) for key, vector, tokens in items]
+            )
+
+class CachedEmbeddings(Embeddings):
+    # Envolve um embedder qualquer (OpenAI ou local) e só envia ao provedor os textos ausentes do cache
+    def __init__(self, embedder, model_name=None, cache=None, batch_size=EMBEDDING_BATCH_SIZE,
+                 batch_chars=EMBEDDING_BATCH_CHARS, max_workers=EMBEDDING_WORKERS,
+                 max_retries=EMBEDDING_MAX_RETRIES):
+        self.embedder = embedder
+        self.model_name = model_name or getattr(embedder, "model", None) or type(embedder).__name__
+        self.cache = cache or EmbeddingCache()
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.tokens_embedded = 0
+        self._stats_lock = threading.Lock()
+
+    def _batches(self, texts):
+        batch, chars = [], 0
+        for text in texts:
+            if batch and (len(batch) >= self.batch_size or chars + len(text) > self.batch_chars):
+                yield batch
+                batch, chars = [], 0
+            batch.append(text)
+            chars += len(text)
+        if batch:
+            yield batch
+
+    def _embed_with_retry(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.embedder.embed_documents(batch)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt, 30) * (0.5 + random.random() / 2)
+                logging.warning(f"Falha ao gerar embeddings ({e}); nova tentativa em {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed_documents(self, texts):
+        with span("embedding", f"{len(texts)} texto(s)") as current:
+            normalized = [normalize_text(text) for text in texts]
+            keys = [text_hash(text) for text in normalized]
+            cached = self.cache.get_many(self.model_name, set(keys))
+
+            # Textos repetidos dentro da mesma chamada são enviados uma única vez
+            pending = {}
+            for key, text in zip(keys, normalized):
+                if key not in cached and key not in pending:
+                    pending[key] = text
+
+            if pending:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    futures = {
+                        executor.submit(self._embed_with_retry, batch): batch
+                        for batch in self._batches(list(pending.values()))
+                    }
+                    for future in as_completed(futures):
+                        batch = futures[future]
+                        items = []
+                        for text, vector in zip(batch, future.result()):
+                            key = text_hash(text)
+                            tokens = count_tokens(text)
+                            cached[key] = (vector, tokens)
+                            items.append((key, vector, tokens))
+                        self.cache.put_many(self.model_name, items)
+
+            with self._stats_lock:
+                self.misses += len(pending)
+                self.hits += len(keys) - len(pending)
+                embedded = sum(cached[key][1] for key in pending)
+                self.tokens_embedded += embedded
+                self.tokens_saved += sum(cached[key][1] for key in keys) - embedded
+            add_embedding_tokens(embedded)
+            current.hits, current.misses = len(keys) - len(pending), len(pending)
+            return [cached[key][0] for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "tokens_embedded": self.tokens_embedded,
+                "tokens_saved": self.tokens_saved,
+            }
+
+class LocalHashEmbeddings(Embeddings):
+    # Embedder determinístico e offline (hashing de palavras), útil para testes e benchmarks
+    def __init__(self, dimensions=256):
+        self.dimensions = dimensions
+        self.model = f"local-hash-{dimensions}"
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimensions
+        for word in normalize_text(text).lower().split():
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = sum(v * v for v in vector) ** 0.5 or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+def get_embeddings():
+    global _embeddings
+    with _embeddings_lock:
+        if _embeddings is None:
+            embedder = LocalHashEmbeddings() if EMBEDDING_BACKEND == "local" else OpenAIEmbeddings()
+            _embeddings = CachedEmbeddings(embedder)
+        return _embeddings
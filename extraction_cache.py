@@ -0,0 +1,170 @@
+import json
+import threading
+import time
+import zlib
+from decouple import config
+from db import get_connection, transaction
+
+EXTRACTION_CACHE_PATH = config("EXTRACTION_CACHE_PATH", default="extraction_cache.sqlite3")
+EXTRACTION_CACHE_MAX_MB = config("EXTRACTION_CACHE_MAX_MB", default=512, cast=int)
+
+_stats = {"hits": 0, "misses": 0}
+_stats_lock = threading.Lock()
+
+def _count(hit):
+    with _stats_lock:
+        _stats["hits" if hit else "misses"] += 1
+
+def _encode(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+def _decode(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+def create_extraction_cache():
+    with transaction(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS extractions (
+                content_hash TEXT,
+                extractor TEXT,
+                version TEXT,
+                item TEXT,
+                data BLOB,
+                size INTEGER,
+                last_access REAL,
+                PRIMARY KEY (content_hash, extractor, version, item)
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_extractions_last_access ON extractions (last_access)")
+        # Tamanho total mantido por triggers: a gravação confere o limite sem somar a tabela inteira
+        c.execute("CREATE TABLE IF NOT EXISTS extraction_totals (key TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+        c.execute("""
+            INSERT OR IGNORE INTO extraction_totals (key, size)
+            SELECT 'size', COALESCE(SUM(size), 0) FROM extractions
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS extractions_ai AFTER INSERT ON extractions BEGIN
+                UPDATE extraction_totals SET size = size + new.size WHERE key = 'size';
+            END
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS extractions_ad AFTER DELETE ON extractions BEGIN
+                UPDATE extraction_totals SET size = size - old.size WHERE key = 'size';
+            END
+        """)
+        c.execute("""
+            CREATE TRIGGER IF NOT EXISTS extractions_au AFTER UPDATE OF size ON extractions BEGIN
+                UPDATE extraction_totals SET size = size - old.size + new.size WHERE key = 'size';
+            END
+        """)
+
+def get_extraction(content_hash, extractor, version, item=""):
+    with transaction(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        key = (content_hash, extractor, version, item)
+        c.execute("SELECT data FROM extractions WHERE content_hash = ? AND extractor = ? AND version = ? AND item = ?", key)
+        row = c.fetchone()
+        if row:
+            c.execute("UPDATE extractions SET last_access = ? WHERE content_hash = ? AND extractor = ? AND version = ? AND item = ?",
+                      (time.time(),) + key)
+    _count(row is not None)
+    return _decode(row[0]) if row else None
+
+def get_extraction_items(content_hash, extractor, version):
+    with transaction(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        key = (content_hash, extractor, version)
+        c.execute("SELECT item, data FROM extractions WHERE content_hash = ? AND extractor = ? AND version = ?", key)
+        rows = c.fetchall()
+        if rows:
+            c.execute("UPDATE extractions SET last_access = ? WHERE content_hash = ? AND extractor = ? AND version = ?",
+                      (time.time(),) + key)
+    _count(bool(rows))
+    return {item: _decode(data) for item, data in rows}
+
+def iter_extraction_items(content_hash, extractor, version, batch_size=64):
+    # Lê os itens em ordem, um lote por consulta, sem carregar todos de uma vez nem prender a conexão
+    last = ""
+    while True:
+        with get_connection(EXTRACTION_CACHE_PATH) as conn:
+            c = conn.cursor()
+            c.execute("""
+                SELECT item, data FROM extractions
+                WHERE content_hash = ? AND extractor = ? AND version = ? AND item > ?
+                ORDER BY item LIMIT ?
+            """, (content_hash, extractor, version, last, batch_size))
+            rows = c.fetchall()
+        for item, data in rows:
+            yield item, _decode(data)
+        if len(rows) < batch_size:
+            return
+        last = rows[-1][0]
+
+def count_extraction_items(content_hash, extractor, version):
+    with get_connection(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM extractions WHERE content_hash = ? AND extractor = ? AND version = ?",
+                  (content_hash, extractor, version))
+        total = c.fetchone()[0]
+    return total
+
+def save_extraction(content_hash, extractor, version, value, item=""):
+    save_extraction_items(content_hash, extractor, version, [(item, value)])
+
+def _delete_items(c, content_hash, extractor, version):
+    c.execute("DELETE FROM extractions WHERE content_hash = ? AND extractor = ? AND version = ?",
+              (content_hash, extractor, version))
+
+def delete_extraction_items(content_hash, extractor, version):
+    with transaction(EXTRACTION_CACHE_PATH) as conn:
+        _delete_items(conn.cursor(), content_hash, extractor, version)
+
+def save_extraction_items(content_hash, extractor, version, items, replace=False):
+    # items: [(item, valor)] gravados numa única transação; replace=True apaga antes os itens anteriores
+    # da mesma extração (ex.: uma extração com menos páginas não deixa páginas antigas para trás)
+    now = time.time()
+    rows = []
+    for item, value in items:
+        data = _encode(value)
+        rows.append((content_hash, extractor, version, item, data, len(data), now))
+    if not rows and not replace:
+        return
+    with transaction(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        if replace:
+            _delete_items(c, content_hash, extractor, version)
+        # Upsert em vez de REPLACE: o REPLACE apaga a linha antiga sem disparar o trigger de exclusão
+        c.executemany("""
+            INSERT INTO extractions (content_hash, extractor, version, item, data, size, last_access)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (content_hash, extractor, version, item) DO UPDATE SET
+                data = excluded.data, size = excluded.size, last_access = excluded.last_access
+        """, rows)
+
+        # Remove as entradas menos usadas até caber no limite configurado
+        c.execute("SELECT size FROM extraction_totals WHERE key = 'size'")
+        excess = c.fetchone()[0] - EXTRACTION_CACHE_MAX_MB * 1024 * 1024
+        if excess > 0:
+            evict = []
+            for row in conn.execute("SELECT content_hash, extractor, version, item, size FROM extractions ORDER BY last_access ASC"):
+                if excess <= 0:
+                    break
+                evict.append(row[:4])
+                excess -= row[4]
+            c.executemany("DELETE FROM extractions WHERE content_hash = ? AND extractor = ? AND version = ? AND item = ?", evict)
+
+def extraction_cache_stats():
+    with get_connection(EXTRACTION_CACHE_PATH) as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), (SELECT size FROM extraction_totals WHERE key = 'size') FROM extractions")
+        entries, size = c.fetchone()
+    with _stats_lock:
+        hits, misses = _stats["hits"], _stats["misses"]
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "entries": entries,
+        "size_bytes": size,
+    }
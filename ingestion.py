@@ -0,0 +1,194 @@
+import os
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from multiprocessing import get_all_start_methods, get_context
+from decouple import config
+from loader import split_batches, UPLOAD_DIRECTORY
+
+INGEST_PROCESSES = config("INGEST_PROCESSES", default=os.cpu_count() or 2, cast=int)
+INGEST_EMBED_THREADS = config("INGEST_EMBED_THREADS", default=2, cast=int)
+INGEST_QUEUE_SIZE = config("INGEST_QUEUE_SIZE", default=8, cast=int)
+# Chunks por lote de embedding e de gravação no Chroma; com a fila, limita a memória em qualquer tamanho de arquivo
+INGEST_BATCH_CHUNKS = config("INGEST_BATCH_CHUNKS", default=64, cast=int)
+# Os pools partem de processos com várias threads (Streamlit, uvicorn, fila, gravador de métricas): com "fork",
+# o filho herda locks presos por essas threads e pode travar. "forkserver" parte de um processo limpo
+INGEST_START_METHOD = config("INGEST_START_METHOD", default="forkserver")
+
+def process_context():
+    method = INGEST_START_METHOD if INGEST_START_METHOD in get_all_start_methods() else "spawn"
+    return get_context(method)
+
+@dataclass
+class IngestReport:
+    files: int = 0
+    chunks: int = 0
+    errors: dict = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    @property
+    def files_per_s(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def chunks_per_s(self):
+        return self.chunks / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"{self.files} arquivo(s), {self.chunks} chunk(s) em {self.elapsed:.1f}s "
+            f"({self.files_per_s:.2f} arquivos/s, {self.chunks_per_s:.1f} chunks/s, {len(self.errors)} falha(s))"
+        )
+
+def stream_file(source, emit, batch_size=INGEST_BATCH_CHUNKS, should_stop=None):
+    # emit(source, offset, chunks, last, error) recebe os lotes na ordem do arquivo; o último lote
+    # vem vazio, com last=True e o erro, se houver. should_stop() devolve o motivo para parar no meio do arquivo
+    try:
+        for offset, chunks in split_batches(os.path.join(UPLOAD_DIRECTORY, source), source, batch_size):
+            stopped = should_stop() if should_stop else None
+            if stopped:
+                emit(source, 0, [], True, stopped)
+                return
+            emit(source, offset, chunks, False, None)
+    except Exception as e:
+        emit(source, 0, [], True, f"{type(e).__name__}: {e}")
+        return
+    emit(source, 0, [], True, None)
+
+_batches = None
+
+def _init_worker(batches):
+    global _batches
+    _batches = batches
+
+def _stream_in_worker(source, batch_size):
+    # Executado nos processos filhos: leitura e split são as etapas pesadas em CPU. Os lotes voltam
+    # pela fila limitada, que segura o filho quando o embedding não acompanha
+    stream_file(source, lambda *item: _batches.put(item), batch_size)
+
+def _produce(sources, emit, processes, queue_size, batch_size, should_stop):
+    if processes <= 1 or len(sources) <= 1:
+        for source in sources:
+            stream_file(source, emit, batch_size, should_stop)
+        return
+
+    context = process_context()
+    batches = context.Queue(maxsize=queue_size)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=_init_worker,
+                             initargs=(batches,)) as executor:
+        remaining = iter(sources)
+        running = {}
+
+        def submit():
+            source = next(remaining, None)
+            if source is None:
+                return
+            stopped = should_stop()
+            if stopped:
+                # Ingestão interrompida: os arquivos que faltam terminam sem ler nada
+                for source in [source, *remaining]:
+                    emit(source, 0, [], True, stopped)
+                return
+            try:
+                running[source] = executor.submit(_stream_in_worker, source, batch_size)
+            except Exception as e:
+                emit(source, 0, [], True, f"{type(e).__name__}: {e}")
+                submit()
+
+        # Um arquivo por processo de cada vez; o próximo entra quando algum termina
+        for _ in range(processes):
+            submit()
+        while running:
+            try:
+                item = batches.get(timeout=1)
+            except queue.Empty:
+                # Processo filho que morreu sem avisar o fim do arquivo
+                for source, future in list(running.items()):
+                    if future.done() and future.exception() is not None:
+                        del running[source]
+                        e = future.exception()
+                        emit(source, 0, [], True, f"{type(e).__name__}: {e}")
+                        submit()
+                continue
+            emit(*item)
+            if item[3]:
+                running.pop(item[0], None)
+                submit()
+    batches.close()
+    batches.join_thread()
+
+def run_ingestion(sources, sink, processes=INGEST_PROCESSES, threads=INGEST_EMBED_THREADS,
+                  queue_size=INGEST_QUEUE_SIZE, batch_size=INGEST_BATCH_CHUNKS, progress=None):
+    # sink(source, offset, chunks, last, error) grava cada lote; roda na etapa de embedding.
+    # Todos os lotes de um arquivo passam pela mesma thread, na ordem de leitura.
+    # progress(source, chunks) é chamado após cada lote gravado; se levantar exceção (ex.: job cancelado),
+    # a ingestão para: os arquivos em andamento e os restantes terminam com esse erro
+    report = IngestReport()
+    report_lock = threading.Lock()
+    aborted = {}
+    lanes = [queue.Queue(maxsize=queue_size) for _ in range(max(1, threads))]
+    start = time.perf_counter()
+
+    def embed_worker(lane):
+        stored, failed = {}, {}
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+            source, offset, chunks, last, error = item
+            if not last:
+                if source in failed:
+                    continue  # Arquivo já falhou: descarta o restante dos lotes
+                try:
+                    sink(source, offset, chunks, False, None)
+                    stored[source] = stored.get(source, 0) + len(chunks)
+                except Exception as e:
+                    failed[source] = f"{type(e).__name__}: {e}"
+                    continue
+                if progress:
+                    try:
+                        progress(source, stored[source])
+                    except Exception as e:
+                        failed[source] = aborted.setdefault("error", f"{type(e).__name__}: {e}")
+                continue
+
+            # Fim do arquivo: o sink confirma o registro ou desfaz os lotes já gravados
+            error = error or failed.pop(source, None)
+            try:
+                sink(source, 0, [], True, error)
+            except Exception as e:
+                error = error or f"{type(e).__name__}: {e}"
+            with report_lock:
+                report.files += 1
+                if error:
+                    report.errors[source] = error
+                    logging.warning(f"{source} → Falha na ingestão: {error}")
+                else:
+                    report.chunks += stored.get(source, 0)
+            stored.pop(source, None)
+
+    def emit(source, offset, chunks, last, error):
+        if aborted:
+            # Depois da interrupção, lotes de filhos ainda lendo são descartados e o arquivo termina com o erro
+            if not last:
+                return
+            error = error or aborted["error"]
+        lanes[hash(source) % len(lanes)].put((source, offset, chunks, last, error))
+
+    workers = [threading.Thread(target=embed_worker, args=(lane,), daemon=True) for lane in lanes]
+    for worker in workers:
+        worker.start()
+    try:
+        _produce(list(sources), emit, processes, queue_size, batch_size, lambda: aborted.get("error"))
+    finally:
+        for lane in lanes:
+            lane.put(None)
+        for worker in workers:
+            worker.join()
+
+    report.elapsed = time.perf_counter() - start
+    logging.info(f"Ingestão concluída: {report.summary()}")
+    return report
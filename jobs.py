@@ -0,0 +1,320 @@
+import os
+import json
+import time
+import logging
+import threading
+from decouple import config
+import tracing
+from db import (
+    get_connection, transaction, get_indexed_files, get_search_files, delete_indexed_file, delete_document_pages, get_manifest
+)
+from extraction_cache import get_extraction_items
+from loader import (
+    UPLOAD_DIRECTORY, sync_index, sync_search_index, file_hash, rescan_manifest, update_manifest_from_index, cache_pages,
+    LOADER_VERSION
+)
+
+# Fila persistente de indexação: uploads só gravam o arquivo e enfileiram; threads de fundo processam
+JOB_WORKERS = config("JOB_WORKERS", default=2, cast=int)
+JOB_MAX_ATTEMPTS = config("JOB_MAX_ATTEMPTS", default=3, cast=int)
+JOB_RETRY_SECONDS = config("JOB_RETRY_SECONDS", default=10, cast=int)
+JOB_SCAN_SECONDS = config("JOB_SCAN_SECONDS", default=30, cast=int)
+JOB_STALE_SECONDS = config("JOB_STALE_SECONDS", default=600, cast=int)
+# A varredura periódica só relista pastas alteradas; de tempos em tempos confere o stat de todos os arquivos
+MANIFEST_FULL_SCAN_SECONDS = config("MANIFEST_FULL_SCAN_SECONDS", default=3600, cast=int)
+
+PRIORITY_CHAT = 20  # Arquivo pedido no chat ainda não indexado
+PRIORITY_UPLOAD = 10
+PRIORITY_SCAN = 5
+PRIORITY_OCR = 1
+
+_workers = []
+_workers_lock = threading.Lock()
+_wake = threading.Event()
+
+class JobCancelled(Exception):
+    pass
+
+def create_jobs_table():
+    with transaction() as conn:
+        c = conn.cursor()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                source TEXT NOT NULL,
+                priority INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                progress REAL DEFAULT 0,
+                error TEXT,
+                run_after REAL DEFAULT 0,
+                created_at REAL,
+                updated_at REAL
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority DESC, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_source ON jobs (source, id)")
+        # No máximo um job pendente por (tipo, arquivo): reenfileirar só ajusta a prioridade
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (kind, source) WHERE status = 'pending'")
+
+def enqueue_job(kind, source, priority=PRIORITY_UPLOAD):
+    now = time.time()
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO jobs (kind, source, priority, created_at, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, source) WHERE status = 'pending'
+            DO UPDATE SET priority = MAX(priority, excluded.priority), run_after = 0, updated_at = excluded.updated_at
+        """, (kind, source, priority, now, now))
+    _wake.set()
+
+def enqueue_file(source, priority=PRIORITY_UPLOAD):
+    enqueue_job("index", source, priority)
+    enqueue_job("search", source, priority - 1)
+
+def cancel_job(job_id):
+    # Pendentes são cancelados na hora; em execução, o worker interrompe no próximo ponto de progresso
+    with transaction() as conn:
+        conn.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status IN ('pending', 'running')",
+                     (time.time(), job_id))
+
+def retry_job(job_id):
+    with transaction() as conn:
+        row = conn.execute("SELECT kind, source, priority FROM jobs WHERE id = ? AND status IN ('failed', 'cancelled')",
+                           (job_id,)).fetchone()
+    if row:
+        enqueue_job(*row)
+
+def _claim_job():
+    now = time.time()
+    with transaction() as conn:
+        return conn.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, progress = 0, updated_at = ?
+            WHERE id = (
+                SELECT id FROM jobs WHERE status = 'pending' AND run_after <= ?
+                ORDER BY priority DESC, id LIMIT 1
+            )
+            RETURNING id, kind, source, attempts
+        """, (now, now)).fetchone()
+
+def _set_progress(job_id, progress):
+    with transaction() as conn:
+        cancelled = conn.execute("""
+            UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ? AND status = 'running' RETURNING id
+        """, (progress, time.time(), job_id)).fetchone() is None
+    if cancelled:
+        raise JobCancelled()
+
+def _is_cancelled(job_id):
+    with get_connection() as conn:
+        row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return row is None or row[0] == "cancelled"
+
+def _index_progress(job_id, start=0.1, end=0.9, half_chunks=256):
+    # A cada lote gravado: avança o progresso, renova updated_at (sinal de vida para start_workers) e levanta
+    # JobCancelled se o job foi cancelado. Sem o total de chunks, a fração se aproxima de `end` sem chegar lá
+    def report(source, chunks):
+        _set_progress(job_id, start + (end - start) * chunks / (chunks + half_chunks))
+    return report
+
+def _finish_job(job_id, attempts, error=None):
+    now = time.time()
+    with transaction() as conn:
+        if error is None:
+            conn.execute("UPDATE jobs SET status = 'done', progress = 1, error = NULL, updated_at = ? WHERE id = ? AND status = 'running'",
+                         (now, job_id))
+        elif attempts < JOB_MAX_ATTEMPTS:
+            # Nova tentativa com espera crescente; o job volta para a fila com a mesma prioridade.
+            # Se o arquivo já foi reenfileirado nesse meio-tempo, esta execução fica registrada como falha
+            conn.execute("""
+                UPDATE jobs SET status = 'pending', error = ?, run_after = ?, updated_at = ?
+                WHERE id = ? AND status = 'running'
+                  AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.kind = jobs.kind AND j.source = jobs.source AND j.status = 'pending')
+            """, (error, now + JOB_RETRY_SECONDS * 2 ** (attempts - 1), now, job_id))
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                         (error, now, job_id))
+        else:
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                         (error, now, job_id))
+
+def _run_index(job_id, source):
+    _set_progress(job_id, 0.1)
+    path = os.path.join(UPLOAD_DIRECTORY, source)
+    if not os.path.exists(path):
+        return
+    errors = {}
+    ready = sync_index([source], errors=errors, progress=_index_progress(job_id))
+    if source in errors:
+        # sync_index não registra o arquivo que falhou: a próxima tentativa o reprocessa
+        if _is_cancelled(job_id):
+            update_manifest_from_index(source)
+            raise JobCancelled()
+        update_manifest_from_index(source, failed=True)
+        raise RuntimeError(errors[source])
+    update_manifest_from_index(source)
+    # PDF sem texto extraível: agenda o OCR, que depois reindexa o arquivo com o texto reconhecido
+    if not ready and source.endswith(".pdf"):
+        enqueue_job("ocr", source, PRIORITY_OCR)
+
+def _run_search(job_id, source):
+    _set_progress(job_id, 0.1)
+    sync_search_index([source])
+
+def _run_ocr(job_id, source):
+    from ocr import ocr_pdf, OCR_VERSION
+
+    path = os.path.join(UPLOAD_DIRECTORY, source)
+    if not os.path.exists(path):
+        return
+    ocr_pdf(path, progress_callback=lambda done, total: _set_progress(job_id, 0.9 * done / total if total else 0.9))
+    content_hash = file_hash(path)
+    pages = get_extraction_items(content_hash, "ocr-page", OCR_VERSION)
+    cache_pages(content_hash, [
+        (text, {"source": path, "page": int(page) - 1}) for page, text in sorted(pages.items(), key=lambda item: int(item[0]))
+    ])
+    # Força a reindexação com as páginas reconhecidas
+    delete_indexed_file(source)
+    delete_document_pages(source)
+    errors = {}
+    sync_index([source], errors=errors, progress=_index_progress(job_id, start=0.9, end=1.0))
+    if source in errors:
+        if _is_cancelled(job_id):
+            update_manifest_from_index(source)
+            raise JobCancelled()
+        update_manifest_from_index(source, failed=True)
+        raise RuntimeError(errors[source])
+    update_manifest_from_index(source)
+    sync_search_index([source])
+
+def _run_lai(job_id, source):
+    from lai_search import backfill_perguntas_lai
+
+    backfill_perguntas_lai(progress=lambda done: _set_progress(job_id, done))
+
+HANDLERS = {"index": _run_index, "search": _run_search, "ocr": _run_ocr, "lai": _run_lai}
+
+def _worker():
+    while True:
+        job = _claim_job()
+        if job is None:
+            _wake.wait(timeout=2)
+            _wake.clear()
+            continue
+        job_id, kind, source, attempts = job
+        try:
+            with tracing.request(f"job.{kind}", source):
+                HANDLERS[kind](job_id, source)
+        except JobCancelled:
+            logging.info(f"{source} → job {kind} #{job_id} cancelado")
+            continue
+        except Exception as e:
+            logging.warning(f"{source} → job {kind} #{job_id} falhou (tentativa {attempts}): {type(e).__name__}: {e}")
+            _finish_job(job_id, attempts, f"{type(e).__name__}: {e}")
+            continue
+        _finish_job(job_id, attempts)
+
+def enqueue_changed_files(priority=PRIORITY_SCAN):
+    # Arquivos do manifesto divergentes dos índices (novos, alterados ou copiados direto para a pasta) entram na fila
+    indexed = get_indexed_files()
+    searched = get_search_files()
+    with get_connection() as conn:
+        active = set(conn.execute("SELECT kind, source FROM jobs WHERE status IN ('pending', 'running')").fetchall())
+    for source, (size, mtime, _, _, index_status) in get_manifest().items():
+        for kind, entries in (("index", indexed), ("search", searched)):
+            entry = entries.get(source)
+            if (kind, source) in active or (kind == "index" and ("ocr", source) in active):
+                continue
+            if not entry or entry[1] != size or entry[2] != mtime:
+                enqueue_job(kind, source, priority)
+            elif kind == "index" and entry[4] != LOADER_VERSION:
+                # Indexado por outra versão dos loaders: reindexa, respondendo com os chunks antigos até lá
+                enqueue_job(kind, source, priority)
+            elif kind == "index" and index_status == "pending":
+                # Indexado antes do manifesto existir (ou reapareceu com o mesmo conteúdo): só atualiza o status
+                update_manifest_from_index(source)
+
+def prioritize_files(sources):
+    # Arquivos pedidos no chat e ainda não indexados passam à frente na fila
+    indexed = get_indexed_files()
+    with get_connection() as conn:
+        active = dict(conn.execute("""
+            SELECT source, kind FROM jobs
+            WHERE status = 'pending' AND kind IN ('index', 'ocr') AND source IN (SELECT value FROM json_each(?))
+        """, (json.dumps(list(sources)),)).fetchall())
+        running = {row[0] for row in conn.execute("SELECT source FROM jobs WHERE status = 'running'").fetchall()}
+    for source in sources:
+        if source in active:
+            enqueue_job(active[source], source, PRIORITY_CHAT)
+            continue
+        if source in running:
+            continue
+        path = os.path.join(UPLOAD_DIRECTORY, source)
+        entry = indexed.get(source)
+        stat = os.stat(path) if os.path.exists(path) else None
+        if stat and (not entry or entry[1] != stat.st_size or entry[2] != stat.st_mtime):
+            enqueue_file(source, PRIORITY_CHAT)
+
+def _scanner():
+    last_full = time.time()
+    while True:
+        time.sleep(JOB_SCAN_SECONDS)
+        try:
+            full = time.time() - last_full >= MANIFEST_FULL_SCAN_SECONDS
+            rescan_manifest(full=full)
+            if full:
+                last_full = time.time()
+            enqueue_changed_files()
+        except Exception as e:
+            logging.warning(f"Varredura de arquivos falhou: {type(e).__name__}: {e}")
+
+def start_workers():
+    # Uma vez por processo; jobs "running" sem atualização há muito tempo são de um processo que morreu
+    # (os jobs vivos renovam updated_at a cada lote gravado ou página de OCR)
+    with _workers_lock:
+        if _workers:
+            return
+        with transaction() as conn:
+            conn.execute("""
+                UPDATE jobs SET status = 'pending', updated_at = ?
+                WHERE status = 'running' AND updated_at < ?
+                  AND NOT EXISTS (SELECT 1 FROM jobs j WHERE j.kind = jobs.kind AND j.source = jobs.source AND j.status = 'pending')
+            """, (time.time(), time.time() - JOB_STALE_SECONDS))
+            conn.execute("UPDATE jobs SET status = 'failed', error = 'Interrompido' WHERE status = 'running' AND updated_at < ?",
+                         (time.time() - JOB_STALE_SECONDS,))
+        purge_jobs()
+        # Primeira varredura antes de abrir a página: completa, para pegar edições feitas com o app parado
+        rescan_manifest(full=True)
+        enqueue_changed_files()
+        for target in [_worker] * max(1, JOB_WORKERS) + [_scanner]:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            _workers.append(thread)
+
+def get_file_status():
+    # Situação do job mais recente de indexação de cada arquivo: {source: (status, progress, error)}
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT source, status, progress, error FROM jobs
+            WHERE id IN (SELECT MAX(id) FROM jobs WHERE kind IN ('index', 'ocr') GROUP BY source)
+        """)
+        rows = c.fetchall()
+    return {source: (status, progress, error) for source, status, progress, error in rows}
+
+def list_jobs(limit=20):
+    # Fila ativa primeiro, depois as falhas mais recentes
+    with get_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT id, kind, source, status, progress, attempts, error FROM jobs
+            WHERE status IN ('pending', 'running', 'failed')
+            ORDER BY status = 'running' DESC, status = 'pending' DESC, priority DESC, id DESC
+            LIMIT ?
+        """, (limit,))
+        rows = c.fetchall()
+    return rows
+
+def purge_jobs(older_than_days=7):
+    with transaction() as conn:
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'cancelled') AND updated_at < ?",
+                     (time.time() - older_than_days * 86400,))
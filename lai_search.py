@@ -0,0 +1,115 @@
+import re
+import threading
+from langchain_community.vectorstores import Chroma
+from db import get_textos_perguntas_lai, get_max_pergunta_lai_id, get_meta_value, set_meta_value
+from embeddings import get_embeddings
+from loader import PERSIST_DIRECTORY, get_index, source_filter, chroma_settings
+
+# Campos de perguntas_lai indexados semanticamente
+LAI_FIELDS = {1: "pergunta", 2: "texto_recurso_1", 3: "texto_recurso_2"}
+
+# Job da fila (jobs.py) que indexa as perguntas cadastradas antes da busca semântica
+LAI_BACKFILL_JOB = ("lai", "perguntas_lai")
+
+_lai_store = None
+_lai_store_lock = threading.Lock()
+
+def _collection_name(embedding):
+    # Uma coleção por modelo de embedding: vetores de modelos diferentes não são comparáveis
+    model = getattr(embedding, "model_name", None) or getattr(embedding, "model", None) or type(embedding).__name__
+    return ("perguntas_lai-" + re.sub(r"[^A-Za-z0-9_-]", "-", model))[:63]
+
+def _backfill_key(store):
+    # Maior id já indexado pelo backfill, por coleção (cada modelo de embedding tem a sua)
+    return f"lai_backfill:{store._collection.name}"
+
+def get_lai_store(embedding=None, persist_directory=PERSIST_DIRECTORY, schedule_backfill=True):
+    # embedding permite usar um embedder local (ex.: LocalHashEmbeddings) para testes offline;
+    # nesse caso quem chama roda backfill_perguntas_lai, pois o job usaria o embedder padrão
+    global _lai_store
+    with _lai_store_lock:
+        if _lai_store is None or embedding is not None:
+            custom = embedding is not None
+            embedding = embedding or get_embeddings()
+            _lai_store = Chroma(
+                collection_name=_collection_name(embedding),
+                embedding_function=embedding,
+                **chroma_settings(persist_directory)
+            )
+            # Backfill em segundo plano: as buscas usam o que já estiver indexado enquanto isso
+            if schedule_backfill and not custom and get_meta_value(_backfill_key(_lai_store)) < get_max_pergunta_lai_id():
+                from jobs import enqueue_job, PRIORITY_SCAN
+                enqueue_job(*LAI_BACKFILL_JOB, PRIORITY_SCAN)
+        return _lai_store
+
+def _entries(id_, pergunta, texto_recurso_1, texto_recurso_2):
+    values = (pergunta, texto_recurso_1, texto_recurso_2)
+    return [
+        (f"{id_}:{field}", (value or "").strip(), {"pergunta_id": id_, "campo": field})
+        for field, value in zip(LAI_FIELDS.values(), values)
+    ]
+
+def _upsert(store, rows):
+    ids, texts, metadatas, empty = [], [], [], []
+    for id_, pergunta, recurso_1, recurso_2, _ in rows:
+        for entry_id, text, metadata in _entries(id_, pergunta, recurso_1, recurso_2):
+            if text:
+                ids.append(entry_id)
+                texts.append(text)
+                metadatas.append(metadata)
+            else:
+                empty.append(entry_id)
+    if ids:
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+    if empty:
+        store.delete(ids=empty)
+
+def backfill_perguntas_lai(store=None, progress=None, batch_size=500):
+    # Indexa perguntas cadastradas antes da busca semântica existir, retomando de onde parou;
+    # progress(fração) a cada lote (o job renova o sinal de vida e verifica cancelamento)
+    store = store or get_lai_store(schedule_backfill=False)
+    key = _backfill_key(store)
+    after_id, last_id = get_meta_value(key), get_max_pergunta_lai_id()
+    first_id = after_id
+    while after_id < last_id:
+        rows = get_textos_perguntas_lai(after_id=after_id, limit=batch_size)
+        if not rows:
+            break
+        _upsert(store, rows)
+        after_id = rows[-1][0]
+        set_meta_value(key, after_id)
+        if progress:
+            progress((after_id - first_id) / max(1, last_id - first_id))
+
+def index_pergunta_lai(id_):
+    # Chamado após inserir ou editar uma pergunta: atualiza apenas os vetores dela
+    _upsert(get_lai_store(), get_textos_perguntas_lai(ids=[id_]))
+
+def find_similar_perguntas(texto, k=5, before_id=None):
+    # Com before_id, só perguntas cadastradas antes dela (e nunca ela mesma)
+    if not texto or not texto.strip():
+        return []
+    search_filter = {"pergunta_id": {"$lt": before_id}} if before_id is not None else None
+    # Busca mais candidatos que k: a mesma pergunta pode aparecer por mais de um campo
+    results = get_lai_store().similarity_search_with_relevance_scores(
+        texto, k=k * len(LAI_FIELDS), filter=search_filter
+    )
+    best = {}
+    for doc, score in results:
+        id_ = doc.metadata["pergunta_id"]
+        if id_ not in best or score > best[id_][0]:
+            best[id_] = (score, doc.metadata["campo"])
+    top = sorted(best.items(), key=lambda item: item[1][0], reverse=True)[:k]
+    rows = {row[0]: row for row in get_textos_perguntas_lai(ids=[id_ for id_, _ in top])}
+    return [
+        (id_, score, campo, rows[id_][1], rows[id_][4])
+        for id_, (score, campo) in top if id_ in rows
+    ]
+
+def find_relevant_chunks(texto, k=5, selected_files=None):
+    if not texto or not texto.strip():
+        return []
+    search_filter = None
+    if selected_files:
+        search_filter = source_filter(selected_files)
+    return get_index().similarity_search_with_relevance_scores(texto, k=k, filter=search_filter)
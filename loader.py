@@ -1,85 +1,603 @@
 import os
+import shutil
+import hashlib
 import logging
+import threading
+import time
+from decouple import config
 from langchain_community.document_loaders import (
     PyPDFLoader, UnstructuredWordDocumentLoader, UnstructuredPowerPointLoader,
     UnstructuredCSVLoader, TextLoader
 )
 from langchain_community.document_loaders.unstructured import UnstructuredFileLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.schema import Document
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
 import streamlit as st
+from db import (
+    get_indexed_files, save_indexed_file, delete_indexed_file, bump_index_version,
+    get_search_files, update_search_file, index_document_pages, delete_document_pages,
+    index_chunks, delete_chunks, get_chunk_sources, buscar_documentos_por_tag, release_dedup_source,
+    get_indexed_file, get_ready_sources, upsert_manifest_file, update_manifest_status, delete_manifest_files,
+    get_manifest, get_manifest_dirs, list_manifest_files, apply_manifest_scan,
+    find_indexed_twin, link_duplicate_source, copy_document_pages, rename_indexed_source, rename_document_source,
+    rename_manifest_path, delete_manifest_folder, delete_document_pages_by_prefix, get_manifest_hashes, count_file_references,
+    get_known_hash
+)
+from embeddings import get_embeddings
+from extraction_cache import (
+    get_extraction, save_extraction, save_extraction_items, iter_extraction_items, count_extraction_items,
+    delete_extraction_items
+)
+from dedup import deduplicate_chunks
+from blob_store import write_blob, link_blob, same_content, release_blob, blob_path
+from tracing import span, traced, traced_iter, record
 
 UPLOAD_DIRECTORY = "uploaded_files"
 PERSIST_DIRECTORY = "chroma"
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 os.makedirs(PERSIST_DIRECTORY, exist_ok=True)
+# Servidor Chroma compartilhado (ex.: chroma run --path chroma --port 8001). O Chroma embutido mantém o índice
+# HNSW em memória por processo: com app.py e api.py abertos no mesmo diretório, um não vê o que o outro grava e
+# os arquivos do índice podem ser sobrescritos. Para rodar os dois juntos, CHROMA_HOST é obrigatório.
+CHROMA_HOST = config("CHROMA_HOST", default="")
+CHROMA_PORT = config("CHROMA_PORT", default=8001, cast=int)
 
-def load_file(file_path):
+# Incrementar ao mudar os loaders ou seus parâmetros invalida o cache de extração
+LOADER_VERSION = "2"
+SUPPORTED_EXTENSIONS = (".pdf", ".docx", ".pptx", ".csv", ".txt")
+# Páginas gravadas no cache de extração por transação durante a leitura
+PAGE_CACHE_BATCH = 32
+
+_vector_store = None
+_chroma_client = None
+_manifest_lock = threading.Lock()
+
+def parse_file(file_path):
+    # Gera as páginas (PDF) ou documentos (demais formatos) sob demanda, sem montar a lista inteira
+    if file_path.endswith(".pdf"):
+        loader = PyPDFLoader(file_path)
+    elif file_path.endswith(".docx"):
+        loader = UnstructuredWordDocumentLoader(file_path)
+    elif file_path.endswith(".pptx"):
+        loader = UnstructuredPowerPointLoader(file_path)
+    elif file_path.endswith(".csv"):
+        loader = UnstructuredCSVLoader(file_path)
+    elif file_path.endswith(".txt"):
+        loader = TextLoader(file_path)
+    else:
+        return
+    yielded = False
     try:
-        if file_path.endswith(".pdf"):
-            return PyPDFLoader(file_path).load_and_split()
-        elif file_path.endswith(".docx"):
-            return UnstructuredWordDocumentLoader(file_path).load()
-        elif file_path.endswith(".pptx"):
-            return UnstructuredPowerPointLoader(file_path).load()
-        elif file_path.endswith(".csv"):
-            return UnstructuredCSVLoader(file_path).load()
-        elif file_path.endswith(".txt"):
-            return TextLoader(file_path).load()
-        else:
-            return []
+        for page in loader.lazy_load():
+            yielded = True
+            yield page
     except Exception as e:
-        return UnstructuredFileLoader(file_path).load()
+        # Depois da primeira página o fallback duplicaria conteúdo; falhas sobem para quem chamou,
+        # que isola o erro por arquivo
+        if yielded:
+            raise
+        logging.warning(f"{file_path} → {type(e).__name__}: {e}; tentando UnstructuredFileLoader")
+        yield from UnstructuredFileLoader(file_path).lazy_load()
+
+def _cached_pages(content_hash):
+    # Só usa o cache completo: a contagem final é gravada depois da última página
+    total = get_extraction(content_hash, "page-count", LOADER_VERSION)
+    if total is None or count_extraction_items(content_hash, "page", LOADER_VERSION) != total:
+        return None
+    return iter_extraction_items(content_hash, "page", LOADER_VERSION)
+
+def cache_pages(content_hash, pages):
+    # pages: [(texto, metadata)] de uma extração completa (ex.: OCR), substituindo a anterior
+    # Sem a contagem, o cache fica incompleto até o fim; as páginas antigas saem na mesma transação das novas
+    items = [(f"{i:06d}", [text, metadata]) for i, (text, metadata) in enumerate(pages)]
+    delete_extraction_items(content_hash, "page-count", LOADER_VERSION)
+    save_extraction_items(content_hash, "page", LOADER_VERSION, items, replace=True)
+    save_extraction(content_hash, "page-count", LOADER_VERSION, len(items))
+
+def iter_pages(file_path):
+    # Páginas uma a uma, do cache ou do arquivo; a memória não cresce com o tamanho do documento
+    if not file_path.endswith(SUPPORTED_EXTENSIONS):
+        return
+    content_hash = known_file_hash(file_path)
+    with span("cache.extraction", os.path.basename(file_path)) as current:
+        cached = _cached_pages(content_hash)
+        current.hits, current.misses = (1, 0) if cached is not None else (0, 1)
+    if cached is not None:
+        for _, (text, metadata) in cached:
+            yield Document(page_content=text, metadata=metadata)
+        return
+    batch, count = [], 0
+    for page in parse_file(file_path):
+        batch.append((f"{count:06d}", [page.page_content, page.metadata]))
+        count += 1
+        yield page
+        if len(batch) >= PAGE_CACHE_BATCH:
+            save_extraction_items(content_hash, "page", LOADER_VERSION, batch)
+            batch = []
+    save_extraction_items(content_hash, "page", LOADER_VERSION, batch)
+    save_extraction(content_hash, "page-count", LOADER_VERSION, count)
+
+def load_file(file_path):
+    return list(iter_pages(file_path))
+
+def split_batches(file_path, source, batch_size):
+    # Gera (posição do primeiro chunk, chunks) em lotes de tamanho fixo, dividindo página a página
+    batch, offset = [], 0
+    split_ms = 0.0
+    for page in traced_iter("load_file", iter_pages(file_path), source):
+        start = time.perf_counter()
+        batch.extend(split_pages([page], source))
+        split_ms += (time.perf_counter() - start) * 1000
+        while len(batch) >= batch_size:
+            yield offset, batch[:batch_size]
+            offset += batch_size
+            batch = batch[batch_size:]
+    if batch:
+        yield offset, batch
+    record("split", split_ms, source)
+
+def load_preview_text(file_path, max_chars=3000):
+    # Lê só as primeiras páginas necessárias para a pré-visualização, sem carregar o documento todo
+    if not file_path.endswith(SUPPORTED_EXTENSIONS):
+        return ""
+    content_hash = known_file_hash(file_path)
+    version = f"{LOADER_VERSION}-{max_chars}"
+    preview = get_extraction(content_hash, "preview", version)
+    if preview is not None:
+        return preview
+
+    parts, size = [], 0
+    for page in iter_pages(file_path):
+        parts.append(page.page_content)
+        size += len(page.page_content) + 1
+        if size >= max_chars:
+            break
+    preview = "\n".join(parts)[:max_chars]
+    save_extraction(content_hash, "preview", version, preview)
+    return preview
+
+def get_ready_files(selected_files):
+    # Arquivos já indexados e inalterados desde a indexação; uma consulta ao manifesto, sem stat nem leitura
+    ready = get_ready_sources(selected_files)
+    return [source for source in selected_files if source in ready]
+
+def _free_path(file_path):
+    # "relatorio.pdf" → "relatorio (2).pdf", "relatorio (3).pdf"...
+    base, ext = os.path.splitext(file_path)
+    n = 2
+    while os.path.exists(f"{base} ({n}){ext}"):
+        n += 1
+    return f"{base} ({n}){ext}"
+
+def _link_twin(source, content_hash, size, mtime, twin):
+    # Conteúdo idêntico a um arquivo já indexado: referencia os chunks dele, sem extrair nem vetorizar de novo
+    twin_source, chunk_count = twin
+    link_duplicate_source(source, twin_source)
+    save_indexed_file(source, content_hash, size, mtime, chunk_count, LOADER_VERSION)
+    logging.info(f"{source} → conteúdo idêntico a {twin_source}; {chunk_count} chunk(s) reaproveitado(s)")
 
 def process_documents(uploaded_files, target_folder=""):
+    from jobs import enqueue_file, enqueue_job
+
     target_path = os.path.join(UPLOAD_DIRECTORY, target_folder) if target_folder else UPLOAD_DIRECTORY
     if not os.path.isdir(target_path):
         os.makedirs(target_path, exist_ok=True)
+    saved, linked, unchanged, renamed = [], [], [], []
     for uploaded_file in uploaded_files:
+        # Gravado em blocos no armazenamento por conteúdo; o hash sai da própria escrita
+        content_hash, existed = write_blob(uploaded_file)
         file_path = os.path.join(target_path, uploaded_file.name)
-        with open(file_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        if os.path.exists(file_path):
+            if same_content(content_hash, file_path) or (
+                os.path.getsize(file_path) == os.path.getsize(blob_path(content_hash)) and file_hash(file_path) == content_hash
+            ):
+                unchanged.append(uploaded_file.name)
+                continue
+            # Mesmo nome com outro conteúdo: grava ao lado em vez de sobrescrever
+            file_path = _free_path(file_path)
+            renamed.append(os.path.basename(file_path))
+        link_blob(content_hash, file_path)
+        source = os.path.relpath(file_path, UPLOAD_DIRECTORY).replace("\\", "/")
+        stat = os.stat(file_path)
+
+        twin = find_indexed_twin(content_hash, source, LOADER_VERSION) if existed else None
+        if twin:
+            _link_twin(source, content_hash, stat.st_size, stat.st_mtime, twin)
+            upsert_manifest_file(source, stat.st_size, stat.st_mtime, "indexed", content_hash)
+            if not copy_document_pages(source, twin[0], stat.st_size, stat.st_mtime):
+                enqueue_job("search", source)
+            linked.append(source)
+        else:
+            upsert_manifest_file(source, stat.st_size, stat.st_mtime, content_hash=content_hash)
+            saved.append(source)
+    # Indexação vetorial, busca textual e OCR ficam a cargo da fila em segundo plano
+    for source in saved:
+        enqueue_file(source)
+    if linked:
+        bump_index_version()
+        st.info(f"♻️ Conteúdo já indexado, reaproveitado sem reprocessar: {', '.join(linked)}")
+    if unchanged:
+        st.info(f"Arquivo(s) idêntico(s) já presente(s) na pasta: {', '.join(unchanged)}")
+    if renamed:
+        st.warning(f"Já havia arquivo com o mesmo nome e outro conteúdo; salvo como: {', '.join(renamed)}")
     st.success("Arquivos enviados com sucesso!")
+    return {"saved": saved, "linked": linked, "unchanged": unchanged, "renamed": renamed}
+
+def _release_blobs(hashes):
+    for content_hash in set(hashes):
+        if not count_file_references(content_hash):
+            release_blob(content_hash)
 
 def delete_files(files):
+    hashes = get_manifest_hashes(files)
     for rel_path in files:
         path = os.path.join(UPLOAD_DIRECTORY, rel_path)
         if os.path.exists(path):
             os.remove(path)
+        remove_from_index(rel_path)
+        delete_document_pages(rel_path)
+    delete_manifest_files(files)
+    _release_blobs(hashes.values())
+    bump_index_version()
+
+def delete_folder(folder, delete_contents=False):
+    folder_path = os.path.join(UPLOAD_DIRECTORY, folder)
+    if delete_contents:
+        delete_files(list_manifest_files(folder))
+        shutil.rmtree(folder_path)
+        delete_document_pages_by_prefix(f"{folder}/")
+    else:
+        os.rmdir(folder_path)
+    delete_manifest_folder(folder)
+
+def rename_source(old_source, new_source):
+    # Mover ou renomear arquivo (ou pasta, com "/" no fim): o blob é o mesmo, então só os metadados mudam,
+    # inclusive o "source" dos vetores no Chroma, sem recalcular embeddings
+    old_path = os.path.join(UPLOAD_DIRECTORY, old_source.rstrip("/"))
+    new_path = os.path.join(UPLOAD_DIRECTORY, new_source.rstrip("/"))
+    is_folder = old_source.endswith("/")
+    if not is_folder and os.path.exists(new_path):
+        delete_files([new_source])  # os.rename sobrescreveria o destino
+    os.rename(old_path, new_path)
+
+    vector_store = get_index()
+    for source in get_indexed_files():
+        if source == old_source or (is_folder and source.startswith(old_source)):
+            stored = vector_store.get(where={"source": source}, include=["metadatas"])
+            if stored["ids"]:
+                renamed = new_source + source[len(old_source):]
+                vector_store._collection.update(
+                    ids=stored["ids"],
+                    metadatas=[{**(metadata or {}), "source": renamed} for metadata in stored["metadatas"]]
+                )
+    rename_indexed_source(old_source, new_source)
+    rename_document_source(old_source, new_source)
+    rename_manifest_path(old_source, new_source)
+    bump_index_version()
 
 def get_available_files():
-    seen = set()
-    files = []
-    for root, _, filenames in os.walk(UPLOAD_DIRECTORY):
-        for filename in filenames:
-            if filename.endswith(".cache"):
-                continue  # Ignora arquivos de cache (resumo e OCR)
-            rel_path = os.path.relpath(os.path.join(root, filename), UPLOAD_DIRECTORY).replace("\\", "/")
-            if rel_path not in seen:
-                seen.add(rel_path)
-                files.append(rel_path)
-    return files
+    return list_manifest_files()
 
-def get_vectorstore(selected_files):
-    all_chunks = []
+def rescan_manifest(full=False):
+    # Varredura incremental: só relista as pastas cujo mtime mudou (entradas criadas, removidas ou renomeadas).
+    # Editar um arquivo no lugar não muda o mtime da pasta; full=True confere o stat de todos os arquivos.
+    # Retorna os arquivos novos ou alterados
+    with _manifest_lock:
+        known_dirs = get_manifest_dirs()
+        children = {}
+        for folder in known_dirs:
+            if folder:
+                children.setdefault(folder.rsplit("/", 1)[0] if "/" in folder else "", []).append(folder)
+        by_folder = {}
+        for path, entry in get_manifest().items():
+            by_folder.setdefault(path.rsplit("/", 1)[0] if "/" in path else "", {})[path] = entry
+
+        seen_dirs, relisted, changed, removed = set(), {}, [], []
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(UPLOAD_DIRECTORY, folder)).st_mtime
+            except FileNotFoundError:
+                continue
+            seen_dirs.add(folder)
+            if not full and known_dirs.get(folder) == mtime:
+                pending.extend(children.get(folder, ()))
+                continue
+            relisted[folder] = mtime
+            listed = set()
+            with os.scandir(os.path.join(UPLOAD_DIRECTORY, folder)) as entries:
+                for entry in entries:
+                    path = f"{folder}/{entry.name}" if folder else entry.name
+                    if entry.is_dir():
+                        pending.append(path)
+                        continue
+                    if entry.name.endswith(".cache") or entry.name.startswith("."):
+                        continue  # Ignora caches legados (resumo e OCR) e temporários ocultos
+                    listed.add(path)
+                    stat = entry.stat()
+                    known = by_folder.get(folder, {}).get(path)
+                    if not known or known[0] != stat.st_size or known[1] != stat.st_mtime:
+                        changed.append((path, stat.st_size, stat.st_mtime))
+            removed.extend(path for path in by_folder.get(folder, {}) if path not in listed)
+
+        removed_dirs = [folder for folder in known_dirs if folder not in seen_dirs]
+        if relisted or removed_dirs:
+            # Hashes que saem do manifesto (arquivo alterado ou apagado fora do app) podem deixar blobs sem uso
+            gone = {path for path, _, _ in changed} | set(removed)
+            gone.update(path for folder in removed_dirs for path in by_folder.get(folder, {}))
+            released = [entry[2] for entries in by_folder.values() for path, entry in entries.items()
+                        if path in gone and entry[2]]
+            # Arquivo alterado que ainda é o mesmo inode do blob (hard link): o blob foi editado junto e não
+            # corresponde mais ao nome; sai do armazenamento mesmo com outras referências
+            changed_paths = {path for path, _, _ in changed}
+            for entries in by_folder.values():
+                for path, entry in entries.items():
+                    if path in changed_paths and entry[2] and same_content(entry[2], os.path.join(UPLOAD_DIRECTORY, path)):
+                        release_blob(entry[2])
+            apply_manifest_scan(relisted, changed, removed, removed_dirs)
+            _release_blobs(released)
+    if changed or removed:
+        logging.info(f"Manifesto: {len(changed)} arquivo(s) novo(s) ou alterado(s), {len(removed)} removido(s)")
+    return [path for path, _, _ in changed]
+
+def page_count(content_hash):
+    # Páginas da extração em cache; formatos sem paginação contam como um único documento
+    return get_extraction(content_hash, "page-count", LOADER_VERSION)
+
+def update_manifest_from_index(source, failed=False):
+    # Copia para o manifesto o resultado da indexação: status, hash e número de páginas
+    entry = get_indexed_file(source)
+    if failed or entry is None:
+        update_manifest_status(source, "failed" if failed else "pending")
+        return
+    content_hash, _, _, chunk_count = entry
+    update_manifest_status(source, "indexed" if chunk_count else "empty", content_hash, page_count(content_hash))
+
+def file_hash(file_path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def known_file_hash(file_path):
+    # Reaproveita o hash do manifesto ou do índice se tamanho e mtime baterem; só relê o arquivo se não
+    source = os.path.relpath(file_path, UPLOAD_DIRECTORY).replace(os.sep, "/")
+    if not source.startswith("../"):
+        stat = os.stat(file_path)
+        content_hash = get_known_hash(source, stat.st_size, stat.st_mtime)
+        if content_hash:
+            return content_hash
+    return file_hash(file_path)
+
+def chroma_settings(persist_directory=PERSIST_DIRECTORY):
+    # Argumentos de conexão do Chroma: o servidor de CHROMA_HOST, se configurado, ou o diretório local
+    global _chroma_client
+    if not CHROMA_HOST:
+        return {"persist_directory": persist_directory}
+    if _chroma_client is None:
+        import chromadb
+        _chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    return {"client": _chroma_client}
+
+def get_index():
+    # Um único índice persistente para todo o acervo; consultas filtram por "source"
+    global _vector_store
+    if _vector_store is None:
+        _vector_store = Chroma(
+            embedding_function=get_embeddings(),
+            **chroma_settings()
+        )
+    return _vector_store
+
+def split_pages(pages, filename):
+    # start_index permite reconstituir trechos contíguos na montagem do contexto
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=400, add_start_index=True)
+    chunks = splitter.split_documents(pages)
+    for chunk in chunks:
+        chunk.metadata["source"] = filename
+    return chunks
+
+def _delete_vectors(source):
+    # Chunks canônicos ainda usados por outros arquivos mudam de dono em vez de serem apagados
+    promoted = release_dedup_source(source)
+    vector_store = get_index()
+    stored = vector_store.get(where={"source": source}, include=["metadatas"])
+    moved = [(chunk_id, metadata) for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]) if chunk_id in promoted]
+    if moved:
+        vector_store._collection.update(
+            ids=[chunk_id for chunk_id, _ in moved],
+            metadatas=[{**(metadata or {}), "source": promoted[chunk_id]} for chunk_id, metadata in moved]
+        )
+    ids = [chunk_id for chunk_id in stored["ids"] if chunk_id not in promoted]
+    if ids:
+        vector_store.delete(ids=ids)
+    delete_chunks(source)
+
+def remove_from_index(source):
+    _delete_vectors(source)
+    delete_indexed_file(source)
+
+@traced("sync_index")
+def sync_index(selected_files, errors=None, progress=None):
+    # progress(source, chunks): repassado a run_ingestion, chamado a cada lote gravado
+    indexed = get_indexed_files()
+    changed = False
+
+    # Remove do índice arquivos apagados fora do app
+    for source in list(indexed):
+        if not os.path.exists(os.path.join(UPLOAD_DIRECTORY, source)):
+            remove_from_index(source)
+            del indexed[source]
+            changed = True
+
+    ready = []
+    to_index = {}
     for filename in selected_files:
         path = os.path.join(UPLOAD_DIRECTORY, filename)
-        pages = load_file(path)
-        if pages:
-            splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=400)
-            chunks = splitter.split_documents(pages)
-            for chunk in chunks:
-                chunk.metadata["source"] = filename
-            logging.info(f"{filename} → {len(chunks)} chunk(s) vetorizado(s)")
-            all_chunks.extend(chunks)
-        else:
-            logging.warning(f"{filename} → Falha ao carregar conteúdo ou OCR necessário")
-    if all_chunks:
-        vector_store = Chroma.from_documents(
-            documents=all_chunks,
-            embedding=OpenAIEmbeddings(),
-            persist_directory=PERSIST_DIRECTORY
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        entry = indexed.get(filename)
+
+        # Tamanho e mtime iguais: arquivo já indexado, sem reler o conteúdo (desde que pelos loaders atuais)
+        current = entry and entry[4] == LOADER_VERSION
+        if current and entry[1] == stat.st_size and entry[2] == stat.st_mtime:
+            if entry[3]:
+                ready.append(filename)
+            continue
+
+        content_hash = file_hash(path)
+        if current and entry[0] == content_hash:
+            save_indexed_file(filename, content_hash, stat.st_size, stat.st_mtime, entry[3], LOADER_VERSION)
+            if entry[3]:
+                ready.append(filename)
+            continue
+
+        if entry:
+            _delete_vectors(filename)
+        twin = find_indexed_twin(content_hash, filename, LOADER_VERSION)
+        if twin:
+            _link_twin(filename, content_hash, stat.st_size, stat.st_mtime, twin)
+            ready.append(filename)
+            changed = True
+            continue
+        to_index[filename] = (content_hash, stat.st_size, stat.st_mtime)
+
+    if to_index:
+        from ingestion import run_ingestion
+
+        dedup_totals = {"chunks": 0, "duplicates": 0}
+        file_totals = {}
+        totals_lock = threading.Lock()
+
+        def store_chunks(filename, offset, chunks, last, error):
+            # Chamado a cada lote: vetoriza e grava só o lote; no último, registra o arquivo ou desfaz o que entrou
+            content_hash, size, mtime = to_index[filename]
+            if not last:
+                # O hash no id evita colisão com chunks que mantiveram o id antigo após mover/renomear
+                ids = [f"{filename}@{content_hash[:12]}#{offset + i}" for i in range(len(chunks))]
+                for chunk_id, chunk in zip(ids, chunks):
+                    chunk.metadata["chunk_id"] = chunk_id
+                with span("dedup", filename):
+                    unique, unique_ids, duplicates = deduplicate_chunks(filename, chunks, ids, offset)
+                if unique:
+                    with span("vector_store.add", filename):
+                        get_index().add_documents(unique, ids=unique_ids)
+                index_chunks(filename, [
+                    (chunk_id, chunk.metadata.get("page"), chunk.metadata.get("start_index"), chunk.page_content)
+                    for chunk_id, chunk in zip(unique_ids, unique)
+                ], replace=offset == 0)
+                with totals_lock:
+                    file_totals[filename] = file_totals.get(filename, 0) + len(chunks)
+                    dedup_totals["chunks"] += len(chunks)
+                    dedup_totals["duplicates"] += duplicates
+                return
+
+            with totals_lock:
+                total = file_totals.pop(filename, 0)
+            if error:
+                # Sem registro em indexed_files: a falha não pode passar por arquivo indexado e vazio
+                remove_from_index(filename)
+                if errors is not None:
+                    errors[filename] = error
+                return
+            if total:
+                logging.info(f"{filename} → {total} chunk(s) processado(s)")
+                ready.append(filename)
+            else:
+                logging.warning(f"{filename} → Falha ao carregar conteúdo ou OCR necessário")
+            save_indexed_file(filename, content_hash, size, mtime, total, LOADER_VERSION)
+
+        run_ingestion(list(to_index), store_chunks, progress=progress)
+        stats = get_embeddings().stats()
+        logging.info(
+            f"Cache de embeddings: {stats['hit_rate']:.0%} de acerto, {stats['tokens_saved']} tokens economizados"
         )
-        return vector_store
+        if dedup_totals["chunks"]:
+            logging.info(
+                f"Deduplicação: {dedup_totals['duplicates']} de {dedup_totals['chunks']} chunk(s) "
+                f"({dedup_totals['duplicates'] / dedup_totals['chunks']:.0%}) sem nova chamada de embedding"
+            )
+        changed = True
+
+    # Arquivos vetorizados antes do índice léxico: copia os chunks do Chroma, sem reprocessar
+    missing_lexical = set(ready) - get_chunk_sources()
+    for source in missing_lexical:
+        stored = get_index().get(where={"source": source}, include=["documents", "metadatas"])
+        index_chunks(source, [
+            (chunk_id, (metadata or {}).get("page"), (metadata or {}).get("start_index"), text)
+            for chunk_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
+        ])
+
+    if changed:
+        bump_index_version()
+    return ready
+
+def sync_search_index(files):
+    indexed = get_search_files()
+    for source in files:
+        path = os.path.join(UPLOAD_DIRECTORY, source)
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        entry = indexed.get(source)
+        if entry and entry[1] == stat.st_size and entry[2] == stat.st_mtime:
+            continue
+        content_hash = file_hash(path)
+        if entry and entry[0] == content_hash:
+            update_search_file(source, content_hash, stat.st_size, stat.st_mtime)
+            continue
+        # As páginas vão direto do gerador para o FTS, sem montar a lista do documento
+        pages = (
+            (doc.metadata["page"] + 1 if "page" in doc.metadata else None, doc.page_content)
+            for doc in iter_pages(path)
+        )
+        try:
+            index_document_pages(source, content_hash, stat.st_size, stat.st_mtime, pages)
+        except Exception as e:
+            logging.warning(f"{source} → Falha ao indexar para busca: {type(e).__name__}: {e}")
+            index_document_pages(source, content_hash, stat.st_size, stat.st_mtime, [])
+
+    # Remove da busca arquivos apagados fora do app
+    for source in indexed:
+        if not os.path.exists(os.path.join(UPLOAD_DIRECTORY, source)):
+            delete_document_pages(source)
+
+def fileset_version(selected_files):
+    # Identifica o conteúdo indexado do conjunto de arquivos; None se algum arquivo mudou desde a indexação
+    indexed = get_indexed_files()
+    digest = hashlib.sha256()
+    for source in sorted(set(selected_files)):
+        entry = indexed.get(source)
+        path = os.path.join(UPLOAD_DIRECTORY, source)
+        if not entry or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        if entry[1] != stat.st_size or entry[2] != stat.st_mtime:
+            return None
+        digest.update(f"{source}\0{entry[0]}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+def filter_sources(selected_files, folder=None, tag=None):
+    # Reduz o conjunto de arquivos pelos filtros de pasta e tag; o resultado restringe ambos os índices
+    sources = list(selected_files)
+    if folder:
+        sources = [s for s in sources if s.startswith(folder.rstrip("/") + "/")]
+    if tag:
+        tagged = set(buscar_documentos_por_tag(tag))
+        sources = [s for s in sources if s in tagged]
+    return sources
+
+def source_filter(selected_files):
+    if len(selected_files) == 1:
+        return {"source": selected_files[0]}
+    return {"source": {"$in": list(selected_files)}}
+
+@traced("get_vectorstore")
+def get_vectorstore(selected_files):
+    if sync_index(selected_files):
+        return get_index()
     return None
@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from decouple import config
+
+# Preço em US$ por 1 milhão de tokens, por modelo da barra lateral ("modelo=entrada/saída,...")
+DEFAULT_MODEL_PRICES = "gpt-3.5-turbo=0.5/1.5,gpt-4=30/60,gpt-4-turbo=10/30,gpt-4o=2.5/10"
+MODEL_PRICES = {
+    model.strip(): tuple(float(price) for price in prices.split("/"))
+    for model, prices in (item.split("=") for item in config("MODEL_PRICES", default=DEFAULT_MODEL_PRICES).split(","))
+}
+EMBEDDING_PRICE = config("EMBEDDING_PRICE", default=0.1, cast=float)  # text-embedding-ada-002
+
+# Consumo da pergunta em andamento; a thread de streaming herda o contexto e soma no mesmo objeto
+_usage = ContextVar("usage", default=None)
+
+@dataclass
+class Usage:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    embedding_tokens: int = 0
+    reported: bool = False  # True quando prompt/completion vieram da API, e não do tokenizador local
+
+    def cost(self, model):
+        prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+        return (self.prompt_tokens * prompt_price + self.completion_tokens * completion_price
+                + self.embedding_tokens * EMBEDDING_PRICE) / 1_000_000
+
+@contextmanager
+def metered():
+    usage = Usage()
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+def current_usage():
+    return _usage.get()
+
+def add_embedding_tokens(tokens):
+    # Só tokens enviados ao provedor: acertos do cache de embeddings não custam nada
+    usage = _usage.get()
+    if usage is not None and tokens:
+        usage.embedding_tokens += tokens
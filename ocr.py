@@ -0,0 +1,100 @@
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from decouple import config
+import pytesseract
+from pdf2image import convert_from_path, pdfinfo_from_path
+from extraction_cache import get_extraction_items, save_extraction
+from loader import file_hash
+from ingestion import process_context
+from tracing import traced
+
+# Caminhos vazios usam o tesseract/poppler disponíveis no PATH
+TESSERACT_CMD = config("TESSERACT_CMD", default="")
+POPPLER_PATH = config("POPPLER_PATH", default="") or None
+OCR_LANG = config("OCR_LANG", default="por")
+OCR_DPI = config("OCR_DPI", default=200, cast=int)
+OCR_WORKERS = config("OCR_WORKERS", default=os.cpu_count() or 2, cast=int)
+OCR_MAX_PAGES = config("OCR_MAX_PAGES", default=0, cast=int)  # 0 = todas as páginas
+# Páginas reconhecidas com outra resolução ou idioma não são reaproveitadas
+OCR_VERSION = f"tesseract-{OCR_DPI}-{OCR_LANG}"
+
+if TESSERACT_CMD:
+    pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+
+@dataclass
+class OcrReport:
+    pages: int = 0
+    cached: int = 0
+    recognized: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def pages_per_s(self):
+        return self.recognized / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return (
+            f"{self.pages} página(s), {self.cached} do cache, {self.recognized} reconhecida(s) "
+            f"em {self.elapsed:.1f}s ({self.pages_per_s:.2f} páginas/s)"
+        )
+
+@traced("ocr.page")
+def ocr_page(file_path, page_number, dpi=OCR_DPI, lang=OCR_LANG):
+    # Executado nos processos filhos: renderiza e reconhece uma única página por vez
+    images = convert_from_path(
+        file_path,
+        dpi=dpi,
+        first_page=page_number,
+        last_page=page_number,
+        poppler_path=POPPLER_PATH
+    )
+    return page_number, "\n".join(pytesseract.image_to_string(img, lang=lang) for img in images)
+
+def count_pages(file_path):
+    return pdfinfo_from_path(file_path, poppler_path=POPPLER_PATH)["Pages"]
+
+@traced("ocr")
+def ocr_pdf(file_path, progress_callback=None, max_pages=OCR_MAX_PAGES, workers=OCR_WORKERS):
+    start = time.perf_counter()
+    content_hash = file_hash(file_path)
+    total = count_pages(file_path)
+    if max_pages:
+        total = min(total, max_pages)
+
+    # Páginas já reconhecidas (mesmo numa execução interrompida) vêm do cache
+    cached = get_extraction_items(content_hash, "ocr-page", OCR_VERSION)
+    texts = {int(page): text for page, text in cached.items() if int(page) <= total}
+    report = OcrReport(pages=total, cached=len(texts))
+    missing = iter([page for page in range(1, total + 1) if page not in texts])
+
+    def notify():
+        if progress_callback:
+            progress_callback(len(texts), total)
+
+    notify()
+    if report.cached < total:
+        # Mesmo método de início da ingestão: nada de fork a partir do processo do app, que tem várias threads
+        with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=process_context()) as executor:
+            pending = set()
+            for page in missing:
+                pending.add(executor.submit(ocr_page, file_path, page))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page, text = future.result()
+                    save_extraction(content_hash, "ocr-page", OCR_VERSION, text, item=str(page))
+                    texts[page] = text
+                    report.recognized += 1
+                    notify()
+                    next_page = next(missing, None)
+                    if next_page is not None:
+                        pending.add(executor.submit(ocr_page, file_path, next_page))
+
+    report.elapsed = time.perf_counter() - start
+    logging.info(f"OCR de {file_path}: {report.summary()}")
+    return "\n\n".join(texts[page] for page in range(1, total + 1)).strip(), report
@@ -0,0 +1,131 @@
+import os
+import re
+import hmac
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from decouple import config
+from loader import UPLOAD_DIRECTORY
+
+# Servidor leve que entrega os arquivos de uploaded_files por referência (com suporte a Range),
+# evitando trafegar PDFs inteiros em base64 pelo websocket do Streamlit.
+# Só sobe com PREVIEW_PUBLIC_URL (o endereço que o navegador dos usuários alcança, ex.: um proxy reverso) e
+# PREVIEW_TOKEN (segredo que assina cada link, com validade): sem os dois, o app não expõe os arquivos.
+PREVIEW_HOST = config("PREVIEW_HOST", default="127.0.0.1")
+PREVIEW_PORT = config("PREVIEW_PORT", default=8502, cast=int)
+PREVIEW_PUBLIC_URL = config("PREVIEW_PUBLIC_URL", default="")  # ex.: https://docs.exemplo.gov.br/arquivos
+PREVIEW_TOKEN = config("PREVIEW_TOKEN", default="")
+PREVIEW_LINK_SECONDS = config("PREVIEW_LINK_SECONDS", default=3600, cast=int)
+
+RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)$")
+
+_server = None
+_server_lock = threading.Lock()
+
+def _signature(rel_path, expires):
+    message = f"{rel_path}:{expires}".encode("utf-8")
+    return hmac.new(PREVIEW_TOKEN.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+def _authorized(request_path):
+    parts = urlsplit(request_path)
+    query = parse_qs(parts.query)
+    expires, signature = query.get("expires", [""])[0], query.get("sig", [""])[0]
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _signature(unquote(parts.path).lstrip("/"), expires))
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    def list_directory(self, path):
+        self.send_error(HTTPStatus.NOT_FOUND)
+        return None
+
+    def log_message(self, format, *args):
+        logging.debug("preview: " + format % args)
+
+    def send_head(self):
+        if not _authorized(self.path):
+            self.send_error(HTTPStatus.FORBIDDEN)
+            return None
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) or os.path.basename(path).startswith("."):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return None
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return None
+
+        size = os.fstat(f.fileno()).st_size
+        start, end = 0, size - 1
+        match = RANGE_HEADER.match(self.headers.get("Range", ""))
+        if match and (match.group(1) or match.group(2)):
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            if start > end:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.end_headers()
+                return None
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(HTTPStatus.OK)
+
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        f.seek(start)
+        self.range_length = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        remaining = getattr(self, "range_length", None)
+        if remaining is None:
+            shutil.copyfileobj(source, outputfile)
+            return
+        while remaining > 0:
+            block = source.read(min(64 * 1024, remaining))
+            if not block:
+                break
+            outputfile.write(block)
+            remaining -= len(block)
+
+def preview_enabled():
+    return bool(PREVIEW_PUBLIC_URL and PREVIEW_TOKEN)
+
+def ensure_preview_server():
+    # Um servidor por processo; se a porta já estiver em uso, assume outro processo do app servindo
+    global _server
+    with _server_lock:
+        if _server is None and not preview_enabled():
+            logging.info("Servidor de pré-visualização desativado: configure PREVIEW_PUBLIC_URL e PREVIEW_TOKEN")
+            _server = False
+        if _server is None:
+            handler = partial(RangeRequestHandler, directory=os.path.abspath(UPLOAD_DIRECTORY))
+            try:
+                _server = ThreadingHTTPServer((PREVIEW_HOST, PREVIEW_PORT), handler)
+            except OSError as e:
+                logging.info(f"Servidor de pré-visualização não iniciado ({e}); usando o existente na porta {PREVIEW_PORT}")
+                _server = False
+            else:
+                threading.Thread(target=_server.serve_forever, daemon=True).start()
+    return _server
+
+def preview_url(rel_path):
+    # Link assinado e com validade; sem servidor configurado, None
+    if not preview_enabled():
+        return None
+    expires = str(int(time.time()) + PREVIEW_LINK_SECONDS)
+    return f"{PREVIEW_PUBLIC_URL.rstrip('/')}/{quote(rel_path)}?expires={expires}&sig={_signature(rel_path, expires)}"
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("langchain")
+pytest.importorskip("streamlit")
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+ANSWER = "FINAL ANSWER: O prazo é de 20 dias, prorrogáveis por mais 10.\nSOURCES: lai.pdf"
+
+class FixedRetriever(BaseRetriever):
+    documents: list
+    error: str = ""
+
+    def _get_relevant_documents(self, query, *, run_manager: CallbackManagerForRetrieverRun):
+        if self.error:
+            raise RuntimeError(self.error)
+        return self.documents
+
+@pytest.fixture
+def chat(tmp_path, monkeypatch):
+    # loader cria as pastas de dados no diretório atual ao ser importado
+    monkeypatch.chdir(tmp_path)
+    import chat
+    return chat
+
+def make_chain(chat, error=""):
+    from langchain.chains import RetrievalQAWithSourcesChain
+
+    llm = chat.FakeStreamingChat(responses=[ANSWER], sleep=0)
+    retriever = FixedRetriever(
+        documents=[Document(page_content="O órgão responde em 20 dias.", metadata={"source": "lai.pdf"})],
+        error=error
+    )
+    return RetrievalQAWithSourcesChain.from_chain_type(llm=llm, retriever=retriever)
+
+def test_tokens_arrive_in_order_and_match_the_final_answer(chat):
+    response = chat.stream_response(make_chain(chat), "Qual o prazo?", ignore_history=True)
+    chunks = list(response)
+
+    assert len(chunks) > 1
+    assert "".join(chunks) == response.answer
+    assert response.answer == "O prazo é de 20 dias, prorrogáveis por mais 10."
+    assert response.sources == "lai.pdf"
+    assert not any("SOURCES" in chunk or "FINAL ANSWER" in chunk for chunk in chunks)
+    assert 0 <= response.ttft_ms <= response.latency_ms
+
+def test_worker_thread_errors_reach_the_caller(chat):
+    response = chat.stream_response(make_chain(chat, error="índice indisponível"), "Qual o prazo?")
+
+    with pytest.raises(RuntimeError, match="índice indisponível"):
+        list(response)
@@ -0,0 +1,322 @@
+import os
+import io
+import atexit
+import time
+import queue
+import pstats
+import sqlite3
+import logging
+import cProfile
+import functools
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from multiprocessing.util import Finalize
+from decouple import config
+
+# Spans de latência por etapa (extração, split, embedding, recuperação, LLM, OCR, SQLite...).
+# Gravados por uma thread de fundo em lotes, num banco separado: medir não disputa a escrita do banco principal
+TRACING_ENABLED = config("TRACING_ENABLED", default=True, cast=bool)
+METRICS_PATH = config("METRICS_PATH", default="metrics.sqlite3")
+TRACE_QUEUE_SIZE = config("TRACE_QUEUE_SIZE", default=10000, cast=int)
+TRACE_FLUSH_SECONDS = config("TRACE_FLUSH_SECONDS", default=2.0, cast=float)
+TRACE_RETENTION_DAYS = config("TRACE_RETENTION_DAYS", default=14, cast=int)
+PROFILE_DIRECTORY = "profiles"
+
+_request_id = ContextVar("trace_request_id", default=None)
+_profiling = ContextVar("trace_profiling", default=None)
+_queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+_writer_pid = None
+_writer_lock = threading.Lock()
+_dropped = 0
+
+class Span:
+    __slots__ = ("stage", "detail", "hits", "misses", "error", "started_at")
+
+    def __init__(self, stage, detail=None):
+        self.stage = stage
+        self.detail = detail
+        self.hits = None  # Etapas com cache informam acertos e faltas
+        self.misses = None
+        self.error = False
+
+def create_metrics_table(path=METRICS_PATH):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS spans (
+                id INTEGER PRIMARY KEY,
+                request_id TEXT,
+                stage TEXT NOT NULL,
+                detail TEXT,
+                started_at REAL,
+                duration_ms REAL,
+                hits INTEGER,
+                misses INTEGER,
+                error INTEGER DEFAULT 0
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_stage ON spans (stage, started_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_spans_request ON spans (request_id)")
+        conn.commit()
+    finally:
+        conn.close()
+
+def _connect():
+    conn = sqlite3.connect(METRICS_PATH, timeout=5)
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+def _write(conn, rows):
+    try:
+        with conn:
+            conn.executemany("""
+                INSERT INTO spans (request_id, stage, detail, started_at, duration_ms, hits, misses, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+    except sqlite3.Error as e:
+        logging.warning(f"Falha ao gravar {len(rows)} span(s): {e}")
+
+def _writer():
+    conn = _connect()
+    last_purge = 0
+    while True:
+        rows, flushed = [], None
+        item = _queue.get()
+        deadline = time.monotonic() + TRACE_FLUSH_SECONDS
+        while True:
+            if isinstance(item, threading.Event):
+                flushed = item  # flush(): grava já o lote em andamento
+                break
+            rows.append(item)
+            if len(rows) >= 1000:
+                break
+            try:
+                item = _queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        if rows:
+            _write(conn, rows)
+        if flushed:
+            flushed.set()
+        if time.time() - last_purge > 3600:
+            _write_purge(conn)
+            last_purge = time.time()
+
+def _write_purge(conn):
+    try:
+        with conn:
+            conn.execute("DELETE FROM spans WHERE started_at < ?", (time.time() - TRACE_RETENTION_DAYS * 86400,))
+    except sqlite3.Error as e:
+        logging.warning(f"Falha ao limpar spans antigos: {e}")
+
+def flush(timeout=5):
+    # Espera a thread de gravação esvaziar a fila; chamado na saída do processo (a thread é daemon)
+    if _writer_pid != os.getpid():
+        return
+    done = threading.Event()
+    try:
+        _queue.put(done, timeout=timeout)
+    except queue.Full:
+        return
+    done.wait(timeout)
+
+def _ensure_writer():
+    # Uma thread por processo (inclusive os processos filhos da ingestão e do OCR)
+    global _writer_pid
+    with _writer_lock:
+        if _writer_pid != os.getpid():
+            create_metrics_table()
+            threading.Thread(target=_writer, daemon=True).start()
+            # Processos filhos do multiprocessing saem sem passar pelo atexit
+            atexit.register(flush)
+            Finalize(None, flush, exitpriority=10)
+            _writer_pid = os.getpid()
+
+def _reset_after_fork():
+    # A fila e a trava do pai podem ter sido copiadas no meio de uma operação da thread de gravação
+    global _queue, _writer_lock, _writer_pid
+    _queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+    _writer_lock = threading.Lock()
+    _writer_pid = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def record(stage, duration_ms, detail=None, hits=None, misses=None, error=False, started_at=None):
+    global _dropped
+    if not TRACING_ENABLED:
+        return
+    if _writer_pid != os.getpid():
+        _ensure_writer()
+    row = (_request_id.get(), stage, detail, started_at or time.time() - duration_ms / 1000, duration_ms,
+           hits, misses, int(error))
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        _dropped += 1  # Nunca bloqueia quem está sendo medido
+
+@contextmanager
+def span(stage, detail=None, min_ms=0):
+    # min_ms: fora de uma requisição, só grava chamadas lentas (ex.: SQLite, chamado o tempo todo pela interface)
+    current = Span(stage, detail)
+    if not TRACING_ENABLED:
+        yield current
+        return
+    current.started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield current
+    except Exception:
+        current.error = True  # st.rerun()/st.stop() interrompem o script sem ser erro
+        raise
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        if duration_ms >= min_ms or current.error or _request_id.get() is not None:
+            record(stage, duration_ms, current.detail, current.hits, current.misses, current.error,
+                   current.started_at)
+
+def traced(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced_iter(stage, iterable, detail=None):
+    # Soma o tempo gasto dentro do gerador (e não no corpo do laço de quem consome) num único span
+    total, count, error = 0.0, 0, False
+    started_at = time.time()
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                total += time.perf_counter() - start
+                break
+            except Exception:
+                total += time.perf_counter() - start
+                error = True
+                raise
+            total += time.perf_counter() - start
+            count += 1
+            yield item
+    finally:
+        record(stage, total * 1000, detail or f"{count} item(ns)", error=error, started_at=started_at)
+
+@contextmanager
+def request(kind, detail=None, profile=False):
+    # Agrupa os spans de uma pergunta; com profile=True grava um cProfile da requisição em profiles/
+    request_id = uuid.uuid4().hex[:12]
+    token = _request_id.set(request_id)
+    profilers = [cProfile.Profile()] if profile else None
+    profiling_token = _profiling.set(profilers)
+    if profilers:
+        profilers[0].enable()
+    try:
+        with span(kind, detail):
+            yield request_id
+    finally:
+        if profilers:
+            profilers[0].disable()
+            _save_profile(request_id, profilers)
+        _profiling.reset(profiling_token)
+        _request_id.reset(token)
+
+@contextmanager
+def profile_thread():
+    # Threads auxiliares da requisição (ex.: streaming da chain) entram no mesmo perfil
+    profilers = _profiling.get()
+    if profilers is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+: o perfil é do interpretador inteiro e o da requisição já cobre esta thread
+        yield
+        return
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profilers.append(profiler)
+
+def _save_profile(request_id, profilers):
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(os.path.join(PROFILE_DIRECTORY, f"{request_id}.prof"))
+
+def profile_summary(request_id, limit=25):
+    path = os.path.join(PROFILE_DIRECTORY, f"{request_id}.prof")
+    if not os.path.exists(path):
+        return None
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+def profile_path(request_id):
+    return os.path.join(PROFILE_DIRECTORY, f"{request_id}.prof")
+
+def current_request():
+    return _request_id.get()
+
+def _read(sql, params=()):
+    conn = sqlite3.connect(METRICS_PATH, timeout=5)
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+def get_stage_percentiles(since):
+    # (etapa, chamadas, p50, p95, p99, máximo) por etapa; percentis por posição, calculados no próprio SQLite
+    return _read("""
+        WITH ranked AS (
+            SELECT stage, duration_ms,
+                   ROW_NUMBER() OVER (PARTITION BY stage ORDER BY duration_ms) AS rn,
+                   COUNT(*) OVER (PARTITION BY stage) AS n
+            FROM spans WHERE started_at >= ?
+        )
+        SELECT stage, MAX(n),
+               MIN(CASE WHEN rn >= 0.50 * n THEN duration_ms END),
+               MIN(CASE WHEN rn >= 0.95 * n THEN duration_ms END),
+               MIN(CASE WHEN rn >= 0.99 * n THEN duration_ms END),
+               MAX(duration_ms)
+        FROM ranked GROUP BY stage ORDER BY stage
+    """, (since,))
+
+def get_slowest_requests(since, kind="chat", limit=10):
+    # (request_id, início, duração, detalhe, etapas mais lentas "etapa=ms; ...")
+    rows = _read("""
+        SELECT request_id, started_at, duration_ms, detail FROM spans
+        WHERE stage = ? AND started_at >= ? AND request_id IS NOT NULL
+        ORDER BY duration_ms DESC LIMIT ?
+    """, (kind, since, limit))
+    if not rows:
+        return []
+    breakdown = {}
+    for request_id, stage, total in _read(f"""
+        SELECT request_id, stage, SUM(duration_ms) FROM spans
+        WHERE request_id IN ({",".join("?" * len(rows))}) AND stage != ?
+        GROUP BY request_id, stage ORDER BY SUM(duration_ms) DESC
+    """, [row[0] for row in rows] + [kind]):
+        breakdown.setdefault(request_id, []).append(f"{stage}={total:.0f}ms")
+    return [(request_id, started_at, duration, detail, "; ".join(breakdown.get(request_id, [])[:4]))
+            for request_id, started_at, duration, detail in rows]
+
+def get_cache_hit_rates(since):
+    # {etapa: (acertos, faltas)} das etapas que passam por cache
+    rows = _read("""
+        SELECT stage, SUM(hits), SUM(misses) FROM spans
+        WHERE started_at >= ? AND hits IS NOT NULL
+        GROUP BY stage
+    """, (since,))
+    return {stage: (hits or 0, misses or 0) for stage, hits, misses in rows}
@@ -1,23 +1,68 @@
 import os
+import uuid
 import streamlit as st
-from loader import get_available_files, delete_files, UPLOAD_DIRECTORY
-from db import delete_all_history
+from loader import delete_files, UPLOAD_DIRECTORY
+from db import delete_all_history, get_manifest, list_manifest_folders, save_manifest_dir, get_session_titles, LEGACY_SESSION_ID
+from jobs import get_file_status, list_jobs, cancel_job, retry_job
+
+STATUS_ICONS = {"pending": "⏳", "running": "🔄", "done": "✅", "failed": "⚠️", "cancelled": "⛔"}
+# Status de indexação registrado no manifesto de arquivos
+INDEX_ICONS = {"pending": "⏳", "indexed": "✅", "empty": "📭", "failed": "⚠️"}
+JOB_LABELS = {"index": "Indexação", "search": "Busca textual", "ocr": "OCR", "lai": "Busca semântica LAI"}
+# Histórico gravado antes das conversas por ID fica todo na sessão "legado"
+SESSION_LABELS = {LEGACY_SESSION_ID: "📜 Conversas anteriores"}
+SESSION_LIST_LIMIT = 20
+
+@st.fragment(run_every=3)
+def render_job_status():
+    # Atualiza sozinho a cada poucos segundos, sem rerun da página inteira
+    jobs = list_jobs()
+    if not jobs:
+        st.caption("✅ Nenhuma indexação pendente.")
+        return
+    for job_id, kind, source, status, progress, attempts, error in jobs:
+        st.markdown(f"{STATUS_ICONS.get(status, '')} **{JOB_LABELS.get(kind, kind)}** · `{source}`")
+        if status == "running":
+            st.progress(progress or 0.0)
+        if status == "failed":
+            st.caption(f"Falhou após {attempts} tentativa(s): {error}")
+            if st.button("🔁 Tentar de novo", key=f"retry_job_{job_id}"):
+                retry_job(job_id)
+                st.rerun(scope="fragment")
+        elif st.button("✖️ Cancelar", key=f"cancel_job_{job_id}"):
+            cancel_job(job_id)
+            st.rerun(scope="fragment")
 
 def render_sidebar():
     with st.sidebar:
         st.header("Upload de arquivos 📄")
         # Pasta destino
-        folders = [f for f in os.listdir(UPLOAD_DIRECTORY) if os.path.isdir(os.path.join(UPLOAD_DIRECTORY, f))]
+        folders = list_manifest_folders()
         selected_folder = st.selectbox("📂 Selecionar pasta destino", folders + ["Nova pasta..."])
         if selected_folder == "Nova pasta...":
             new_folder = st.text_input("Nome da nova pasta")
             if new_folder:
-                os.makedirs(os.path.join(UPLOAD_DIRECTORY, new_folder), exist_ok=True)
+                folder_path = os.path.join(UPLOAD_DIRECTORY, new_folder)
+                os.makedirs(folder_path, exist_ok=True)
+                save_manifest_dir(new_folder, os.stat(folder_path).st_mtime)
                 selected_folder = new_folder
         uploaded_files = st.file_uploader("Faça o upload de arquivos", type=["pdf", "docx", "pptx", "csv", "txt"], accept_multiple_files=True)
         st.markdown("---")
-        files = list(set(get_available_files()))  # Evita duplicações no menu
-        selected_files = st.multiselect("📁 Escolha os arquivos para base do RAG:", files, default=files)
+        manifest = get_manifest()
+        files = list(manifest)
+        status = get_file_status()
+
+        def file_label(f):
+            job_status = status.get(f, (None,))[0]
+            if job_status in ("pending", "running", "failed"):
+                return f"{STATUS_ICONS[job_status]} {f}"
+            # "empty": processado sem gerar conteúdo (ex.: PDF de imagem aguardando OCR)
+            return f"{INDEX_ICONS.get(manifest[f][4], '⏳')} {f}"
+
+        selected_files = st.multiselect("📁 Escolha os arquivos para base do RAG:", files, default=files,
+                                        format_func=file_label)
+        with st.expander("⚙️ Fila de indexação"):
+            render_job_status()
 
         if selected_files and st.button("❌ Apagar arquivos selecionados"):
             delete_files(selected_files)
@@ -26,11 +71,35 @@ def render_sidebar():
         st.markdown("---")
         selected_model = st.selectbox("Selecione o modelo LLM", ["gpt-3.5-turbo", "gpt-4", "gpt-4-turbo", "gpt-4o"])
         st.markdown("---")
+        if st.button("🆕 Nova conversa"):
+            st.query_params["conversa"] = uuid.uuid4().hex
+            st.rerun()
+        render_sessions()
         if st.button("🗑️ Limpar histórico"):
             delete_all_history()
             st.success("Histórico apagado com sucesso!")
     return uploaded_files, selected_files, selected_model, selected_folder
 
+def render_sessions():
+    # Só as conversas abertas neste navegador (mais recente primeiro) e o histórico legado, da época sem conversas
+    candidates = st.session_state.get("minhas_conversas", [])[:SESSION_LIST_LIMIT]
+    if LEGACY_SESSION_ID not in candidates:
+        candidates = candidates + [LEGACY_SESSION_ID]
+    titles = get_session_titles(candidates)
+    sessions = [session_id for session_id in candidates if session_id in titles]
+    if not sessions:
+        return
+    current = st.query_params.get("conversa")
+    with st.expander("💬 Conversas"):
+        for session_id in sessions:
+            title = titles[session_id]
+            label = SESSION_LABELS.get(session_id) or title[:40] + ("…" if len(title) > 40 else "")
+            if session_id == current:
+                st.markdown(f"**▶ {label}**")
+            elif st.button(label, key=f"conversa_{session_id}"):
+                st.query_params["conversa"] = session_id
+                st.rerun()
+
 def render_chat_history(history_rows):
     for row in history_rows:
         chat_id, model, user_input, assistant_response, fontes = row